@@ -1,5 +1,12 @@
+from .compilation import CompiledGenerator
 from .configuration import DalleBartConfig
+from .encoder_cache import EncoderCache
+from .engine import ContinuousBatchingEngine
 from .modeling import DalleBart
+from .parallel import ShardedGenerator
 from .partitions import set_partitions
+from .postprocessing import ImagePostprocessor
 from .processor import DalleBartProcessor
+from .reranking import ClipReranker
+from .result_cache import GenerationResultCache, generate_with_cache
 from .tokenizer import DalleBartTokenizer
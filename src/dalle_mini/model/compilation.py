@@ -0,0 +1,220 @@
+""" Ahead-of-time compiled DalleBart generation """
+
+import hashlib
+import json
+import os
+import pickle
+from typing import Any, Dict, Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax.core.frozen_dict import unfreeze
+from flax.traverse_util import flatten_dict
+from transformers.utils import logging
+
+from .modeling import DalleBart
+
+try:
+    from jax.experimental.serialize_executable import deserialize_and_load, serialize
+
+    compile_and_serialize = None
+except ImportError:  # jax < 0.4.8 serializes while compiling
+    from jax.experimental.serialize_executable import compile_and_serialize
+    from jax.experimental.serialize_executable import (
+        load_compiled as deserialize_and_load,
+    )
+
+    serialize = None
+
+logger = logging.get_logger(__name__)
+
+
+class CompiledGenerator:
+    """
+    Sampling loop of `DalleBart.generate` compiled ahead of time for a set of batch sizes.
+
+    Executables are serialized to `cache_dir`, keyed by the model config and dtype, the
+    shapes and dtypes of the params, the sampling settings, the batch size, the JAX
+    version and the backend, so that a new process loads them instead of recompiling.
+    On CPU, executables can only be serialized with the XLA runtime, enabled with
+    `XLA_FLAGS=--xla_cpu_use_xla_runtime=true` before jax is imported; otherwise they
+    are compiled by every process. Inputs are padded to the smallest batch size that
+    fits them.
+
+    Example:
+        generator = CompiledGenerator(
+            model, params, cache_dir="aot_cache", batch_sizes=(1, 4, 8), condition_scale=10.0
+        )
+        generator.warmup()  # load or compile every batch size
+        sequences = generator(
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            prng_key,
+            inputs["input_ids_uncond"],
+            inputs["attention_mask_uncond"],
+        )
+    """
+
+    def __init__(
+        self,
+        model: DalleBart,
+        params: Dict[str, Any],
+        cache_dir: Optional[str] = None,
+        batch_sizes: Sequence[int] = (1,),
+        **generate_kwargs,
+    ):
+        self.model = model
+        # plain dicts keep the tree structure of the executables serializable
+        self.params = unfreeze(params)
+        self.cache_dir = cache_dir
+        self.batch_sizes = sorted(batch_sizes)
+        self.generate_kwargs = generate_kwargs
+        self.super_conditioning = generate_kwargs.get("condition_scale", 1.0) != 1.0
+        self._executables = {}
+        self.metrics = {"loaded": 0, "compiled": 0}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _generate_fn(
+        self,
+        params,
+        input_ids,
+        attention_mask,
+        prng_key,
+        input_ids_uncond=None,
+        attention_mask_uncond=None,
+    ):
+        return self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            input_ids_uncond=input_ids_uncond,
+            attention_mask_uncond=attention_mask_uncond,
+            prng_key=prng_key,
+            params=params,
+            **self.generate_kwargs,
+        ).sequences
+
+    def cache_key(self, batch_size: int) -> str:
+        """Identifies an executable across processes."""
+        params_description = sorted(
+            ("/".join(k), v.shape, str(v.dtype))
+            for k, v in flatten_dict(self.params).items()
+        )
+        description = {
+            "config": self.model.config.to_json_string(),
+            "dtype": str(self.model.dtype),
+            "params": hashlib.sha256(str(params_description).encode()).hexdigest(),
+            "generate_kwargs": self.generate_kwargs,
+            "batch_size": batch_size,
+            "max_text_length": self.model.config.max_text_length,
+            "jax": jax.__version__,
+            "backend": jax.default_backend(),
+            "devices": [d.device_kind for d in jax.local_devices()],
+        }
+        description = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _abstract_inputs(self, batch_size):
+        text_shape = jax.ShapeDtypeStruct(
+            (batch_size, self.model.config.max_text_length), jnp.int32
+        )
+        inputs = [text_shape, text_shape, jax.ShapeDtypeStruct((2,), jnp.uint32)]
+        if self.super_conditioning:
+            inputs += [text_shape, text_shape]
+        return inputs
+
+    def _compile(self, batch_size, serialize_executable=False):
+        """Compiles the executable of `batch_size`, along with its serialized form."""
+        lowered = jax.jit(self._generate_fn).lower(
+            self.params, *self._abstract_inputs(batch_size)
+        )
+        executable = serialized = None
+        if serialize_executable:
+            try:
+                if compile_and_serialize is not None:
+                    serialized = compile_and_serialize(lowered)
+                    executable = deserialize_and_load(*serialized)
+                else:
+                    executable = lowered.compile()
+                    serialized = serialize(executable)
+            except Exception as e:
+                # e.g. CPU without the XLA runtime
+                logger.warning(f"Could not serialize compiled generation: {e}")
+                serialized = None
+        if executable is None:
+            executable = lowered.compile()
+        return executable, serialized
+
+    def get_executable(self, batch_size: int):
+        """Returns the executable for `batch_size`, loading or compiling it."""
+        if batch_size in self._executables:
+            return self._executables[batch_size]
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, f"{self.cache_key(batch_size)}.pkl")
+        executable = None
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    executable = deserialize_and_load(*pickle.load(f))
+            except Exception as e:
+                logger.warning(f"Could not load compiled generation from {path}: {e}")
+            else:
+                self.metrics["loaded"] += 1
+        if executable is None:
+            executable, serialized = self._compile(
+                batch_size, serialize_executable=path is not None
+            )
+            self.metrics["compiled"] += 1
+            if serialized is not None:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(serialized, f)
+                os.replace(tmp_path, path)
+        self._executables[batch_size] = executable
+        return executable
+
+    def warmup(self):
+        """Loads or compiles the executables of all batch sizes."""
+        for batch_size in self.batch_sizes:
+            self.get_executable(batch_size)
+
+    def bucket(self, batch_size: int) -> int:
+        """Smallest declared batch size that fits `batch_size`."""
+        for bucket in self.batch_sizes:
+            if bucket >= batch_size:
+                return bucket
+        raise ValueError(
+            f"Batch size {batch_size} exceeds the largest bucket {self.batch_sizes[-1]}"
+        )
+
+    def __call__(
+        self,
+        input_ids,
+        attention_mask,
+        prng_key,
+        input_ids_uncond=None,
+        attention_mask_uncond=None,
+    ) -> np.ndarray:
+        batch_size = input_ids.shape[0]
+        bucket = self.bucket(batch_size)
+        inputs = [input_ids, attention_mask]
+        if self.super_conditioning:
+            assert (
+                input_ids_uncond is not None
+            ), "`input_ids_uncond` has to be defined for super conditioning."
+            inputs += [input_ids_uncond, attention_mask_uncond]
+        # padding rows repeat the last request and are dropped from the output
+        inputs = [
+            np.pad(
+                np.asarray(x, dtype=np.int32),
+                ((0, bucket - batch_size), (0, 0)),
+                mode="edge",
+            )
+            for x in inputs
+        ]
+        sequences = self.get_executable(bucket)(
+            self.params, *inputs[:2], prng_key, *inputs[2:]
+        )
+        return np.asarray(sequences)[:batch_size]
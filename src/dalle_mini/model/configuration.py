@@ -52,6 +52,7 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         init_std=0.02,
         scale_embedding=False,
         gradient_checkpointing=True,
+        remat_policy=None,  # activations saved by gradient checkpointing, None (recompute everything), "save_attention" or "save_dots"
         use_scan=None,
         use_cache=True,
         is_encoder_decoder=True,
@@ -72,10 +73,19 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         use_glu=True,  # "GLU Variants Improve Transformer"
         use_alibi=False,  # Not implemented yet - from "Train Short, Test Long: Attention with Linear Biases Enables Input Length Extrapolation"
         sinkhorn_iters=1,  # used in SinkFormers
+        attention_block_size=None,  # keys per block of memory efficient attention (online softmax), None for full attention weights, encoder layers with sinkhorn_iters > 1 always use full attention weights
+        fuse_qkv=False,  # single query, key and value projection in self-attention (see `DalleBart.fuse_qkv`)
         use_final_ln_encoder=True,  # final layer normalization in encoder
         use_final_ln_decoder=True,  # final layer normalization in decoder
         # parameters that should not be necessary but could affect results
         force_ln_scale=False,  # force scale in layernorm even when followed by dense layers
+        # inference
+        quantization=None,  # weight-only quantization of dense kernels, None, "int8" or "int4"
+        quantization_group_size=128,  # input channels per scale in "int4" quantization
+        # decoder self-attention cache, None or "int8" (scale per position and head), each key and value
+        # is rounded to within 0.4% of its largest component, logits move by up to ~0.3% of their largest
+        # magnitude (see tests/test_quantization.py)
+        kv_cache_quantization=None,
         **kwargs,
     ):
         # text normalizer
@@ -110,6 +120,13 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         self.use_glu = use_glu
         self.use_alibi = use_alibi
         self.sinkhorn_iters = sinkhorn_iters
+        self.attention_block_size = attention_block_size
+        if attention_block_size is not None and sinkhorn_iters > 1:
+            logger.warning(
+                "Encoder attention weights are materialized with `sinkhorn_iters` > 1, "
+                "`attention_block_size` only applies to decoder layers."
+            )
+        self.fuse_qkv = fuse_qkv
         if ln_positions == "postln":
             assert (
                 use_final_ln_encoder
@@ -120,6 +137,18 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         self.use_final_ln_encoder = use_final_ln_encoder
         self.use_final_ln_decoder = use_final_ln_decoder
         self.force_ln_scale = force_ln_scale
+        assert quantization in [
+            None,
+            "int8",
+            "int4",
+        ], "quantization must be None, 'int8' or 'int4'"
+        self.quantization = quantization
+        self.quantization_group_size = quantization_group_size
+        assert kv_cache_quantization in [
+            None,
+            "int8",
+        ], "kv_cache_quantization must be None or 'int8'"
+        self.kv_cache_quantization = kv_cache_quantization
 
         # common parameters
         self.encoder_vocab_size = encoder_vocab_size
@@ -140,6 +169,12 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         self.init_std = init_std
         self.use_cache = use_cache
         self.gradient_checkpointing = gradient_checkpointing
+        assert remat_policy in [
+            None,
+            "save_attention",
+            "save_dots",
+        ], "remat_policy must be None, 'save_attention' or 'save_dots'"
+        self.remat_policy = remat_policy
         # all layers are the same in most configurations
         self.use_scan = use_scan if use_scan is not None else ln_positions != "swinv2"
         assert not (
@@ -0,0 +1,186 @@
+""" Cache of DalleBart encoder outputs for repeated prompts """
+
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax.traverse_util import flatten_dict
+from transformers.modeling_flax_outputs import FlaxBaseModelOutput
+
+
+def params_fingerprint(params) -> str:
+    """Hash of the encoder params (structure, shapes and checksums of the values)."""
+    if "model" in params and "encoder" in params["model"]:
+        params = params["model"]["encoder"]
+    description = hashlib.sha256()
+    leaves = sorted(flatten_dict(params).items())
+    checksums = jax.device_get(
+        [
+            (
+                jnp.sum(v.astype(jnp.float32)),
+                jnp.sum(jnp.square(v.astype(jnp.float32))),
+            )
+            for _, v in leaves
+        ]
+    )
+    for (k, v), checksum in zip(leaves, checksums):
+        description.update(f"{k}{v.shape}{v.dtype}{checksum}".encode())
+    return description.hexdigest()
+
+
+class EncoderCache:
+    """
+    LRU cache of encoder hidden states, one entry per prompt.
+
+    Entries are keyed by the token ids and attention mask of a row and a fingerprint
+    of the encoder params. Up to `max_device_bytes` of hidden states stay on device;
+    least recently used entries are then moved to host memory (up to
+    `max_host_bytes`) before being dropped.
+
+    Pass it to `DalleBart.generate(..., encoder_cache=cache)` to encode only the
+    prompts that are not cached (outside of `jax.jit`).
+    """
+
+    def __init__(
+        self,
+        max_device_bytes: int = 256 * 2**20,
+        max_host_bytes: Optional[int] = 2**30,
+    ):
+        self.max_device_bytes = max_device_bytes
+        self.max_host_bytes = max_host_bytes or 0
+        self._device = OrderedDict()
+        self._host = OrderedDict()
+        self._device_bytes = 0
+        self._host_bytes = 0
+        # weak references to the leaves of recent params, to check that ids are not reused
+        self._fingerprints = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "host_hits": 0, "misses": 0, "evictions": 0}
+
+    def fingerprint(self, params) -> str:
+        leaves = jax.tree_util.tree_leaves(params)
+        ids = tuple(id(x) for x in leaves)
+        if ids in self._fingerprints:
+            refs, fingerprint = self._fingerprints[ids]
+            if all(ref() is x for ref, x in zip(refs, leaves)):
+                self._fingerprints.move_to_end(ids)
+                return fingerprint
+        fingerprint = params_fingerprint(params)
+        try:
+            refs = tuple(weakref.ref(x) for x in leaves)
+        except TypeError:
+            # leaves cannot be tracked: do not memoize
+            return fingerprint
+        self._fingerprints[ids] = (refs, fingerprint)
+        if len(self._fingerprints) > 4:
+            self._fingerprints.popitem(last=False)
+        return fingerprint
+
+    @staticmethod
+    def key(input_ids, attention_mask, fingerprint: str) -> str:
+        description = hashlib.sha256(fingerprint.encode())
+        description.update(np.asarray(input_ids, dtype=np.int32).tobytes())
+        description.update(np.asarray(attention_mask, dtype=np.int32).tobytes())
+        return description.hexdigest()
+
+    def _evict(self):
+        # caller holds the lock
+        while self._device_bytes > self.max_device_bytes:
+            key, value = self._device.popitem(last=False)
+            self._device_bytes -= value.nbytes
+            if value.nbytes <= self.max_host_bytes:
+                self._host[key] = np.asarray(value)
+                self._host_bytes += value.nbytes
+            else:
+                self.metrics["evictions"] += 1
+        while self._host_bytes > self.max_host_bytes:
+            _, value = self._host.popitem(last=False)
+            self._host_bytes -= value.nbytes
+            self.metrics["evictions"] += 1
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._device:
+                self._device.move_to_end(key)
+                self.metrics["hits"] += 1
+                return self._device[key]
+            if key in self._host:
+                value = self._host.pop(key)
+                self._host_bytes -= value.nbytes
+                self.metrics["host_hits"] += 1
+                value = jnp.asarray(value)
+                # may be moved back to host right away if it exceeds `max_device_bytes`
+                self._put(key, value)
+                return value
+            self.metrics["misses"] += 1
+            return None
+
+    def _put(self, key, value):
+        self._device[key] = value
+        self._device_bytes += value.nbytes
+        self._evict()
+
+    def put(self, key: str, hidden_states):
+        with self._lock:
+            if key not in self._device:
+                self._put(key, hidden_states)
+
+    def prepare_encoder_kwargs(
+        self,
+        prepare_encoder_kwargs: Callable,
+        input_ids,
+        params,
+        model_kwargs: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """
+        Same as `prepare_encoder_kwargs(input_ids, params, model_kwargs)` (see
+        `DalleBart._prepare_encoder_decoder_kwargs_for_generation`), encoding only
+        the rows missing from the cache.
+
+        The cache is skipped when called with traced inputs or params (e.g. under
+        `jax.jit`), as keys are computed from concrete values.
+        """
+        traced = [input_ids, model_kwargs.get("attention_mask"), params]
+        if any(
+            isinstance(x, jax.core.Tracer) for x in jax.tree_util.tree_leaves(traced)
+        ):
+            return prepare_encoder_kwargs(input_ids, params, model_kwargs)
+        input_ids = np.asarray(input_ids)
+        attention_mask = model_kwargs.get("attention_mask")
+        attention_mask = (
+            np.asarray(attention_mask)
+            if attention_mask is not None
+            else np.ones_like(input_ids)
+        )
+        fingerprint = self.fingerprint(params)
+        keys = [
+            self.key(ids, mask, fingerprint)
+            for ids, mask in zip(input_ids, attention_mask)
+        ]
+        cached = {key: self.get(key) for key in dict.fromkeys(keys)}
+        # identical rows (e.g. unconditional prompts) are encoded once
+        missing = [keys.index(key) for key, h in cached.items() if h is None]
+        if missing:
+            # pad to a power of 2 to limit the number of compiled shapes
+            num_rows = 1 << (len(missing) - 1).bit_length()
+            rows = np.asarray(missing + missing[-1:] * (num_rows - len(missing)))
+            encoded = prepare_encoder_kwargs(
+                jnp.asarray(input_ids[rows]),
+                params,
+                {**model_kwargs, "attention_mask": jnp.asarray(attention_mask[rows])},
+            )["encoder_outputs"].last_hidden_state
+            for j, i in enumerate(missing):
+                cached[keys[i]] = encoded[j]
+                self.put(keys[i], encoded[j])
+        return {
+            **model_kwargs,
+            "attention_mask": jnp.asarray(attention_mask),
+            "encoder_outputs": FlaxBaseModelOutput(
+                last_hidden_state=jnp.stack([cached[key] for key in keys])
+            ),
+        }
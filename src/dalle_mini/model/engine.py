@@ -0,0 +1,599 @@
+""" Continuous batching generation engine for DalleBart """
+
+import itertools
+import math
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+import flax
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax.traverse_util import flatten_dict, unflatten_dict
+from jax import lax
+
+from .modeling import DalleBart
+
+
+def _first_not_none(*values):
+    return next(v for v in values if v is not None)
+
+
+@flax.struct.dataclass
+class EngineState:
+    """Decode state of a fixed number of slots, each holding one request."""
+
+    cur_len: jnp.ndarray
+    sequences: jnp.ndarray
+    running_token: jnp.ndarray
+    active: jnp.ndarray
+    prng_key: jnp.ndarray
+    sampling_params: Dict[str, jnp.ndarray]
+    model_kwargs: Dict[str, Any]
+    model_kwargs_uncond: Optional[Dict[str, Any]]
+
+
+class ContinuousBatchingEngine:
+    """
+    Runs DalleBart sampling over a fixed number of slots.
+
+    Requests are queued with `submit` and join free slots at token boundaries
+    (every `steps_per_sync` tokens), where cancelled requests (see `cancel`) also
+    release their slot. Each slot keeps its own `cur_len` and KV-cache
+    position so that rows finish and get replaced independently instead of waiting
+    for the whole batch.
+
+    The unconditional prompt used for super conditioning is encoded once and shared
+    by all slots.
+
+    `top_k`, `top_p`, `temperature` and `condition_scale` are defaults that each request
+    may override in `submit`. They are traced per slot so that requests with different
+    settings share the same batch and executable.
+
+    With `page_size`, the self-attention cache is a pool of `num_pages` pages shared by
+    all slots instead of a buffer of `max_length` positions per slot. Pages are
+    allocated to a slot as its sequence grows and returned to the pool when the
+    request finishes, so that the pool can be smaller than `num_slots` full sequences.
+    When the pool runs out, the most recently admitted request is preempted and
+    requeued to restart later.
+
+    Example:
+        inputs = processor(["a prompt"])
+        engine = ContinuousBatchingEngine(
+            model,
+            params,
+            num_slots=8,
+            condition_scale=10.0,
+            input_ids_uncond=inputs["input_ids_uncond"],
+            attention_mask_uncond=inputs["attention_mask_uncond"],
+        )
+        request_id = engine.submit(
+            inputs["input_ids"], inputs["attention_mask"], prng_key=key, top_k=64
+        )
+        results = engine.run()  # {request_id: sequence}
+    """
+
+    def __init__(
+        self,
+        model: DalleBart,
+        params: Dict[str, Any],
+        num_slots: int = 8,
+        steps_per_sync: int = 16,
+        condition_scale: float = 1.0,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        temperature: Optional[float] = None,
+        input_ids_uncond: Optional[jnp.ndarray] = None,
+        attention_mask_uncond: Optional[jnp.ndarray] = None,
+        page_size: Optional[int] = None,
+        num_pages: Optional[int] = None,
+    ):
+        self.model = model
+        self.params = params
+        self.num_slots = num_slots
+        self.steps_per_sync = steps_per_sync
+        self.max_length = model.config.max_length
+        self.sampling_params = {
+            "top_k": _first_not_none(top_k, model.config.top_k, 0),
+            "top_p": _first_not_none(top_p, model.config.top_p, 1.0),
+            "temperature": _first_not_none(temperature, model.config.temperature, 1.0),
+            "condition_scale": condition_scale,
+        }
+        # the unconditional rows are decoded whenever an unconditional prompt is given
+        self.super_conditioning = input_ids_uncond is not None or condition_scale != 1.0
+
+        self._queue = deque()
+        self._slots = [None] * num_slots
+        self._slot_requests = [None] * num_slots
+        self._request_ids = itertools.count()
+
+        self.page_size = page_size
+        if page_size is not None:
+            assert (
+                self.max_length - 1
+            ) % page_size == 0, f"`page_size` must divide {self.max_length - 1}"
+            self.pages_per_slot = (self.max_length - 1) // page_size
+            # page 0 is a scratch page for slots without pages
+            self.num_pages = (
+                num_pages
+                if num_pages is not None
+                else num_slots * self.pages_per_slot + 1
+            )
+            assert (
+                self.num_pages > self.pages_per_slot
+            ), "`num_pages` must fit at least one full sequence"
+            self._free_pages = list(range(1, self.num_pages))
+            self._slot_pages = [[] for _ in range(num_slots)]
+            # host copy of the length of each slot, to allocate pages ahead of decoding
+            self._slot_lengths = [0] * num_slots
+            self._block_table = None
+            self._set_block_table = jax.jit(self._set_block_table_fn)
+
+        if self.super_conditioning:
+            assert (
+                input_ids_uncond is not None
+            ), "`input_ids_uncond` has to be defined for super conditioning."
+            self.uncond_cache = jax.jit(self.model.init_uncond_cache)(
+                input_ids_uncond, attention_mask_uncond, params=params
+            )
+        else:
+            self.uncond_cache = None
+
+        self._encode = jax.jit(self._encode_fn)
+        self._insert = jax.jit(self._insert_fn)
+        self._decode = jax.jit(self._decode_fn)
+        self.state = self._init_state()
+
+    def _init_kwargs(self, uncond_cache=None):
+        config = self.model.config
+        if uncond_cache is not None:
+            # a single row broadcast to every slot
+            encoder_outputs = (uncond_cache["encoder_outputs"][0],)
+            encoder_attention_mask = uncond_cache["attention_mask"]
+            cross_attention_cache = uncond_cache["cross_attention_cache"]
+        else:
+            encoder_outputs = (
+                jnp.zeros(
+                    (self.num_slots, config.max_text_length, config.d_model),
+                    dtype=self.model.dtype,
+                ),
+            )
+            encoder_attention_mask = jnp.ones(
+                (self.num_slots, config.max_text_length), dtype="i4"
+            )
+            cross_attention_cache = jax.jit(self.model.init_cross_attention_cache)(
+                encoder_outputs, encoder_attention_mask, params=self.params
+            )
+        past_key_values = self.model.init_cache(
+            self.num_slots,
+            self.max_length - 1,
+            encoder_outputs,
+            per_row_index=True,
+            page_size=self.page_size,
+            num_pages=self.num_pages if self.page_size is not None else None,
+        )
+        past_key_values = unflatten_dict(
+            {
+                **flatten_dict(past_key_values),
+                **flatten_dict(cross_attention_cache),
+            }
+        )
+        return {
+            "past_key_values": past_key_values,
+            "encoder_outputs": encoder_outputs,
+            "encoder_attention_mask": encoder_attention_mask,
+            "decoder_attention_mask": jnp.ones(
+                (self.num_slots, self.max_length - 1), dtype="i4"
+            ),
+            "decoder_position_ids": jnp.zeros((self.num_slots, 1), dtype="i4"),
+        }
+
+    def _init_state(self):
+        pad_token_id = self.model.config.pad_token_id
+        return EngineState(
+            cur_len=jnp.zeros((self.num_slots,), dtype=jnp.int32),
+            sequences=jnp.full(
+                (self.num_slots, self.max_length), pad_token_id, dtype=jnp.int32
+            ),
+            running_token=jnp.full((self.num_slots, 1), pad_token_id, dtype=jnp.int32),
+            active=jnp.zeros((self.num_slots,), dtype=jnp.bool_),
+            prng_key=jnp.zeros((self.num_slots, 2), dtype=jnp.uint32),
+            sampling_params={
+                k: jnp.full((self.num_slots,), v, dtype=jnp.asarray(v).dtype)
+                for k, v in self.sampling_params.items()
+            },
+            model_kwargs=self._init_kwargs(),
+            model_kwargs_uncond=(
+                self._init_kwargs(self.uncond_cache)
+                if self.super_conditioning
+                else None
+            ),
+        )
+
+    def _encode_fn(self, params, input_ids, attention_mask):
+        encoder_outputs = self.model.encode(input_ids, attention_mask, params=params)
+        cross_attention_cache = self.model.init_cross_attention_cache(
+            encoder_outputs, attention_mask, params=params
+        )
+        return encoder_outputs[0], cross_attention_cache
+
+    def _insert_fn(
+        self,
+        state,
+        slot,
+        prng_key,
+        sampling_params,
+        encoder_hidden_states,
+        cross_attention_cache,
+        attention_mask,
+    ):
+        """Reset one slot and load the encoder outputs of a new request."""
+
+        def reset_position(model_kwargs):
+            cache = flatten_dict(model_kwargs["past_key_values"])
+            for k, v in cache.items():
+                if k[-1] == "cache_index":
+                    # keys and values of the previous request are masked out
+                    cache[k] = v.at[..., slot].set(0)
+            return {
+                **model_kwargs,
+                "past_key_values": unflatten_dict(cache),
+                "decoder_position_ids": model_kwargs["decoder_position_ids"]
+                .at[slot]
+                .set(0),
+            }
+
+        def reset(model_kwargs, hidden_states, cross_attention_cache, mask):
+            model_kwargs = reset_position(model_kwargs)
+            cache = flatten_dict(model_kwargs["past_key_values"])
+            for k, v in flatten_dict(cross_attention_cache).items():
+                # batch axis comes after the scanned layer axis
+                cache[k] = cache[k].at[..., slot, :, :, :].set(v[..., 0, :, :, :])
+            return {
+                **model_kwargs,
+                "past_key_values": unflatten_dict(cache),
+                "encoder_outputs": (
+                    lax.dynamic_update_slice(
+                        model_kwargs["encoder_outputs"][0],
+                        hidden_states.astype(model_kwargs["encoder_outputs"][0].dtype),
+                        (slot, 0, 0),
+                    ),
+                ),
+                "encoder_attention_mask": lax.dynamic_update_slice(
+                    model_kwargs["encoder_attention_mask"],
+                    mask.astype("i4"),
+                    (slot, 0),
+                ),
+            }
+
+        start_token_id = self.model.config.decoder_start_token_id
+        pad_token_id = self.model.config.pad_token_id
+        return EngineState(
+            cur_len=state.cur_len.at[slot].set(1),
+            sequences=state.sequences.at[slot]
+            .set(pad_token_id)
+            .at[slot, 0]
+            .set(start_token_id),
+            running_token=state.running_token.at[slot].set(start_token_id),
+            active=state.active.at[slot].set(True),
+            prng_key=state.prng_key.at[slot].set(prng_key),
+            sampling_params={
+                k: v.at[slot].set(sampling_params[k])
+                for k, v in state.sampling_params.items()
+            },
+            model_kwargs=reset(
+                state.model_kwargs,
+                encoder_hidden_states,
+                cross_attention_cache,
+                attention_mask,
+            ),
+            model_kwargs_uncond=(
+                reset_position(state.model_kwargs_uncond)
+                if self.super_conditioning
+                else None
+            ),
+        )
+
+    def _set_block_table_fn(self, state, block_table):
+        """Write the page table of every slot to all layers."""
+
+        def update(model_kwargs):
+            cache = flatten_dict(model_kwargs["past_key_values"])
+            for k, v in cache.items():
+                if k[-1] == "block_table":
+                    # scanned layers keep their leading layer axis
+                    cache[k] = jnp.broadcast_to(block_table, v.shape)
+            return {**model_kwargs, "past_key_values": unflatten_dict(cache)}
+
+        return state.replace(
+            model_kwargs=update(state.model_kwargs),
+            model_kwargs_uncond=(
+                update(state.model_kwargs_uncond) if self.super_conditioning else None
+            ),
+        )
+
+    def _decode_fn(self, params, state):
+        """Sample `steps_per_sync` tokens for every active slot."""
+        eos_token_id = self.model.config.eos_token_id
+        pad_token_id = self.model.config.pad_token_id
+        rows = jnp.arange(self.num_slots)
+
+        def update_kwargs(model_outputs, model_kwargs, active):
+            model_kwargs = self.model.update_inputs_for_generation(
+                model_outputs, dict(model_kwargs)
+            )
+            # finished slots stay at a valid position until they get reused
+            model_kwargs["decoder_position_ids"] = jnp.where(
+                active[:, None],
+                model_kwargs["decoder_position_ids"],
+                model_kwargs["decoder_position_ids"] - 1,
+            )
+            return model_kwargs
+
+        def body_fn(_, state):
+            prng_keys = jax.vmap(jax.random.split)(state.prng_key)
+            model_outputs = self.model.decode(
+                state.running_token, params=params, **state.model_kwargs
+            )
+            logits = model_outputs.logits[:, -1]
+
+            # perform super conditioning
+            if self.super_conditioning:
+                model_outputs_uncond = self.model.decode(
+                    state.running_token, params=params, **state.model_kwargs_uncond
+                )
+                logits_uncond = model_outputs_uncond.logits[:, -1]
+                logits = self.model._apply_condition_scale(
+                    logits,
+                    logits_uncond,
+                    state.sampling_params["condition_scale"][:, None],
+                )
+
+            # image tokens never end with eos (min_length == max_length)
+            logits = logits.at[:, eos_token_id].set(-jnp.inf)
+            # apply top_k, top_k, temperature
+            logits_warper = self.model._get_per_row_logits_warper(
+                self.num_slots,
+                top_k=state.sampling_params["top_k"],
+                top_p=state.sampling_params["top_p"],
+                temperature=state.sampling_params["temperature"],
+            )
+            logits = logits_warper(state.sequences, logits, state.cur_len)
+
+            next_token = jax.vmap(jax.random.categorical)(prng_keys[:, 0], logits)
+            next_token = jnp.where(state.active, next_token, pad_token_id)
+
+            next_sequences = jnp.where(
+                state.active[:, None],
+                state.sequences.at[
+                    rows, jnp.minimum(state.cur_len, self.max_length - 1)
+                ].set(next_token),
+                state.sequences,
+            )
+            next_cur_len = state.cur_len + state.active
+            next_active = state.active & (next_cur_len < self.max_length)
+
+            return EngineState(
+                cur_len=next_cur_len,
+                sequences=next_sequences,
+                running_token=next_token[:, None],
+                active=next_active,
+                prng_key=prng_keys[:, 1],
+                sampling_params=state.sampling_params,
+                model_kwargs=update_kwargs(
+                    model_outputs, state.model_kwargs, next_active
+                ),
+                model_kwargs_uncond=(
+                    update_kwargs(
+                        model_outputs_uncond, state.model_kwargs_uncond, next_active
+                    )
+                    if self.super_conditioning
+                    else None
+                ),
+            )
+
+        return lax.fori_loop(0, self.steps_per_sync, body_fn, state)
+
+    def submit(
+        self,
+        input_ids: jnp.ndarray,
+        attention_mask: Optional[jnp.ndarray] = None,
+        prng_key: Optional[jnp.ndarray] = None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        temperature: Optional[float] = None,
+        condition_scale: Optional[float] = None,
+    ) -> int:
+        """
+        Queue a single tokenized prompt and return its request id.
+
+        Sampling params default to the ones of the engine.
+        """
+        input_ids = jnp.atleast_2d(input_ids)
+        assert input_ids.shape[0] == 1, "submit one prompt at a time"
+        sampling_params = {
+            "top_k": top_k,
+            "top_p": top_p,
+            "temperature": temperature,
+            "condition_scale": condition_scale,
+        }
+        sampling_params = {
+            k: _first_not_none(v, self.sampling_params[k])
+            for k, v in sampling_params.items()
+        }
+        assert (
+            sampling_params["condition_scale"] == 1.0 or self.super_conditioning
+        ), "`input_ids_uncond` has to be given to the engine for super conditioning."
+        request_id = next(self._request_ids)
+        self._queue.append(
+            (
+                request_id,
+                input_ids,
+                attention_mask,
+                prng_key if prng_key is not None else jax.random.PRNGKey(request_id),
+                sampling_params,
+            )
+        )
+        return request_id
+
+    def _encode_request(self, input_ids, attention_mask):
+        input_ids = jnp.atleast_2d(input_ids)[:1]
+        attention_mask = (
+            jnp.atleast_2d(attention_mask)[:1]
+            if attention_mask is not None
+            else jnp.ones_like(input_ids)
+        )
+        hidden_states, cross_attention_cache = self._encode(
+            self.params, input_ids, attention_mask
+        )
+        return hidden_states, cross_attention_cache, attention_mask
+
+    def _num_pages_needed(self, length):
+        """Pages of a slot at `length` tokens to decode the next `steps_per_sync` tokens."""
+        cache_length = min(length - 1 + self.steps_per_sync, self.max_length - 1)
+        return math.ceil(cache_length / self.page_size)
+
+    def _num_pages_reserved(self):
+        """Pages that running slots still need for the next decoding step."""
+        return sum(
+            max(
+                0,
+                self._num_pages_needed(self._slot_lengths[slot])
+                - len(self._slot_pages[slot]),
+            )
+            for slot, request_id in enumerate(self._slots)
+            if request_id is not None
+        )
+
+    def _release_slot(self, slot, deactivate=False):
+        if deactivate:
+            self.state = self.state.replace(
+                active=self.state.active.at[slot].set(False)
+            )
+        self._slots[slot] = None
+        self._slot_requests[slot] = None
+        if self.page_size is not None:
+            self._free_pages.extend(self._slot_pages[slot])
+            self._slot_pages[slot] = []
+            self._slot_lengths[slot] = 0
+
+    def _allocate_pages(self):
+        """Give running slots the pages of their next tokens, preempting if needed."""
+        running = [s for s, r in enumerate(self._slots) if r is not None]
+        # oldest requests are served first
+        for slot in sorted(running, key=lambda s: self._slots[s]):
+            needed = self._num_pages_needed(self._slot_lengths[slot]) - len(
+                self._slot_pages[slot]
+            )
+            while self._slots[slot] is not None and needed > len(self._free_pages):
+                # restart the most recent request later
+                victim = max(
+                    (s for s, r in enumerate(self._slots) if r is not None),
+                    key=lambda s: self._slots[s],
+                )
+                request = self._slot_requests[victim]
+                self._release_slot(victim, deactivate=True)
+                self._queue.appendleft(request)
+            if self._slots[slot] is not None and needed > 0:
+                self._slot_pages[slot].extend(self._free_pages[:needed])
+                del self._free_pages[:needed]
+
+        block_table = np.zeros((self.num_slots, self.pages_per_slot), dtype=np.int32)
+        for slot, pages in enumerate(self._slot_pages):
+            block_table[slot, : len(pages)] = pages
+        if not np.array_equal(block_table, self._block_table):
+            self.state = self._set_block_table(self.state, block_table)
+            self._block_table = block_table
+
+    def _fill_free_slots(self):
+        reserved = self._num_pages_reserved() if self.page_size is not None else 0
+        for slot, request_id in enumerate(self._slots):
+            if request_id is not None or not self._queue:
+                continue
+            if self.page_size is not None:
+                # admit a request only if its first tokens fit in the pool
+                needed = self._num_pages_needed(1)
+                if needed > len(self._free_pages) - reserved:
+                    break
+                reserved += needed
+            request = self._queue.popleft()
+            (
+                request_id,
+                input_ids,
+                attention_mask,
+                prng_key,
+                sampling_params,
+            ) = request
+            (
+                hidden_states,
+                cross_attention_cache,
+                attention_mask,
+            ) = self._encode_request(input_ids, attention_mask)
+            self.state = self._insert(
+                self.state,
+                slot,
+                prng_key,
+                sampling_params,
+                hidden_states,
+                cross_attention_cache,
+                attention_mask,
+            )
+            self._slots[slot] = request_id
+            self._slot_requests[slot] = request
+            if self.page_size is not None:
+                self._slot_lengths[slot] = 1
+
+    def cancel(self, request_id: int) -> bool:
+        """
+        Drop a queued or running request, e.g. when its client disconnects.
+
+        A running request stops at the next token boundary and its slot is handed to
+        queued work. Returns whether the request was found.
+        """
+        for i, request in enumerate(self._queue):
+            if request[0] == request_id:
+                del self._queue[i]
+                return True
+        for slot, slot_request_id in enumerate(self._slots):
+            if slot_request_id == request_id:
+                self._release_slot(slot, deactivate=True)
+                return True
+        return False
+
+    @property
+    def num_pending(self) -> int:
+        """Number of queued or running requests."""
+        return len(self._queue) + sum(r is not None for r in self._slots)
+
+    def step(self) -> List[Tuple[int, np.ndarray]]:
+        """
+        Fill free slots, decode `steps_per_sync` tokens and release finished slots.
+
+        Returns a list of (request_id, sequence) for requests that completed.
+        """
+        self._fill_free_slots()
+        if self.page_size is not None:
+            self._allocate_pages()
+        if all(request_id is None for request_id in self._slots):
+            return []
+        self.state = self._decode(self.params, self.state)
+        active = np.asarray(self.state.active)
+        finished = []
+        for slot, request_id in enumerate(self._slots):
+            if request_id is None:
+                continue
+            if self.page_size is not None:
+                self._slot_lengths[slot] = min(
+                    self._slot_lengths[slot] + self.steps_per_sync, self.max_length
+                )
+            if not active[slot]:
+                finished.append((request_id, np.asarray(self.state.sequences[slot])))
+                self._release_slot(slot)
+        return finished
+
+    def run(self) -> Dict[int, np.ndarray]:
+        """Step until every submitted request is complete."""
+        results = {}
+        while self.num_pending:
+            results.update(self.step())
+        return results
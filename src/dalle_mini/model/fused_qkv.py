@@ -0,0 +1,98 @@
+""" Fused query, key and value projection of DalleBart self-attention """
+
+import jax
+import jax.numpy as jnp
+from flax.core.frozen_dict import freeze, unfreeze
+from flax.traverse_util import flatten_dict, unflatten_dict
+
+_qkv_names = ("q_proj", "k_proj", "v_proj")
+
+
+def pack_qkv(query, key, value, num_heads: int):
+    """
+    Packs arrays of shape (..., embed_dim) (kernels, biases or quantization scales of
+    the projections) into an array of shape (..., 3 * embed_dim).
+
+    Outputs are laid out as (num_heads, 3, head_dim) so that splitting the last axis
+    along "mp" keeps the query, key and value of each head on the same device.
+    """
+    *batch_dims, embed_dim = query.shape
+    packed = jnp.stack(
+        [
+            x.reshape(*batch_dims, num_heads, embed_dim // num_heads)
+            for x in (query, key, value)
+        ],
+        axis=-2,
+    )
+    return packed.reshape(*batch_dims, 3 * embed_dim)
+
+
+def unpack_qkv(packed, num_heads: int):
+    """Query, key and value arrays of shape (..., embed_dim) from `pack_qkv` output."""
+    *batch_dims, features = packed.shape
+    packed = packed.reshape(*batch_dims, num_heads, 3, features // (3 * num_heads))
+    return tuple(
+        packed[..., i, :].reshape(*batch_dims, features // 3) for i in range(3)
+    )
+
+
+def fused_qkv_init(num_heads: int, query_init, key_init, value_init):
+    """Initializer of a fused kernel from the initializers of each projection."""
+
+    def _init(key, shape, dtype=jnp.float32):
+        *batch_dims, in_features, features = shape
+        shape = (*batch_dims, in_features, features // 3)
+        keys = jax.random.split(key, 3)
+        return pack_qkv(
+            query_init(keys[0], shape, dtype),
+            key_init(keys[1], shape, dtype),
+            value_init(keys[2], shape, dtype),
+            num_heads,
+        )
+
+    return _init
+
+
+def _is_self_attention(path) -> bool:
+    # decoder layers hold self-attention then cross-attention
+    return "encoder" in path or path[-3] == "FlaxBartAttention_0"
+
+
+def _num_heads(path, config) -> int:
+    if "encoder" in path:
+        return config.encoder_attention_heads
+    return config.decoder_attention_heads
+
+
+def fuse_qkv_params(params, config):
+    """
+    Packs `q_proj`, `k_proj` and `v_proj` params of self-attention layers into
+    `qkv_proj` params (float or quantized).
+
+    The result is loaded by a model whose config has `fuse_qkv=True` (see
+    `DalleBart.fuse_qkv`).
+    """
+    params = flatten_dict(unfreeze(params))
+    fused = {}
+    for path, value in params.items():
+        if path[-2] not in _qkv_names or not _is_self_attention(path):
+            fused[path] = value
+        elif path[-2] == "q_proj":
+            fused[path[:-2] + ("qkv_proj", path[-1])] = pack_qkv(
+                *(params[path[:-2] + (name, path[-1])] for name in _qkv_names),
+                _num_heads(path, config),
+            )
+    return freeze(unflatten_dict(fused))
+
+
+def unfuse_qkv_params(params, config):
+    """Inverse of `fuse_qkv_params`, for a model whose config has `fuse_qkv=False`."""
+    params = flatten_dict(unfreeze(params))
+    unfused = {}
+    for path, value in params.items():
+        if path[-2] != "qkv_proj":
+            unfused[path] = value
+            continue
+        for name, x in zip(_qkv_names, unpack_qkv(value, _num_heads(path, config))):
+            unfused[path[:-2] + (name, path[-1])] = x
+    return freeze(unflatten_dict(unfused))
@@ -15,20 +15,22 @@
 """ DalleBart model. """
 
 import math
+import time
 from functools import partial
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import flax
 import flax.linen as nn
 import jax
 import jax.numpy as jnp
+import numpy as np
 from einops import rearrange
 from flax.core.frozen_dict import unfreeze
-from flax.linen import combine_masks, make_causal_mask
 from flax.linen import partitioning as nn_partitioning
 from flax.linen.linear import PrecisionLike
 from flax.traverse_util import flatten_dict, unflatten_dict
 from jax import custom_jvp, lax
+from jax.ad_checkpoint import checkpoint_name
 from jax.random import PRNGKey
 from transformers.modeling_flax_outputs import (
     FlaxBaseModelOutput,
@@ -46,6 +48,10 @@ from transformers.models.bart.modeling_flax_bart import (
 from transformers.utils import ModelOutput, logging
 
 from .configuration import DalleBartConfig
+from .encoder_cache import EncoderCache
+from .fused_qkv import fuse_qkv_params, fused_qkv_init, unfuse_qkv_params
+from .partitions import with_kv_cache_sharding
+from .quantization import quantize_int8, quantize_params, unpack_int4
 from .utils import PretrainedFromWandbMixin
 
 logger = logging.get_logger(__name__)
@@ -53,6 +59,24 @@ logger = logging.get_logger(__name__)
 remat = nn_partitioning.remat
 
 
+def remat_policy(name: Optional[str]):
+    """
+    Checkpoint policy of rematerialized layers (see `DalleBartConfig.remat_policy`):
+    - None: only layer inputs are saved, everything else is recomputed
+    - "save_attention": attention outputs (named "attention_output") are saved so that
+      only attention internals and feed-forward blocks are recomputed
+    - "save_dots": outputs of dense layers (matmuls without batch dimensions) are saved
+    """
+    if name is None:
+        return None
+    policies = jax.checkpoint_policies
+    if name == "save_attention":
+        return policies.save_only_these_names("attention_output")
+    if name == "save_dots":
+        return policies.dots_with_no_batch_dims_saveable
+    raise ValueError(f"Unknown remat_policy {name}")
+
+
 def smelu(beta: Any = 1.0):
     """
     Implementation of "Real World Large Scale Recommendation Systems Reproducibility and Smooth Activations"
@@ -195,6 +219,34 @@ def norm(type, *args, **kwargs):
         raise ValueError(f"Unknown norm type {type}")
 
 
+def sinkhorn_normalization(attn_weights, mask=None, iters: int = 1):
+    """
+    Normalizes attention logits of shape (..., q_length, kv_length) alternately over
+    keys and queries, in log space, for `iters` iterations.
+
+    Pairs of normalizations run in a `lax.fori_loop` and are recomputed in the backward
+    pass, so that the traced graph and the saved activations do not grow with `iters`.
+
+    Adapted from https://github.com/lucidrains/sinkhorn-transformer
+    """
+
+    def normalize(x, axis):
+        x = x - jax.nn.logsumexp(x, axis=axis, keepdims=True)
+        if mask is not None:
+            # fully masked rows or columns would otherwise become nan
+            x = jnp.where(mask, x, -jnp.inf)
+        return x
+
+    @jax.checkpoint
+    def body_fn(i, x):
+        return normalize(normalize(x, -1), -2)
+
+    attn_weights = lax.fori_loop(0, iters // 2, body_fn, attn_weights)
+    if iters % 2:
+        attn_weights = normalize(attn_weights, -1)
+    return attn_weights
+
+
 def dot_product_attention_weights(
     query: Any,
     key: Any,
@@ -245,15 +297,7 @@ def dot_product_attention_weights(
         # sinkhorn does not work for causal (leaks info of future tokens into past)
         attn_weights = jax.nn.softmax(attn_weights).astype(dtype)
     else:
-        # adapted from https://github.com/lucidrains/sinkhorn-transformer
-        for i in range(sinkhorn_iters):
-            # when causal, some attn_weights have been set to -inf through bias
-            if i % 2 == 0:
-                attn_weights -= jax.nn.logsumexp(attn_weights, axis=-1, keepdims=True)
-            else:
-                attn_weights -= jax.nn.logsumexp(attn_weights, axis=-2, keepdims=True)
-            if mask is not None:
-                attn_weights = jnp.where(mask, attn_weights, -jnp.inf)
+        attn_weights = sinkhorn_normalization(attn_weights, mask, sinkhorn_iters)
         attn_weights = jnp.exp(attn_weights).astype(dtype)
 
     # apply attention dropout
@@ -273,11 +317,221 @@ def dot_product_attention_weights(
     return attn_weights
 
 
+def blockwise_dot_product_attention(
+    query: Any,
+    key: Any,
+    value: Any,
+    mask: Optional[Any] = None,
+    embed_pos: Optional[Any] = None,
+    block_size: int = 64,
+    dtype: Any = jnp.float32,
+    precision: PrecisionLike = None,
+    tau=None,
+    bias: Optional[Any] = None,
+    broadcast_dropout: bool = True,
+    dropout_rng: Optional[PRNGKey] = None,
+    dropout_rate: float = 0.0,
+    deterministic: bool = False,
+):
+    """
+    Computes attention outputs over blocks of `block_size` keys with an online softmax,
+    so that the (batch..., num_heads, q_length, kv_length) weights are never materialized.
+    Blocks are recomputed in the backward pass.
+
+    Same as `dot_product_attention_weights` (without sinkhorn normalization) followed by
+    the weighted sum of values. Dropout masks are drawn per block, from `dropout_rng`
+    folded with the block index.
+    """
+    assert query.ndim == key.ndim, "q, k must have same rank."
+    assert query.shape[:-3] == key.shape[:-3], "q, k batch dims must match."
+    assert query.shape[-2] == key.shape[-2], "q, k num_heads must match."
+    assert query.shape[-1] == key.shape[-1], "q, k depths must match."
+
+    *batch_dims, kv_length, num_heads, depth = key.shape
+    num_blocks = -(-kv_length // block_size)
+    padding = num_blocks * block_size - kv_length
+    if mask is None:
+        mask = jnp.ones((kv_length,), dtype=jnp.bool_)
+    mask = mask.astype(jnp.bool_)
+
+    def blocks(x, axis, pad_value=0):
+        # split the key axis into blocks, stacked along a leading axis
+        axis = axis % x.ndim
+        pad_width = [(0, 0)] * x.ndim
+        pad_width[axis] = (0, padding)
+        x = jnp.pad(x, pad_width, constant_values=pad_value)
+        x = x.reshape(x.shape[:axis] + (num_blocks, block_size) + x.shape[axis + 1 :])
+        return jnp.moveaxis(x, axis, 0)
+
+    xs = (
+        jnp.arange(num_blocks),
+        blocks(key, -3),
+        blocks(value, -3),
+        blocks(mask, -1, False),
+        blocks(embed_pos, -1) if embed_pos is not None else None,
+        blocks(bias, -1, -jnp.inf) if bias is not None else None,
+    )
+
+    # divide by tau (used in Swin v2)
+    if tau is not None:
+        scale = 1.0 / tau
+    else:
+        scale = 1.0 / jnp.sqrt(depth).astype(dtype)
+
+    @jax.checkpoint
+    def body_fn(carry, xs):
+        max_score, normalizer, output = carry
+        index, key_block, value_block, mask_block, embed_pos_block, bias_block = xs
+        scores = jnp.einsum(
+            "...qhd,...khd->...hqk", query, key_block, precision=precision
+        )
+        scores = (scores * scale).astype(jnp.float32)
+        if embed_pos_block is not None:
+            scores = scores + embed_pos_block
+        if bias_block is not None:
+            scores = scores + bias_block
+        scores = jnp.where(mask_block, scores, -jnp.inf)
+        new_max_score = jnp.maximum(max_score, scores.max(axis=-1))
+        # rows without any valid key so far
+        safe_max_score = jnp.where(jnp.isneginf(new_max_score), 0.0, new_max_score)
+        weights = jnp.exp(scores - safe_max_score[..., None])
+        correction = jnp.exp(max_score - safe_max_score)
+        normalizer = normalizer * correction + weights.sum(axis=-1)
+        # apply attention dropout, the normalizer is computed before dropout
+        if not deterministic and dropout_rate > 0.0:
+            keep_prob = 1.0 - dropout_rate
+            if broadcast_dropout:
+                # dropout is broadcast across the batch + head dimensions
+                dropout_shape = tuple([1] * (key.ndim - 2)) + weights.shape[-2:]
+            else:
+                dropout_shape = weights.shape
+            keep = jax.random.bernoulli(
+                jax.random.fold_in(dropout_rng, index), keep_prob, dropout_shape
+            )
+            weights = weights * keep / keep_prob
+        output = output * jnp.swapaxes(correction, -1, -2)[..., None] + jnp.einsum(
+            "...hqk,...khd->...qhd",
+            weights,
+            value_block.astype(jnp.float32),
+            precision=precision,
+        )
+        return (new_max_score, normalizer, output), None
+
+    q_length = query.shape[-3]
+    stats_shape = tuple(batch_dims) + (num_heads, q_length)
+    init = (
+        jnp.full(stats_shape, -jnp.inf, dtype=jnp.float32),
+        jnp.zeros(stats_shape, dtype=jnp.float32),
+        jnp.zeros(
+            tuple(batch_dims) + (q_length, num_heads, value.shape[-1]),
+            dtype=jnp.float32,
+        ),
+    )
+    (_, normalizer, output), _ = lax.scan(body_fn, init, xs)
+    normalizer = jnp.swapaxes(normalizer, -1, -2)[..., None]
+    output = jnp.where(normalizer > 0, output / normalizer, 0.0)
+    return output.astype(dtype)
+
+
+def make_attention_bias(
+    attention_mask: Optional[jnp.ndarray] = None,
+    causal: bool = False,
+    query_length: Optional[int] = None,
+    cache_index: Optional[jnp.ndarray] = None,
+    kv_length: Optional[int] = None,
+    dtype: Any = jnp.float32,
+):
+    """
+    Attention bias (0 for attended keys, -inf otherwise) of shape
+    (batch or 1, 1, query_length or 1, kv_length), computed once per forward pass and
+    shared by all layers.
+
+    - `attention_mask` of shape (batch, kv_length) masks padded keys
+    - `causal` masks future positions of `query_length` queries. During cached decoding,
+      queries start at `cache_index` (scalar or per row) and attend to the `kv_length`
+      positions of the cache, so that positions not cached yet are masked out.
+    """
+    mask = None
+    if causal:
+        if cache_index is None:
+            query_positions = jnp.arange(query_length)
+            kv_length = query_length
+        else:
+            query_positions = cache_index[..., None] + jnp.arange(query_length)
+        mask = jnp.arange(kv_length) <= query_positions[..., None]
+        mask = mask.reshape((-1, 1, query_length, kv_length))
+    if attention_mask is not None:
+        padding_mask = (attention_mask > 0)[:, None, None, :]
+        mask = padding_mask if mask is None else mask & padding_mask
+    if mask is None:
+        return None
+    return jnp.where(mask, jnp.array(0.0, dtype), jnp.array(-jnp.inf, dtype))
+
+
+class Dense(nn.Dense):
+    """
+    Edits:
+    - optional weight-only quantization of the kernel ("int8" or "int4" group-wise, see
+      `quantization.py`), dequantized on the fly
+    """
+
+    quantization: Optional[str] = None
+    group_size: int = 128
+
+    @nn.compact
+    def __call__(self, inputs: jnp.ndarray) -> jnp.ndarray:
+        if self.quantization is None:
+            return super().__call__(inputs)
+
+        dtype = self.dtype if self.dtype is not None else inputs.dtype
+        in_features = inputs.shape[-1]
+        inputs = inputs.astype(dtype)
+        if self.quantization == "int8":
+            kernel = self.param(
+                "kernel", nn.initializers.zeros, (in_features, self.features), jnp.int8
+            )
+            scale = self.param(
+                "kernel_scale", nn.initializers.ones, (self.features,), self.param_dtype
+            )
+            # per output channel scale is applied after the matmul
+            y = jnp.dot(inputs, kernel.astype(dtype), precision=self.precision)
+            y = y * scale.astype(dtype)
+        else:
+            group_size = min(self.group_size, in_features)
+            num_groups = in_features // group_size
+            kernel = self.param(
+                "kernel",
+                nn.initializers.zeros,
+                (in_features // 2, self.features),
+                jnp.int8,
+            )
+            scale = self.param(
+                "kernel_scale",
+                nn.initializers.ones,
+                (num_groups, self.features),
+                self.param_dtype,
+            )
+            kernel = unpack_int4(kernel).astype(dtype)
+            kernel = kernel.reshape(num_groups, group_size, self.features)
+            inputs = inputs.reshape(*inputs.shape[:-1], num_groups, group_size)
+            # per group scales are applied before summing the groups
+            y = jnp.einsum("...gi,gio->...go", inputs, kernel, precision=self.precision)
+            y = (y * scale.astype(dtype)).sum(axis=-2)
+        if self.use_bias:
+            bias = self.param(
+                "bias", self.bias_init, (self.features,), self.param_dtype
+            )
+            y = y + bias.astype(dtype)
+        return y
+
+
 class FlaxBartAttention(FlaxBartAttention):
     """
     Edits:
     - causal mask is used only in decoder and considers image_length
     - scale attention heads per NormFormer paper
+    - optional blockwise attention (`attention_block_size`)
+    - optional fused query, key and value projection in self-attention (`fuse_qkv`)
     """
 
     is_encoder: bool = False
@@ -294,10 +548,12 @@ class FlaxBartAttention(FlaxBartAttention):
             )
 
         dense = partial(
-            nn.Dense,
+            Dense,
             self.embed_dim,
             use_bias=self.bias,
             dtype=self.dtype,
+            quantization=self.config.quantization,
+            group_size=self.config.quantization_group_size,
         )
 
         if self.config.use_deepnet_scaling:
@@ -307,20 +563,29 @@ class FlaxBartAttention(FlaxBartAttention):
         elif self.config.use_subln_init and not self.is_cross_attention:
             gain = subln_gain["encoder" if self.is_encoder else "decoder"](self.config)
 
-        self.q_proj = dense(
-            kernel_init=jax.nn.initializers.normal(self.config.init_std)
-        )
-        self.k_proj = dense(
-            kernel_init=jax.nn.initializers.normal(self.config.init_std)
-        )
-        self.v_proj = dense(
-            kernel_init=deepnet_init(self.config.init_std, gain)
+        qk_init = jax.nn.initializers.normal(self.config.init_std)
+        v_init = (
+            deepnet_init(self.config.init_std, gain)
             if (
                 self.config.use_deepnet_scaling
                 or (self.config.use_subln_init and not self.is_cross_attention)
             )
             else jax.nn.initializers.normal(self.config.init_std)
         )
+        if self.config.fuse_qkv and not self.is_cross_attention:
+            # a single matmul, see `fused_qkv.py` for the layout of the kernel
+            self.qkv_proj = Dense(
+                3 * self.embed_dim,
+                use_bias=self.bias,
+                dtype=self.dtype,
+                quantization=self.config.quantization,
+                group_size=self.config.quantization_group_size,
+                kernel_init=fused_qkv_init(self.num_heads, qk_init, qk_init, v_init),
+            )
+        else:
+            self.q_proj = dense(kernel_init=qk_init)
+            self.k_proj = dense(kernel_init=qk_init)
+            self.v_proj = dense(kernel_init=v_init)
         self.out_proj = dense(
             kernel_init=deepnet_init(self.config.init_std, gain)
             if (
@@ -347,12 +612,6 @@ class FlaxBartAttention(FlaxBartAttention):
                 embedding_init=jax.nn.initializers.normal(self.config.init_std),
             )
 
-        if self.causal:
-            # used only in decoder
-            self.causal_mask = make_causal_mask(
-                jnp.ones((1, self.config.image_length), dtype="bool"), dtype="bool"
-            )
-
         if self.config.ln_positions in ["subln"] and not self.is_cross_attention:
             self.mid_layernorm = norm(
                 self.config.ln_type, dtype=self.dtype, epsilon=1e-05
@@ -362,78 +621,68 @@ class FlaxBartAttention(FlaxBartAttention):
         self,
         hidden_states: jnp.ndarray,
         key_value_states: Optional[jnp.ndarray] = None,
-        attention_mask: Optional[jnp.ndarray] = None,
+        attention_bias: Optional[jnp.ndarray] = None,
         init_cache: bool = False,
         deterministic: bool = True,
     ) -> Tuple[jnp.ndarray]:
-        """Input shape: Batch x Time x Channel"""
+        """
+        Input shape: Batch x Time x Channel
+
+        `attention_bias` (0 for attended keys, -inf otherwise) includes the causal mask and
+        is computed once for all layers, see `make_attention_bias`.
+        """
 
         # if key_value_states are provided this layer is used as a cross-attention layer
         # for the decoder
         is_cross_attention = key_value_states is not None
         batch_size = hidden_states.shape[0]
 
-        # get query proj
-        query_states = self.q_proj(hidden_states)
+        if self.config.fuse_qkv and not is_cross_attention:
+            # self_attention with a fused projection of shape (heads, 3, head_dim)
+            qkv_states = self.qkv_proj(hidden_states).reshape(
+                hidden_states.shape[:2] + (self.num_heads, 3, self.head_dim)
+            )
+            query_states = qkv_states[..., 0, :]
+            key_states = qkv_states[..., 1, :]
+            value_states = qkv_states[..., 2, :]
+        else:
+            # get query proj
+            query_states = self._split_heads(self.q_proj(hidden_states))
         # get key, value proj
         if is_cross_attention:
             # cross_attentions
-            key_states = self.k_proj(key_value_states)
-            value_states = self.v_proj(key_value_states)
-        else:
-            # self_attention
-            key_states = self.k_proj(hidden_states)
-            value_states = self.v_proj(hidden_states)
-
-        query_states = self._split_heads(query_states)
-        key_states = self._split_heads(key_states)
-        value_states = self._split_heads(value_states)
-
-        # handle cache prepare causal attention mask
-        if self.causal:
-            query_length, key_length = query_states.shape[1], key_states.shape[1]
-            if self.has_variable("cache", "cached_key"):
-                mask_shift = self.variables["cache"]["cache_index"]
-                max_decoder_length = self.variables["cache"]["cached_key"].shape[1]
-                causal_mask = lax.dynamic_slice(
-                    self.causal_mask,
-                    (0, 0, mask_shift, 0),
-                    (1, 1, query_length, max_decoder_length),
-                )
+            if self.has_variable("cache", "cached_cross_key"):
+                # projected once per prompt, see `DalleBart.init_cross_attention_cache`
+                key_states = self.variables["cache"]["cached_cross_key"]
+                value_states = self.variables["cache"]["cached_cross_value"]
             else:
-                causal_mask = self.causal_mask[:, :, :query_length, :key_length]
-            causal_mask = jnp.broadcast_to(
-                causal_mask, (batch_size,) + causal_mask.shape[1:]
+                key_states = self._split_heads(self.k_proj(key_value_states))
+                value_states = self._split_heads(self.v_proj(key_value_states))
+                if init_cache and not self.is_initializing():
+                    self.put_variable("cache", "cached_cross_key", key_states)
+                    self.put_variable("cache", "cached_cross_value", value_states)
+            # a single prompt (such as the unconditional one) can be shared by all rows
+            key_states = jnp.broadcast_to(
+                key_states, (batch_size,) + key_states.shape[1:]
             )
-
-        # combine masks if needed
-        if attention_mask is not None and self.causal:
-            attention_mask = jnp.broadcast_to(
-                jnp.expand_dims(attention_mask, axis=(-3, -2)), causal_mask.shape
+            value_states = jnp.broadcast_to(
+                value_states, (batch_size,) + value_states.shape[1:]
             )
-            attention_mask = combine_masks(attention_mask, causal_mask)
-        elif self.causal:
-            attention_mask = causal_mask
-        elif attention_mask is not None:
-            attention_mask = jnp.expand_dims(attention_mask, axis=(-3, -2))
+        elif not self.config.fuse_qkv:
+            # self_attention
+            key_states = self._split_heads(self.k_proj(hidden_states))
+            value_states = self._split_heads(self.v_proj(hidden_states))
 
         # During fast autoregressive decoding, we feed one position at a time,
         # and cache the keys and values step by step.
-        if self.causal and (self.has_variable("cache", "cached_key") or init_cache):
-            key_states, value_states, attention_mask = self._concatenate_to_cache(
-                key_states, value_states, query_states, attention_mask
-            )
-
-        # Convert the boolean attention mask to an attention bias.
-        if attention_mask is not None:
-            # attention mask in the form of attention bias
-            attention_bias = lax.select(
-                attention_mask > 0,
-                jnp.full(attention_mask.shape, 0.0).astype(self.dtype),
-                jnp.full(attention_mask.shape, -jnp.inf).astype(self.dtype),
+        if self.causal and (
+            self.has_variable("cache", "cached_key")
+            or self.has_variable("cache", "paged_key")
+            or init_cache
+        ):
+            key_states, value_states = self._concatenate_to_cache(
+                key_states, value_states, query_states
             )
-        else:
-            attention_bias = None
 
         dropout_rng = None
         if not deterministic and self.dropout > 0.0:
@@ -450,31 +699,64 @@ class FlaxBartAttention(FlaxBartAttention):
 
         # relative position embeddings
         if self.config.use_swin_position_embeddings:
-            position_ids = jnp.arange(self.q_length)
-            embed_pos = self.rel_bias(position_ids)
+            # the module applies the embedding dtype, unlike reading the table directly
+            embed_pos = self.rel_bias(jnp.arange(self.q_length))
             embed_pos = rearrange(embed_pos, "q (k h) -> 1 h q k", h=self.num_heads)
         else:
             embed_pos = None
 
         tau = self.tau if self.config.use_cosine_attention else None
-        attn_weights = dot_product_attention_weights(
-            query_states,
-            key_states,
-            bias=attention_bias,
-            mask=attention_mask,
-            embed_pos=embed_pos,
-            dropout_rng=dropout_rng,
-            dropout_rate=self.dropout,
-            broadcast_dropout=True,
-            deterministic=deterministic,
-            dtype=self.dtype,
-            precision=None,
-            sinkhorn_iters=self.config.sinkhorn_iters,
-            is_encoder=self.is_encoder,
-            tau=tau,
+        # sinkhorn normalization needs the full attention weights
+        use_blockwise_attention = self.config.attention_block_size is not None and not (
+            self.is_encoder and self.config.sinkhorn_iters > 1
         )
-
-        attn_output = jnp.einsum("...hqk,...khd->...qhd", attn_weights, value_states)
+        if use_blockwise_attention:
+            # attention weights are not materialized
+            attn_weights = None
+            attn_output = blockwise_dot_product_attention(
+                query_states,
+                key_states,
+                value_states,
+                bias=attention_bias,
+                embed_pos=(
+                    embed_pos[..., : query_states.shape[1], : key_states.shape[1]]
+                    if embed_pos is not None
+                    else None
+                ),
+                block_size=self.config.attention_block_size,
+                dtype=self.dtype,
+                precision=None,
+                tau=tau,
+                dropout_rng=dropout_rng,
+                dropout_rate=self.dropout,
+                broadcast_dropout=True,
+                deterministic=deterministic,
+            )
+        else:
+            attn_weights = dot_product_attention_weights(
+                query_states,
+                key_states,
+                bias=attention_bias,
+                # sinkhorn normalization masks its intermediate weights
+                mask=(
+                    jnp.isfinite(attention_bias)
+                    if attention_bias is not None and self.config.sinkhorn_iters > 1
+                    else None
+                ),
+                embed_pos=embed_pos,
+                dropout_rng=dropout_rng,
+                dropout_rate=self.dropout,
+                broadcast_dropout=True,
+                deterministic=deterministic,
+                dtype=self.dtype,
+                precision=None,
+                sinkhorn_iters=self.config.sinkhorn_iters,
+                is_encoder=self.is_encoder,
+                tau=tau,
+            )
+            attn_output = jnp.einsum(
+                "...hqk,...khd->...qhd", attn_weights, value_states
+            )
         if self.config.use_head_scale:
             # per Normformer
             attn_output = attn_output * self.head_scale
@@ -484,9 +766,109 @@ class FlaxBartAttention(FlaxBartAttention):
             attn_output = self.mid_layernorm(attn_output)
 
         attn_output = self.out_proj(attn_output)
+        # can be saved by gradient checkpointing, see `remat_policy`
+        attn_output = checkpoint_name(attn_output, "attention_output")
 
         return attn_output, attn_weights
 
+    @nn.compact
+    def _concatenate_to_cache(self, key, value, query):
+        """
+        Edits:
+        - no attention mask, the causal mask of the decoder attention bias already
+          excludes positions that are not cached yet (see `make_attention_bias`)
+        - support a per-row `cache_index` of shape (batch,) so that each row of the batch
+          can be at a different decoding position (continuous batching)
+        - optional int8 cache (`kv_cache_quantization`) with a scale per position and head
+        - optional paged cache (see `DalleBart.init_cache`)
+        """
+        if self.has_variable("cache", "paged_key"):
+            # keys and values live in pages of a shared pool, mapped by a per-row block table
+            paged_key = self.variable("cache", "paged_key")
+            paged_value = self.variable("cache", "paged_value")
+            block_table = self.variable("cache", "block_table").value
+            cache_index = self.variable("cache", "cache_index")
+            batch_size, num_updated_cache_vectors = query.shape[:2]
+            page_size = paged_key.value.shape[1]
+            max_length = block_table.shape[-1] * page_size
+            cur_index = cache_index.value
+            positions = cur_index[:, None] + jnp.arange(num_updated_cache_vectors)
+            # finished rows keep advancing, stay within their last page
+            positions = jnp.minimum(positions, max_length - 1)
+            pages = jnp.take_along_axis(block_table, positions // page_size, axis=1)
+            offsets = positions % page_size
+            paged_key.value = paged_key.value.at[pages, offsets].set(key)
+            paged_value.value = paged_value.value.at[pages, offsets].set(value)
+            cache_index.value = cur_index + num_updated_cache_vectors
+            # gather the pages of each row
+            key = paged_key.value[block_table].reshape(
+                (batch_size, max_length) + key.shape[2:]
+            )
+            value = paged_value.value[block_table].reshape(
+                (batch_size, max_length) + value.shape[2:]
+            )
+            return key, value
+
+        quantized = self.config.kv_cache_quantization == "int8"
+        cache_dtype = jnp.int8 if quantized else key.dtype
+        # detect if we're initializing by absence of existing cache data.
+        is_initialized = self.has_variable("cache", "cached_key")
+        cached_key = self.variable(
+            "cache", "cached_key", jnp.zeros, key.shape, cache_dtype
+        )
+        cached_value = self.variable(
+            "cache", "cached_value", jnp.zeros, value.shape, cache_dtype
+        )
+        if quantized:
+            scale_shape = key.shape[:-1] + (1,)
+            cached_key_scale = self.variable(
+                "cache", "cached_key_scale", jnp.zeros, scale_shape, key.dtype
+            )
+            cached_value_scale = self.variable(
+                "cache", "cached_value_scale", jnp.zeros, scale_shape, value.dtype
+            )
+        cache_index = self.variable(
+            "cache", "cache_index", lambda: jnp.array(0, dtype=jnp.int32)
+        )
+
+        if is_initialized:
+            *batch_dims, max_length, num_heads, depth_per_head = cached_key.value.shape
+            num_updated_cache_vectors = query.shape[1]
+            cur_index = cache_index.value
+            if cur_index.ndim == 0:
+                # update key, value caches with our new 1d spatial slices
+                indices = (0,) * len(batch_dims) + (cur_index, 0, 0)
+                update = partial(lax.dynamic_update_slice, start_indices=indices)
+            else:
+                # each row writes at its own position
+                update_row = jax.vmap(
+                    lambda cache, x, i: lax.dynamic_update_slice(cache, x, (i, 0, 0))
+                )
+                update = lambda cache, x: update_row(cache, x, cur_index)
+            if quantized:
+                key_q, key_scale = quantize_int8(key)
+                value_q, value_scale = quantize_int8(value)
+                cached_key.value = with_kv_cache_sharding(
+                    update(cached_key.value, key_q)
+                )
+                cached_value.value = with_kv_cache_sharding(
+                    update(cached_value.value, value_q)
+                )
+                cached_key_scale.value = update(cached_key_scale.value, key_scale)
+                cached_value_scale.value = update(cached_value_scale.value, value_scale)
+                key = cached_key.value.astype(key.dtype) * cached_key_scale.value
+                value = (
+                    cached_value.value.astype(value.dtype) * cached_value_scale.value
+                )
+            else:
+                # heads are sharded along "mp" like the k_proj and v_proj kernels
+                key = with_kv_cache_sharding(update(cached_key.value, key))
+                value = with_kv_cache_sharding(update(cached_value.value, value))
+                cached_key.value = key
+                cached_value.value = value
+            cache_index.value = cur_index + num_updated_cache_vectors
+        return key, value
+
 
 class GLU(nn.Module):
     """From "GLU Variants Improve Transformer" by https://arxiv.org/abs/2002.05202"""
@@ -513,19 +895,23 @@ class GLU(nn.Module):
                 epsilon=1e-05,
                 use_scale=self.config.force_ln_scale,
             )(x)
-        w = nn.Dense(
+        w = Dense(
             self.ffn_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
+            quantization=self.config.quantization,
+            group_size=self.config.quantization_group_size,
             kernel_init=deepnet_init(self.config.init_std, gain)
             if (self.config.use_deepnet_scaling or self.config.use_subln_init)
             else jax.nn.initializers.normal(self.config.init_std),
         )(x)
         w = ACT2FN[self.config.activation_function](w)
-        v = nn.Dense(
+        v = Dense(
             self.ffn_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
+            quantization=self.config.quantization,
+            group_size=self.config.quantization_group_size,
             kernel_init=deepnet_init(self.config.init_std, gain)
             if (self.config.use_deepnet_scaling or self.config.use_subln_init)
             else jax.nn.initializers.normal(self.config.init_std),
@@ -542,10 +928,12 @@ class GLU(nn.Module):
             x, deterministic=deterministic
         )
 
-        x = nn.Dense(
+        x = Dense(
             self.embed_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
+            quantization=self.config.quantization,
+            group_size=self.config.quantization_group_size,
             kernel_init=deepnet_init(self.config.init_std, gain)
             if (self.config.use_deepnet_scaling or self.config.use_subln_init)
             else jax.nn.initializers.normal(self.config.init_std),
@@ -580,10 +968,12 @@ class FFN(nn.Module):
                 epsilon=1e-05,
                 use_scale=self.config.force_ln_scale,
             )(x)
-        x = nn.Dense(
+        x = Dense(
             self.ffn_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
+            quantization=self.config.quantization,
+            group_size=self.config.quantization_group_size,
             kernel_init=deepnet_init(self.config.init_std, gain)
             if (self.config.use_deepnet_scaling or self.config.use_subln_init)
             else jax.nn.initializers.normal(self.config.init_std),
@@ -599,10 +989,12 @@ class FFN(nn.Module):
         x = nn.Dropout(rate=self.config.activation_dropout)(
             x, deterministic=deterministic
         )
-        x = nn.Dense(
+        x = Dense(
             self.embed_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
+            quantization=self.config.quantization,
+            group_size=self.config.quantization_group_size,
             kernel_init=deepnet_init(self.config.init_std, gain)
             if (self.config.use_deepnet_scaling or self.config.use_subln_init)
             else jax.nn.initializers.normal(self.config.init_std),
@@ -618,6 +1010,7 @@ class FlaxBartEncoderLayer(nn.Module):
     Edits:
     - no bias
     - use custom FlaxBartAttention
+    - takes an attention bias shared by all layers instead of an attention mask
     """
 
     config: DalleBartConfig
@@ -629,7 +1022,7 @@ class FlaxBartEncoderLayer(nn.Module):
     def __call__(
         self,
         hidden_states: jnp.ndarray,
-        attention_mask: jnp.ndarray,
+        attention_bias: jnp.ndarray,
         output_attentions: bool = True,
         deterministic: bool = True,
     ) -> Tuple[jnp.ndarray]:
@@ -662,7 +1055,7 @@ class FlaxBartEncoderLayer(nn.Module):
             is_cross_attention=False,
             q_length=self.config.max_text_length,
             k_length=self.config.max_text_length,
-        )(hidden_states=hidden_states, attention_mask=attention_mask)
+        )(hidden_states=hidden_states, attention_bias=attention_bias)
 
         if self.config.ln_positions in ["normformer", "swinv2", "cogview"]:
             hidden_states = norm(self.config.ln_type, dtype=self.dtype, epsilon=1e-05)(
@@ -722,6 +1115,7 @@ class FlaxBartDecoderLayer(nn.Module):
     Edits:
     - no bias
     - use custom FlaxBartAttention
+    - takes attention biases shared by all layers instead of attention masks
     """
 
     config: DalleBartConfig
@@ -733,9 +1127,9 @@ class FlaxBartDecoderLayer(nn.Module):
     def __call__(
         self,
         hidden_states: jnp.ndarray,
-        attention_mask: jnp.ndarray,
+        attention_bias: jnp.ndarray,
         encoder_hidden_states: Optional[jnp.ndarray] = None,
-        encoder_attention_mask: Optional[jnp.ndarray] = None,
+        encoder_attention_bias: Optional[jnp.ndarray] = None,
         init_cache: bool = False,
         output_attentions: bool = True,
         deterministic: bool = True,
@@ -774,7 +1168,7 @@ class FlaxBartDecoderLayer(nn.Module):
             k_length=self.config.image_length,
         )(
             hidden_states=hidden_states,
-            attention_mask=attention_mask,
+            attention_bias=attention_bias,
             init_cache=init_cache,
         )
 
@@ -816,7 +1210,8 @@ class FlaxBartDecoderLayer(nn.Module):
             )(
                 hidden_states=hidden_states,
                 key_value_states=encoder_hidden_states,
-                attention_mask=encoder_attention_mask,
+                attention_bias=encoder_attention_bias,
+                init_cache=init_cache,
             )
             if self.config.ln_positions in ["normformer", "swinv2", "cogview"]:
                 hidden_states = norm(
@@ -878,7 +1273,8 @@ class FlaxBartEncoderLayerCollection(nn.Module):
     """
     Edits:
     - use custom FlaxBartEncoderLayer
-    - allow Gradient Checkpointing (nn.remat)
+    - allow Gradient Checkpointing (nn.remat) with a configurable policy
+    - attention bias computed once for all layers
     """
 
     @nn.compact
@@ -894,12 +1290,15 @@ class FlaxBartEncoderLayerCollection(nn.Module):
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
 
+        attention_bias = make_attention_bias(attention_mask, dtype=self.dtype)
+
         n_layers = self.config.encoder_layers
         layer = (
             remat(
                 FlaxBartEncoderLayer,
                 static_argnums=(2, 3),
                 prevent_cse=not self.config.use_scan,
+                policy=remat_policy(self.config.remat_policy),
             )
             if self.config.gradient_checkpointing
             else FlaxBartEncoderLayer
@@ -924,7 +1323,7 @@ class FlaxBartEncoderLayerCollection(nn.Module):
                 name="FlaxBartEncoderLayers",
             )(
                 hidden_states,
-                attention_mask,
+                attention_bias,
                 output_attentions,
                 deterministic,
             )
@@ -950,7 +1349,7 @@ class FlaxBartEncoderLayerCollection(nn.Module):
                     name=f"FlaxBartEncoderLayer_{i}",
                 )(
                     hidden_states,
-                    attention_mask,
+                    attention_bias,
                     output_attentions,
                     deterministic,
                 )
@@ -984,9 +1383,19 @@ class FlaxBartDecoderLayerCollection(nn.Module):
     """
     Edits:
     - use custom FlaxBartDecoderLayer
-    - allow Gradient Checkpointing (nn.remat)
+    - allow Gradient Checkpointing (nn.remat) with a configurable policy
+    - attention biases computed once for all layers, see `make_attention_bias`
     """
 
+    def _self_attention_cache(self):
+        layer_name = (
+            "FlaxBartDecoderLayers"
+            if self.config.use_scan
+            else "FlaxBartDecoderLayer_0"
+        )
+        cache = self.variables.get("cache", {}).get(layer_name, {})
+        return cache.get("FlaxBartAttention_0", {})
+
     @nn.compact
     def __call__(
         self,
@@ -1007,12 +1416,37 @@ class FlaxBartDecoderLayerCollection(nn.Module):
             () if (output_attentions and encoder_hidden_states is not None) else None
         )
 
+        # all layers are at the same decoding position, read it from the first one
+        cache_index, kv_length = None, None
+        cache = self._self_attention_cache()
+        if "paged_key" in cache:
+            cache_index = cache["cache_index"]
+            kv_length = cache["block_table"].shape[-1] * cache["paged_key"].shape[-3]
+        elif "cached_key" in cache:
+            cache_index = cache["cache_index"]
+            kv_length = cache["cached_key"].shape[-3]
+        if cache_index is not None and self.config.use_scan:
+            # scanned layers have a leading layer axis
+            cache_index = cache_index[0]
+        attention_bias = make_attention_bias(
+            attention_mask,
+            causal=True,
+            query_length=hidden_states.shape[1],
+            cache_index=cache_index,
+            kv_length=kv_length,
+            dtype=self.dtype,
+        )
+        encoder_attention_bias = make_attention_bias(
+            encoder_attention_mask, dtype=self.dtype
+        )
+
         n_layers = self.config.decoder_layers
         layer = (
             remat(
                 FlaxBartDecoderLayer,
                 static_argnums=(4, 5, 6),
                 prevent_cse=not self.config.use_scan,
+                policy=remat_policy(self.config.remat_policy),
             )
             if self.config.gradient_checkpointing
             else FlaxBartDecoderLayer
@@ -1044,9 +1478,9 @@ class FlaxBartDecoderLayerCollection(nn.Module):
                 name="FlaxBartDecoderLayers",
             )(
                 hidden_states,
-                attention_mask,
+                attention_bias,
                 encoder_hidden_states,
-                encoder_attention_mask,
+                encoder_attention_bias,
                 init_cache,
                 output_attentions,
                 deterministic,
@@ -1074,9 +1508,9 @@ class FlaxBartDecoderLayerCollection(nn.Module):
                     name=f"FlaxBartDecoderLayer_{i}",
                 )(
                     hidden_states,
-                    attention_mask,
+                    attention_bias,
                     encoder_hidden_states,
-                    encoder_attention_mask,
+                    encoder_attention_bias,
                     init_cache,
                     output_attentions,
                     deterministic,
@@ -1406,6 +1840,86 @@ class SampleState:
     model_kwargs_uncond: Dict[str, jnp.ndarray]
 
 
+@flax.struct.dataclass
+class SpeculativeSampleState:
+    cur_len: jnp.ndarray
+    sequences: jnp.ndarray
+    prng_key: jnp.ndarray
+    model_kwargs: Dict[str, jnp.ndarray]
+    draft_model_kwargs: Dict[str, jnp.ndarray]
+
+
+@partial(jax.jit, static_argnums=(0, 1, 2))
+def _jitted_method_call(model, method_name, static_kwargs, *args, **kwargs):
+    """Calls `model.method_name`, compiled once per model and hashable `static_kwargs`."""
+    return getattr(model, method_name)(*args, **dict(static_kwargs), **kwargs)
+
+
+@partial(jax.jit, static_argnums=(0, 1))
+def _sample_chunk(model, settings, params, state, dynamic):
+    """Runs `decode_chunk_size` steps of `DalleBart._sample` (see `_sample_chunks`)."""
+    settings = dict(settings)
+    batch_size = state.sequences.shape[0]
+    logits_processor = model._get_logits_processor(
+        settings["no_repeat_ngram_size"],
+        settings["min_length"],
+        settings["max_length"],
+        settings["eos_token_id"],
+        settings["forced_bos_token_id"],
+        settings["forced_eos_token_id"],
+    )
+    if dynamic["sampling_params"] is not None:
+        logits_warper = model._get_per_row_logits_warper(
+            batch_size, **dynamic["sampling_params"]
+        )
+    else:
+        logits_warper = model._get_logits_warper(
+            top_k=settings["top_k"],
+            top_p=settings["top_p"],
+            temperature=settings["temperature"],
+        )
+    cond_fn, body_fn = model._sample_loop_fns(
+        settings["max_length"],
+        settings["pad_token_id"],
+        settings["eos_token_id"],
+        logits_processor=logits_processor,
+        logits_warper=logits_warper,
+        params=params,
+        condition_scale=dynamic["condition_scale"],
+        fuse_uncond=settings["fuse_uncond"],
+        super_conditioning=settings["super_conditioning"],
+    )
+    if state.running_token.shape[1] > 1:
+        state = body_fn(state)
+    stop = state.cur_len + settings["decode_chunk_size"]
+    state = lax.while_loop(
+        lambda state: cond_fn(state) & (state.cur_len < stop), body_fn, state
+    )
+    return state, cond_fn(state)
+
+
+@flax.struct.dataclass
+class FlaxStreamOutput(ModelOutput):
+    """
+    Partial sequences yielded by `DalleBart.generate(..., stream=True)`.
+
+    Args:
+        sequences (`jnp.ndarray` of shape `(batch_size, max_length)`):
+            The sequences generated so far, padded with `pad_token_id`.
+        cur_len (`jnp.ndarray`):
+            Number of tokens generated so far, including the decoder start token.
+        elapsed_time (`float`):
+            Seconds since the start of sampling.
+        tokens_per_second (`float`):
+            Tokens sampled per second over the last chunk, summed over rows.
+    """
+
+    sequences: jnp.ndarray = None
+    cur_len: jnp.ndarray = None
+    elapsed_time: float = None
+    tokens_per_second: float = None
+
+
 @flax.struct.dataclass
 class FlaxSampleOutput(ModelOutput):
     """
@@ -1431,6 +1945,8 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
     - custom generate method to allow super conditions
     - num_params property
     - unscan function
+    - quantize function
+    - fuse_qkv and unfuse_qkv functions
     """
 
     module_class = FlaxBartForConditionalGenerationModule
@@ -1463,6 +1979,36 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
             params = unflatten_dict(params)
         return params
 
+    def quantize(self, params, quantization: str = "int8", group_size: int = 128):
+        """
+        Weight-only quantization of attention and feed-forward kernels.
+
+        The config is updated so that quantized params can be saved with `save_pretrained`
+        and loaded back with `from_pretrained`.
+        """
+        assert self.config.quantization is None, "params are already quantized"
+        self.config.quantization = quantization
+        self.config.quantization_group_size = group_size
+        return quantize_params(params, quantization, group_size)
+
+    def fuse_qkv(self, params):
+        """
+        Packs the query, key and value kernels of self-attention layers into a single
+        `qkv_proj` kernel.
+
+        The config is updated so that fused params can be saved with `save_pretrained`
+        and loaded back with `from_pretrained`.
+        """
+        assert not self.config.fuse_qkv, "params are already fused"
+        self.config.fuse_qkv = True
+        return fuse_qkv_params(params, self.config)
+
+    def unfuse_qkv(self, params):
+        """Inverse of `fuse_qkv`, e.g. to resume training from separate projections."""
+        assert self.config.fuse_qkv, "params are not fused"
+        self.config.fuse_qkv = False
+        return unfuse_qkv_params(params, self.config)
+
     def decode(
         self,
         decoder_input_ids,
@@ -1595,6 +2141,258 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
 
         return outputs
 
+    def init_cache(
+        self,
+        batch_size,
+        max_length,
+        encoder_outputs,
+        per_row_index=False,
+        page_size=None,
+        num_pages=None,
+    ):
+        """
+        Edits:
+        - `per_row_index` creates one cache index per row so that rows can be
+          reset and advanced independently (continuous batching)
+        - `page_size` replaces the self-attention keys and values of each row with a pool of
+          `num_pages` pages of `page_size` positions shared by all rows, and a `block_table`
+          of shape (batch_size, max_length // page_size) mapping positions of each row to
+          pages (requires `per_row_index`). Page 0 is a scratch page for rows without pages.
+        """
+        cache = super().init_cache(batch_size, max_length, encoder_outputs)
+        if per_row_index:
+            cache = flatten_dict(cache)
+            for k, v in cache.items():
+                if k[-1] == "cache_index":
+                    # scanned layers keep their leading layer axis
+                    cache[k] = jnp.zeros(v.shape + (batch_size,), dtype=v.dtype)
+            cache = unflatten_dict(cache)
+        if page_size is not None:
+            assert per_row_index, "a paged cache requires `per_row_index`"
+            assert (
+                self.config.kv_cache_quantization is None
+            ), "a paged cache cannot be quantized"
+            assert max_length % page_size == 0, "`page_size` must divide `max_length`"
+            pages_per_row = max_length // page_size
+            if num_pages is None:
+                num_pages = batch_size * pages_per_row + 1
+            cache = flatten_dict(cache)
+            for k in list(cache.keys()):
+                if k[-1] in ["cached_key", "cached_value"]:
+                    # (..., batch, max_length, heads, head_dim)
+                    v = cache.pop(k)
+                    layer_dims = v.shape[:-4]
+                    cache[k[:-1] + ("paged_" + k[-1][len("cached_") :],)] = jnp.zeros(
+                        layer_dims + (num_pages, page_size) + v.shape[-2:], v.dtype
+                    )
+                    cache[k[:-1] + ("block_table",)] = jnp.zeros(
+                        layer_dims + (batch_size, pages_per_row), dtype=jnp.int32
+                    )
+            cache = unflatten_dict(cache)
+        return cache
+
+    def _add_cross_attention_cache(self, model_kwargs, params=None):
+        if model_kwargs.get("cross_attention_cache") is not None:
+            return model_kwargs
+        return {
+            **model_kwargs,
+            "cross_attention_cache": self.init_cross_attention_cache(
+                model_kwargs["encoder_outputs"],
+                model_kwargs.get("attention_mask"),
+                params=params,
+            ),
+        }
+
+    def _expand_to_num_return_sequences(
+        self,
+        model_kwargs,
+        num_return_sequences,
+        params=None,
+        cross_attention_cache=False,
+    ):
+        """Repeat encoder outputs (and cross-attention cache) for every returned sequence."""
+
+        def expand(x, axis=0):
+            return jnp.repeat(x, num_return_sequences, axis=axis)
+
+        if cross_attention_cache:
+            model_kwargs = self._add_cross_attention_cache(model_kwargs, params)
+        expanded = {
+            **model_kwargs,
+            "encoder_outputs": FlaxBaseModelOutput(
+                last_hidden_state=expand(model_kwargs["encoder_outputs"][0])
+            ),
+        }
+        if model_kwargs.get("attention_mask") is not None:
+            expanded["attention_mask"] = expand(model_kwargs["attention_mask"])
+        if model_kwargs.get("cross_attention_cache") is not None:
+            # batch axis comes after the scanned layer axis
+            expanded["cross_attention_cache"] = jax.tree_util.tree_map(
+                lambda x: expand(x, axis=-4), model_kwargs["cross_attention_cache"]
+            )
+        return expanded
+
+    @staticmethod
+    def _concatenate_uncond_kwargs(model_kwargs, model_kwargs_uncond):
+        """Stack conditional and unconditional encoder outputs into a single batch."""
+
+        hidden_states = model_kwargs["encoder_outputs"]["last_hidden_state"]
+
+        def attention_mask(kwargs):
+            mask = kwargs.get("attention_mask")
+            if mask is None:
+                mask = jnp.ones(hidden_states.shape[:2], dtype="i4")
+            # the unconditional prompt may be shared by all rows (`uncond_cache`)
+            return jnp.broadcast_to(mask, hidden_states.shape[:2])
+
+        hidden_states_uncond = jnp.broadcast_to(
+            model_kwargs_uncond["encoder_outputs"]["last_hidden_state"],
+            hidden_states.shape,
+        )
+        return {
+            **model_kwargs,
+            "encoder_outputs": FlaxBaseModelOutput(
+                last_hidden_state=jnp.concatenate(
+                    [hidden_states, hidden_states_uncond], axis=0
+                )
+            ),
+            "attention_mask": jnp.concatenate(
+                [attention_mask(model_kwargs), attention_mask(model_kwargs_uncond)],
+                axis=0,
+            ),
+        }
+
+    def init_cross_attention_cache(
+        self,
+        encoder_outputs,
+        encoder_attention_mask: Optional[jnp.ndarray] = None,
+        params: dict = None,
+    ):
+        """
+        Projects the encoder outputs into the cross-attention keys and values of every
+        decoder layer, to be merged into the decoder cache with
+        `prepare_inputs_for_generation(..., cross_attention_cache=...)`.
+        """
+        encoder_hidden_states = encoder_outputs[0]
+        batch_size, sequence_length = encoder_hidden_states.shape[:2]
+        if encoder_attention_mask is None:
+            encoder_attention_mask = jnp.ones((batch_size, sequence_length))
+        # a single decoder position is enough to reach every cross-attention layer
+        decoder_input_ids = jnp.ones((batch_size, 1), dtype="i4")
+
+        def _decoder_forward(
+            module,
+            decoder_input_ids,
+            decoder_attention_mask,
+            decoder_position_ids,
+            **kwargs,
+        ):
+            decoder_module = module._get_decoder_module()
+            return decoder_module(
+                decoder_input_ids,
+                decoder_attention_mask,
+                decoder_position_ids,
+                **kwargs,
+            )
+
+        _, variables = self.module.apply(
+            {"params": params or self.params},
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=jnp.ones_like(decoder_input_ids),
+            decoder_position_ids=jnp.zeros_like(decoder_input_ids),
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=jnp.array(encoder_attention_mask, dtype="i4"),
+            init_cache=True,
+            mutable=["cache"],
+            method=_decoder_forward,
+        )
+        cache = flatten_dict(unfreeze(variables["cache"]))
+        return unflatten_dict(
+            {
+                k: v
+                for k, v in cache.items()
+                if k[-1] in ["cached_cross_key", "cached_cross_value"]
+            }
+        )
+
+    def init_uncond_cache(
+        self,
+        input_ids_uncond: jnp.ndarray,
+        attention_mask_uncond: Optional[jnp.ndarray] = None,
+        params: dict = None,
+    ):
+        """
+        Encodes the unconditional prompt once, along with its cross-attention keys and values.
+
+        The result can be passed to `generate(..., uncond_cache=...)` for every request
+        sharing these params, so that the unconditional prompt is never re-encoded.
+        """
+        # the unconditional prompt is the same for every row
+        input_ids_uncond = input_ids_uncond[:1]
+        if attention_mask_uncond is None:
+            attention_mask_uncond = jnp.ones_like(input_ids_uncond)
+        attention_mask_uncond = attention_mask_uncond[:1]
+        encoder_outputs = self.encode(
+            input_ids_uncond, attention_mask_uncond, params=params, return_dict=True
+        )
+        return {
+            "encoder_outputs": encoder_outputs,
+            "attention_mask": attention_mask_uncond,
+            "cross_attention_cache": self.init_cross_attention_cache(
+                encoder_outputs, attention_mask_uncond, params=params
+            ),
+        }
+
+    @staticmethod
+    def _apply_condition_scale(logits, logits_uncond, condition_scale):
+        """Super conditioning, leaving rows with a scale of 1.0 unchanged."""
+        # Source: @RiversHaveWings - https://twitter.com/RiversHaveWings/status/1478093658716966912?s=20&t=xdm-wZ61Wf7OLnE_NJHZ1w
+        return jnp.where(
+            condition_scale == 1.0,
+            logits,
+            logits_uncond + condition_scale * (logits - logits_uncond),
+        )
+
+    def _get_per_row_logits_warper(
+        self,
+        batch_size: int,
+        top_k: Optional[Any] = None,
+        top_p: Optional[Any] = None,
+        temperature: Optional[Any] = None,
+    ):
+        """
+        Same as `_get_logits_warper` with sampling params that are traced arrays of shape
+        (batch_size,) (or scalars) instead of values baked into the trace.
+
+        A `top_k` of 0 and a `top_p` of 1.0 disable the corresponding filter.
+        """
+
+        def per_row(value, config_value, disabled_value, dtype):
+            for v in [value, config_value, disabled_value]:
+                if v is not None:
+                    return jnp.broadcast_to(jnp.asarray(v, dtype=dtype), (batch_size,))
+
+        top_k = per_row(top_k, self.config.top_k, 0, jnp.int32)
+        top_p = per_row(top_p, self.config.top_p, 1.0, jnp.float32)
+        temperature = per_row(temperature, self.config.temperature, 1.0, jnp.float32)
+
+        def logits_warper(input_ids, scores, cur_len):
+            scores = scores / temperature[:, None].astype(scores.dtype)
+            vocab_size = scores.shape[-1]
+            # a single sort serves both filters
+            sorted_scores, sorted_indices = lax.top_k(scores, vocab_size)
+            rank = jnp.arange(vocab_size)[None]
+            k = jnp.where(top_k > 0, jnp.minimum(top_k, vocab_size), vocab_size)
+            sorted_scores = jnp.where(rank < k[:, None], sorted_scores, -jnp.inf)
+            cumulative_probs = jax.nn.softmax(sorted_scores, axis=-1).cumsum(axis=-1)
+            # include the token that crosses top_p as well
+            keep = jnp.roll(cumulative_probs < top_p[:, None], 1, axis=-1)
+            keep = keep.at[:, 0].set(True) | (top_p[:, None] >= 1.0)
+            sorted_scores = jnp.where(keep, sorted_scores, -jnp.inf)
+            return lax.sort_key_val(sorted_indices, sorted_scores)[-1]
+
+        return logits_warper
+
     def prepare_inputs_for_generation(
         self,
         decoder_input_ids,
@@ -1602,12 +2400,24 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
         attention_mask: Optional[jnp.DeviceArray] = None,
         decoder_attention_mask: Optional[jnp.DeviceArray] = None,
         encoder_outputs=None,
+        cross_attention_cache=None,
         **kwargs,
     ):
+        """
+        Edits:
+        - `cross_attention_cache` (see `init_cross_attention_cache`) is merged into the cache
+        """
         # initializing the cache
         batch_size, seq_length = decoder_input_ids.shape
 
         past_key_values = self.init_cache(batch_size, max_length - 1, encoder_outputs)
+        if cross_attention_cache is not None:
+            past_key_values = unflatten_dict(
+                {
+                    **flatten_dict(past_key_values),
+                    **flatten_dict(unfreeze(cross_attention_cache)),
+                }
+            )
         # Note that usually one would have to put 0's in the attention_mask for x > input_ids.shape[-1] and x < cache_length.
         # But since the decoder uses a causal mask, those positions are masked anyways.
         # Thus we can create a single static attention_mask here, which is more efficient for compilation
@@ -1656,9 +2466,54 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
         condition_scale: Optional[float] = 1.0,
         input_ids_uncond: Optional[jnp.ndarray] = None,
         attention_mask_uncond: Optional[jnp.ndarray] = None,
+        uncond_cache: Optional[Dict[str, Any]] = None,
+        fuse_uncond: bool = False,
+        draft_model: Optional["DalleBart"] = None,
+        draft_params: Optional[Dict[str, jnp.ndarray]] = None,
+        num_speculative_tokens: int = 4,
+        per_row_sampling: bool = False,
+        decode_chunk_size: Optional[int] = None,
+        stream: bool = False,
+        cancel_mask: Optional[np.ndarray] = None,
+        chunk_callback: Optional[Callable[["FlaxStreamOutput"], None]] = None,
+        encoder_cache: Optional[EncoderCache] = None,
+        num_return_sequences: Optional[int] = None,
         **model_kwargs,
     ):
-        """Edit: Allow super conditioning."""
+        """
+        Edits:
+        - allow super conditioning
+        - `uncond_cache` (see `init_uncond_cache`) replaces `input_ids_uncond` and is shared
+          by all rows instead of encoding the unconditional prompt for every call
+        - `draft_model` enables speculative sampling: a smaller DalleBart sharing the same
+          tokenizer and image vocabulary proposes `num_speculative_tokens` tokens that are
+          verified with a single decoder call of this model
+        - `fuse_uncond` runs the conditional and unconditional rows as a single batch
+          of size 2 * batch_size (one decoder call per token when using super conditioning)
+        - `per_row_sampling` accepts `top_k`, `top_p`, `temperature` and `condition_scale`
+          as arrays of shape (batch_size,) that are traced instead of compiled in, so that
+          a single executable serves any sampling settings; super conditioning is then
+          enabled by passing `input_ids_uncond` or `uncond_cache`
+        - `decode_chunk_size` runs sampling from the host, `decode_chunk_size` tokens per
+          jitted call, and `stream` returns an iterator of `FlaxStreamOutput` after each
+          chunk (16 tokens, one row of image tokens, by default); both require calling
+          `generate` outside of `jax.jit`
+        - `cancel_mask` is a host array of shape (batch_size,) read between chunks: rows
+          set to True are padded from there on and decoding stops once every row is done
+        - `chunk_callback` is called on the host with the `FlaxStreamOutput` of every chunk
+          (progress, tokens per second, previews or updates of `cancel_mask`), also when
+          iterating over the outputs of `stream`
+        - `encoder_cache` (see `EncoderCache`) reuses the encoder outputs of prompts seen
+          before and only encodes the other rows (requires calling `generate` outside of
+          `jax.jit`)
+        - `prng_key` may be an array of shape (batch_size, 2) of keys (one per output
+          row) so that the tokens of a row do not depend on the other rows of the batch
+          (not supported with `draft_model`)
+        - `num_return_sequences` samples that many sequences per prompt from a single
+          encoder pass: rows `i * num_return_sequences` to `(i + 1) * num_return_sequences - 1`
+          of the output belong to prompt `i`, and per-row arguments (`per_row_sampling`
+          arrays, `cancel_mask`) refer to these output rows
+        """
 
         # set init values
         max_length = max_length if max_length is not None else self.config.max_length
@@ -1685,19 +2540,56 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
 
         do_sample = do_sample if do_sample is not None else self.config.do_sample
         num_beams = num_beams if num_beams is not None else self.config.num_beams
+        num_return_sequences = num_return_sequences or 1
+        batch_size = input_ids.shape[0] * num_return_sequences
+
+        if per_row_sampling:
+            assert (
+                do_sample is True and num_beams == 1
+            ), "`per_row_sampling` requires `do_sample` and `num_beams` == 1."
+            assert (
+                draft_model is None
+            ), "`per_row_sampling` is not supported with `draft_model`."
+            super_conditioning = (
+                input_ids_uncond is not None or uncond_cache is not None
+            )
+            condition_scale = jnp.broadcast_to(
+                jnp.asarray(condition_scale, dtype=jnp.float32), (batch_size,)
+            )[:, None]
+        else:
+            super_conditioning = condition_scale != 1.0
+
+        chunked = stream or any(
+            arg is not None for arg in [decode_chunk_size, cancel_mask, chunk_callback]
+        )
+        if chunked or encoder_cache is not None:
+            # sampling is driven from the host: avoid re-tracing the encoder at every call
+            params = params if params is not None else self.params
+            prepare_encoder_kwargs = partial(
+                _jitted_method_call,
+                self,
+                "_prepare_encoder_decoder_kwargs_for_generation",
+                (),
+            )
+            if encoder_cache is not None:
+                prepare_encoder_kwargs = partial(
+                    encoder_cache.prepare_encoder_kwargs, prepare_encoder_kwargs
+                )
+        else:
+            prepare_encoder_kwargs = self._prepare_encoder_decoder_kwargs_for_generation
 
         if self.config.is_encoder_decoder:
             # add encoder_outputs to model_kwargs
             if model_kwargs.get("encoder_outputs") is None:
                 model_kwargs_input = dict(model_kwargs)
-                model_kwargs = self._prepare_encoder_decoder_kwargs_for_generation(
+                model_kwargs = prepare_encoder_kwargs(
                     input_ids,
                     params,
                     {"attention_mask": attention_mask, **model_kwargs_input},
                 )
-                if condition_scale != 1.0:
+                if super_conditioning:
                     assert (
-                        input_ids_uncond is not None
+                        input_ids_uncond is not None or uncond_cache is not None
                     ), "`input_ids_uncond` has to be defined for super conditioning."
                     assert (
                         do_sample is True
@@ -1705,8 +2597,10 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                     assert (
                         num_beams == 1
                     ), "`num_beams` has to be 1 for super conditioning."
-                    model_kwargs_uncond = (
-                        self._prepare_encoder_decoder_kwargs_for_generation(
+                    if uncond_cache is not None:
+                        model_kwargs_uncond = {**model_kwargs_input, **uncond_cache}
+                    else:
+                        model_kwargs_uncond = prepare_encoder_kwargs(
                             input_ids_uncond,
                             params,
                             {
@@ -1714,13 +2608,51 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                                 **model_kwargs_input,
                             },
                         )
-                    )
                 else:
                     model_kwargs_uncond = None
+            if draft_model is not None:
+                assert (
+                    draft_model.config.image_vocab_size == self.config.image_vocab_size
+                ), "`draft_model` must share the image vocabulary."
+                draft_model_kwargs = (
+                    draft_model._prepare_encoder_decoder_kwargs_for_generation(
+                        input_ids, draft_params, {"attention_mask": attention_mask}
+                    )
+                )
+                if condition_scale != 1.0:
+                    if input_ids_uncond is None:
+                        # `uncond_cache` holds encoder outputs of this model only
+                        raise ValueError(
+                            "`draft_model` requires `input_ids_uncond` for super "
+                            "conditioning (also when passing `uncond_cache`)."
+                        )
+                    draft_model_kwargs_uncond = (
+                        draft_model._prepare_encoder_decoder_kwargs_for_generation(
+                            input_ids_uncond,
+                            draft_params,
+                            {"attention_mask": attention_mask_uncond},
+                        )
+                    )
+                else:
+                    draft_model_kwargs_uncond = None
+            if num_return_sequences > 1:
+                # cross-attention keys and values are also projected once per prompt,
+                # unless rows are stacked with unconditional rows afterwards
+                expand = partial(
+                    self._expand_to_num_return_sequences,
+                    num_return_sequences=num_return_sequences,
+                    params=params,
+                    cross_attention_cache=not fuse_uncond and draft_model is None,
+                )
+                model_kwargs = expand(model_kwargs)
+                if super_conditioning and uncond_cache is None:
+                    model_kwargs_uncond = expand(model_kwargs_uncond)
+                if draft_model is not None:
+                    draft_model_kwargs = expand(draft_model_kwargs)
+                    if draft_model_kwargs_uncond is not None:
+                        draft_model_kwargs_uncond = expand(draft_model_kwargs_uncond)
             # prepare decoder_input_ids for generation
-            input_ids = (
-                jnp.ones((input_ids.shape[0], 1), dtype="i4") * decoder_start_token_id
-            )
+            input_ids = jnp.ones((batch_size, 1), dtype="i4") * decoder_start_token_id
 
         if not do_sample and num_beams == 1:
             logits_processor = self._get_logits_processor(
@@ -1742,9 +2674,17 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                 model_kwargs=model_kwargs,
             )
         elif do_sample and num_beams == 1:
-            logits_warper = self._get_logits_warper(
-                top_k=top_k, top_p=top_p, temperature=temperature
-            )
+            if per_row_sampling:
+                logits_warper = self._get_per_row_logits_warper(
+                    input_ids.shape[0],
+                    top_k=top_k,
+                    top_p=top_p,
+                    temperature=temperature,
+                )
+            else:
+                logits_warper = self._get_logits_warper(
+                    top_k=top_k, top_p=top_p, temperature=temperature
+                )
             logits_processor = self._get_logits_processor(
                 no_repeat_ngram_size,
                 min_length,
@@ -1753,6 +2693,62 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                 forced_bos_token_id,
                 forced_eos_token_id,
             )
+            if chunked:
+                assert draft_model is None, "`draft_model` does not support chunks."
+                chunks = self._sample_chunks(
+                    input_ids,
+                    max_length,
+                    prng_key,
+                    params=params,
+                    model_kwargs=model_kwargs,
+                    condition_scale=condition_scale,
+                    model_kwargs_uncond=model_kwargs_uncond,
+                    decode_chunk_size=decode_chunk_size or 16,
+                    cancel_mask=cancel_mask,
+                    chunk_callback=chunk_callback,
+                    sampling_params=(
+                        {"top_k": top_k, "top_p": top_p, "temperature": temperature}
+                        if per_row_sampling
+                        else None
+                    ),
+                    pad_token_id=pad_token_id,
+                    eos_token_id=eos_token_id,
+                    no_repeat_ngram_size=no_repeat_ngram_size,
+                    min_length=min_length,
+                    forced_bos_token_id=forced_bos_token_id,
+                    forced_eos_token_id=forced_eos_token_id,
+                    top_k=None if per_row_sampling else top_k,
+                    top_p=None if per_row_sampling else top_p,
+                    temperature=None if per_row_sampling else temperature,
+                    fuse_uncond=fuse_uncond,
+                    super_conditioning=super_conditioning,
+                )
+                if stream:
+                    return chunks
+                for output in chunks:
+                    pass
+                return FlaxSampleOutput(sequences=output.sequences)
+            if draft_model is not None:
+                assert (
+                    prng_key.ndim == 1
+                ), "`draft_model` does not support one `prng_key` per row."
+                return self._speculative_sample(
+                    input_ids,
+                    max_length,
+                    prng_key,
+                    draft_model,
+                    num_speculative_tokens=num_speculative_tokens,
+                    logits_processor=logits_processor,
+                    logits_warper=logits_warper,
+                    trace=trace,
+                    params=params,
+                    draft_params=draft_params,
+                    model_kwargs=model_kwargs,
+                    draft_model_kwargs=draft_model_kwargs,
+                    condition_scale=condition_scale,
+                    model_kwargs_uncond=model_kwargs_uncond,
+                    draft_model_kwargs_uncond=draft_model_kwargs_uncond,
+                )
             return self._sample(
                 input_ids,
                 max_length,
@@ -1766,6 +2762,8 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                 model_kwargs=model_kwargs,
                 condition_scale=condition_scale,
                 model_kwargs_uncond=model_kwargs_uncond,
+                fuse_uncond=fuse_uncond,
+                super_conditioning=super_conditioning,
             )
         elif not do_sample and num_beams > 1:
             # broadcast input_ids & encoder_outputs
@@ -1822,6 +2820,8 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
         model_kwargs: Optional[Dict[str, jnp.ndarray]] = None,
         condition_scale: float = 1.0,
         model_kwargs_uncond: Optional[Dict[str, jnp.ndarray]] = None,
+        fuse_uncond: bool = False,
+        super_conditioning: Optional[bool] = None,
     ):
         # init values
         max_length = max_length if max_length is not None else self.config.max_length
@@ -1832,10 +2832,61 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
             eos_token_id if eos_token_id is not None else self.config.eos_token_id
         )
         prng_key = prng_key if prng_key is not None else jax.random.PRNGKey(0)
+        # `condition_scale` may be a traced array, in which case `super_conditioning` is set
+        if super_conditioning is None:
+            super_conditioning = condition_scale != 1.0
+        fuse_uncond = fuse_uncond and super_conditioning
+
+        state = self._init_sample_state(
+            input_ids,
+            max_length,
+            pad_token_id,
+            prng_key,
+            params=params,
+            model_kwargs=model_kwargs,
+            model_kwargs_uncond=model_kwargs_uncond,
+            fuse_uncond=fuse_uncond,
+            super_conditioning=super_conditioning,
+        )
+        sample_search_cond_fn, sample_search_body_fn = self._sample_loop_fns(
+            max_length,
+            pad_token_id,
+            eos_token_id,
+            logits_processor=logits_processor,
+            logits_warper=logits_warper,
+            params=params,
+            condition_scale=condition_scale,
+            fuse_uncond=fuse_uncond,
+            super_conditioning=super_conditioning,
+        )
+
+        # The very first prompt often has sequence length > 1, so run outside of `lax.while_loop` to comply with TPU
+        if input_ids.shape[1] > 1:
+            state = sample_search_body_fn(state)
 
+        if not trace:
+            state = self._run_loop_in_debug(
+                sample_search_cond_fn, sample_search_body_fn, state
+            )
+        else:
+            state = lax.while_loop(sample_search_cond_fn, sample_search_body_fn, state)
+
+        return FlaxSampleOutput(sequences=state.sequences)
+
+    def _init_sample_state(
+        self,
+        input_ids,
+        max_length: int,
+        pad_token_id: int,
+        prng_key: jnp.ndarray,
+        params: Optional[Dict[str, jnp.ndarray]] = None,
+        model_kwargs: Optional[Dict[str, jnp.ndarray]] = None,
+        model_kwargs_uncond: Optional[Dict[str, jnp.ndarray]] = None,
+        fuse_uncond: bool = False,
+        super_conditioning: bool = False,
+    ):
         batch_size, cur_len = input_ids.shape
 
-        eos_token_id = jnp.array(eos_token_id)
         pad_token_id = jnp.array(pad_token_id)
         cur_len = jnp.array(cur_len)
 
@@ -1846,30 +2897,63 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
         # per batch-item state bit indicating if sentence has finished.
         is_sent_finished = jnp.zeros((batch_size,), dtype=jnp.bool_)
 
-        # For Seq2Seq generation, we only need to use the decoder instead of the whole model in generation loop
-        # and pass it the `encoder_outputs`, which are part of the `model_kwargs`.
-        model = self.decode if self.config.is_encoder_decoder else self
+        # conditional and unconditional rows share a single batch and cache
+        if fuse_uncond:
+            model_kwargs = self._concatenate_uncond_kwargs(
+                model_kwargs, model_kwargs_uncond
+            )
+            model_kwargs_uncond = None
+            running_token = jnp.concatenate([input_ids, input_ids], axis=0)
+        else:
+            running_token = input_ids
+
+        # cross-attention keys and values are projected once instead of at every step
+        if self.config.is_encoder_decoder:
+            model_kwargs = self._add_cross_attention_cache(model_kwargs, params)
+            if super_conditioning and not fuse_uncond:
+                model_kwargs_uncond = self._add_cross_attention_cache(
+                    model_kwargs_uncond, params
+                )
 
         # initialize model specific kwargs
         model_kwargs = self.prepare_inputs_for_generation(
-            input_ids, max_length, **model_kwargs
+            running_token, max_length, **model_kwargs
         )
-        if condition_scale != 1.0:
+        if super_conditioning and not fuse_uncond:
             model_kwargs_uncond = self.prepare_inputs_for_generation(
                 input_ids, max_length, **model_kwargs_uncond
             )
 
         # initialize state
-        state = SampleState(
+        return SampleState(
             cur_len=cur_len,
             sequences=sequences,
-            running_token=input_ids,
+            running_token=running_token,
             is_sent_finished=is_sent_finished,
             prng_key=prng_key,
             model_kwargs=model_kwargs,
             model_kwargs_uncond=model_kwargs_uncond,
         )
 
+    def _sample_loop_fns(
+        self,
+        max_length: int,
+        pad_token_id: int,
+        eos_token_id: int,
+        logits_processor=None,
+        logits_warper=None,
+        params: Optional[Dict[str, jnp.ndarray]] = None,
+        condition_scale: float = 1.0,
+        fuse_uncond: bool = False,
+        super_conditioning: bool = False,
+    ):
+        eos_token_id = jnp.array(eos_token_id)
+        pad_token_id = jnp.array(pad_token_id)
+
+        # For Seq2Seq generation, we only need to use the decoder instead of the whole model in generation loop
+        # and pass it the `encoder_outputs`, which are part of the `model_kwargs`.
+        model = self.decode if self.config.is_encoder_decoder else self
+
         def sample_search_cond_fn(state):
             """state termination condition fn."""
             has_reached_max_length = state.cur_len == max_length
@@ -1881,7 +2965,14 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
 
         def sample_search_body_fn(state):
             """state update fn."""
-            prng_key, prng_key_next = jax.random.split(state.prng_key)
+            # `prng_key` of shape (batch_size, 2) holds one key per row
+            per_row_keys = state.prng_key.ndim == 2
+            if per_row_keys:
+                prng_key, prng_key_next = jnp.swapaxes(
+                    jax.vmap(jax.random.split)(state.prng_key), 0, 1
+                )
+            else:
+                prng_key, prng_key_next = jax.random.split(state.prng_key)
             model_outputs = model(
                 state.running_token, params=params, **state.model_kwargs
             )
@@ -1889,13 +2980,20 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
             logits = model_outputs.logits[:, -1]
 
             # perform super conditioning
-            # Source: @RiversHaveWings - https://twitter.com/RiversHaveWings/status/1478093658716966912?s=20&t=xdm-wZ61Wf7OLnE_NJHZ1w
-            if condition_scale != 1.0:
+            if fuse_uncond:
+                logits, logits_uncond = jnp.split(logits, 2, axis=0)
+                logits = self._apply_condition_scale(
+                    logits, logits_uncond, condition_scale
+                )
+                model_outputs_uncond = None
+            elif super_conditioning:
                 model_outputs_uncond = model(
                     state.running_token, params=params, **state.model_kwargs_uncond
                 )
                 logits_uncond = model_outputs_uncond.logits[:, -1]
-                logits = logits_uncond + condition_scale * (logits - logits_uncond)
+                logits = self._apply_condition_scale(
+                    logits, logits_uncond, condition_scale
+                )
             else:
                 model_outputs_uncond = None
 
@@ -1904,7 +3002,10 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
             # apply top_k, top_k, temperature
             logits = logits_warper(logits, logits, state.cur_len)
 
-            next_token = jax.random.categorical(prng_key, logits, axis=-1)
+            if per_row_keys:
+                next_token = jax.vmap(jax.random.categorical)(prng_key, logits)
+            else:
+                next_token = jax.random.categorical(prng_key, logits, axis=-1)
 
             next_is_sent_finished = state.is_sent_finished | (
                 next_token == eos_token_id
@@ -1925,29 +3026,354 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                 self.update_inputs_for_generation(
                     model_outputs_uncond, state.model_kwargs_uncond
                 )
-                if condition_scale != 1.0
+                if super_conditioning and not fuse_uncond
                 else None
             )
 
             return SampleState(
                 cur_len=state.cur_len + 1,
                 sequences=next_sequences,
-                running_token=next_token,
+                running_token=jnp.concatenate([next_token, next_token], axis=0)
+                if fuse_uncond
+                else next_token,
                 is_sent_finished=next_is_sent_finished,
                 model_kwargs=next_model_kwargs,
                 model_kwargs_uncond=next_model_kwargs_uncond,
                 prng_key=prng_key_next,
             )
 
-        # The very first prompt often has sequence length > 1, so run outside of `lax.while_loop` to comply with TPU
+        return sample_search_cond_fn, sample_search_body_fn
+
+    def _sample_chunks(
+        self,
+        input_ids: None,
+        max_length: int,
+        prng_key: jnp.ndarray,
+        params: Optional[Dict[str, jnp.ndarray]] = None,
+        model_kwargs: Optional[Dict[str, jnp.ndarray]] = None,
+        condition_scale: float = 1.0,
+        model_kwargs_uncond: Optional[Dict[str, jnp.ndarray]] = None,
+        decode_chunk_size: int = 16,
+        sampling_params: Optional[Dict[str, jnp.ndarray]] = None,
+        cancel_mask: Optional[np.ndarray] = None,
+        chunk_callback: Optional[Callable[["FlaxStreamOutput"], None]] = None,
+        **chunk_settings,
+    ):
+        """
+        Same as `_sample` but runs the loop from the host, `decode_chunk_size` tokens per
+        jitted call, and yields a `FlaxStreamOutput` after every chunk.
+
+        `chunk_settings` are hashable generation settings (see `_sample_chunk`) so that the
+        chunk executable is compiled once per setting. `condition_scale` and
+        `sampling_params` (for `per_row_sampling`) are traced.
+
+        Rows set in `cancel_mask` are marked as finished before each chunk, and
+        `chunk_callback` is called with every output before it is yielded.
+        """
+        super_conditioning = chunk_settings["super_conditioning"]
+        fuse_uncond = chunk_settings["fuse_uncond"] and super_conditioning
+        chunk_settings = {**chunk_settings, "fuse_uncond": fuse_uncond}
+        params = params if params is not None else self.params
+        state = _jitted_method_call(
+            self,
+            "_init_sample_state",
+            (
+                ("max_length", max_length),
+                ("pad_token_id", chunk_settings["pad_token_id"]),
+                ("fuse_uncond", fuse_uncond),
+                ("super_conditioning", super_conditioning),
+            ),
+            input_ids,
+            prng_key=prng_key,
+            params=params,
+            model_kwargs=model_kwargs,
+            model_kwargs_uncond=model_kwargs_uncond,
+        )
+        settings = tuple(
+            sorted(
+                {
+                    **chunk_settings,
+                    "max_length": max_length,
+                    "decode_chunk_size": decode_chunk_size,
+                }.items()
+            )
+        )
+        dynamic = {
+            "condition_scale": jnp.asarray(condition_scale, dtype=jnp.float32),
+            "sampling_params": sampling_params,
+        }
+        start_time = chunk_start_time = time.perf_counter()
+        cur_len = int(state.cur_len)
+        while True:
+            if cancel_mask is not None:
+                state = state.replace(
+                    is_sent_finished=state.is_sent_finished
+                    | jnp.asarray(cancel_mask, dtype=jnp.bool_)
+                )
+            state, unfinished = _sample_chunk(self, settings, params, state, dynamic)
+            # reading the flag waits for the chunk to complete
+            unfinished = bool(unfinished)
+            chunk_end_time = time.perf_counter()
+            num_tokens = (int(state.cur_len) - cur_len) * state.sequences.shape[0]
+            cur_len = int(state.cur_len)
+            output = FlaxStreamOutput(
+                sequences=state.sequences,
+                cur_len=state.cur_len,
+                elapsed_time=chunk_end_time - start_time,
+                tokens_per_second=num_tokens / (chunk_end_time - chunk_start_time),
+            )
+            if chunk_callback is not None:
+                chunk_callback(output)
+            yield output
+            chunk_start_time = time.perf_counter()
+            if not unfinished:
+                return
+
+    def _speculative_sample(
+        self,
+        input_ids: None,
+        max_length: int,
+        prng_key: jnp.ndarray,
+        draft_model: "DalleBart",
+        num_speculative_tokens: int = 4,
+        logits_processor=None,
+        logits_warper=None,
+        trace: bool = True,
+        params: Optional[Dict[str, jnp.ndarray]] = None,
+        draft_params: Optional[Dict[str, jnp.ndarray]] = None,
+        model_kwargs: Optional[Dict[str, jnp.ndarray]] = None,
+        draft_model_kwargs: Optional[Dict[str, jnp.ndarray]] = None,
+        condition_scale: float = 1.0,
+        model_kwargs_uncond: Optional[Dict[str, jnp.ndarray]] = None,
+        draft_model_kwargs_uncond: Optional[Dict[str, jnp.ndarray]] = None,
+    ):
+        """
+        Speculative sampling (https://arxiv.org/abs/2302.01318).
+
+        The draft model proposes `num_speculative_tokens` tokens which are all scored with
+        a single decoder call of this model. Proposals are accepted with probability
+        min(1, p / q) and the first rejected token is resampled from max(0, p - q), so that
+        sequences follow the distribution of this model (after super conditioning,
+        `logits_processor` and top_k, top_p, temperature, applied to both models). Rows
+        accept a different number of tokens so each row keeps its own position in the
+        cache. Sequences never end early with eos.
+        """
+        k = num_speculative_tokens
+        assert k > 0, "`num_speculative_tokens` must be positive"
+        batch_size = input_ids.shape[0]
+        eos_token_id = self.config.eos_token_id
+        pad_token_id = self.config.pad_token_id
+        super_conditioning = condition_scale != 1.0
+        rows = jnp.arange(batch_size)
+
+        def init_model_kwargs(model, model_params, kwargs, kwargs_uncond):
+            # conditional and unconditional rows share a single batch and cache
+            if super_conditioning:
+                kwargs = self._concatenate_uncond_kwargs(kwargs, kwargs_uncond)
+            kwargs = model._add_cross_attention_cache(kwargs, model_params)
+            n_rows = kwargs["encoder_outputs"]["last_hidden_state"].shape[0]
+            cache = flatten_dict(
+                model.init_cache(
+                    n_rows,
+                    max_length - 1,
+                    kwargs["encoder_outputs"],
+                    per_row_index=True,
+                )
+            )
+            for key, v in cache.items():
+                if key[-1] in [
+                    "cached_key",
+                    "cached_value",
+                    "cached_key_scale",
+                    "cached_value_scale",
+                ]:
+                    # room for proposals past max_length (they are discarded)
+                    pad_width = [(0, 0)] * (v.ndim - 3) + [(0, k + 1), (0, 0), (0, 0)]
+                    cache[key] = jnp.pad(v, pad_width)
+            cache.update(flatten_dict(unfreeze(kwargs["cross_attention_cache"])))
+            return {
+                "past_key_values": unflatten_dict(cache),
+                "encoder_outputs": kwargs["encoder_outputs"],
+                "encoder_attention_mask": kwargs.get("attention_mask"),
+                "decoder_attention_mask": jnp.ones(
+                    (n_rows, max_length + k), dtype="i4"
+                ),
+            }
+
+        def set_cache_index(kwargs, index):
+            if super_conditioning:
+                index = jnp.concatenate([index, index], axis=0)
+            cache = flatten_dict(kwargs["past_key_values"])
+            for key, v in cache.items():
+                if key[-1] == "cache_index":
+                    cache[key] = jnp.broadcast_to(index, v.shape).astype(v.dtype)
+            return {**kwargs, "past_key_values": unflatten_dict(cache)}
+
+        def log_probs(model, model_params, kwargs, tokens, positions):
+            """Log-probabilities of the next token after each of `tokens`."""
+            next_positions = positions + 1
+            if super_conditioning:
+                tokens = jnp.concatenate([tokens, tokens], axis=0)
+                positions = jnp.concatenate([positions, positions], axis=0)
+            model_outputs = model.decode(
+                tokens,
+                params=model_params,
+                # proposals past max_length are discarded
+                decoder_position_ids=jnp.minimum(positions, max_length - 2),
+                **kwargs,
+            )
+            logits = model_outputs.logits
+            if super_conditioning:
+                logits, logits_uncond = jnp.split(logits, 2, axis=0)
+                logits = self._apply_condition_scale(
+                    logits, logits_uncond, condition_scale
+                )
+            shape = logits.shape
+            logits = logits.reshape(-1, shape[-1])
+            # apply min_length, ... at the position of each next token
+            if logits_processor is not None:
+                logits = logits_processor(None, logits, next_positions.reshape(-1, 1))
+            # rows do not stop early (image tokens never end with eos)
+            logits = logits.at[:, eos_token_id].set(-jnp.inf)
+            # apply top_k, top_k, temperature
+            logits = logits_warper(None, logits, None).reshape(shape)
+            next_kwargs = {**kwargs, "past_key_values": model_outputs.past_key_values}
+            return jax.nn.log_softmax(logits, axis=-1), next_kwargs
+
+        # sequences have room for proposals past max_length (they are discarded)
+        sequences = jnp.full(
+            (batch_size, max_length + k + 1), pad_token_id, dtype=jnp.int32
+        )
+        sequences = lax.dynamic_update_slice(sequences, input_ids, (0, 0))
+        state = SpeculativeSampleState(
+            cur_len=jnp.full((batch_size,), input_ids.shape[1], dtype=jnp.int32),
+            sequences=sequences,
+            prng_key=prng_key,
+            model_kwargs=init_model_kwargs(
+                self, params, model_kwargs, model_kwargs_uncond
+            ),
+            draft_model_kwargs=init_model_kwargs(
+                draft_model, draft_params, draft_model_kwargs, draft_model_kwargs_uncond
+            ),
+        )
+        # the prompt except its last token is fed to the cache first
         if input_ids.shape[1] > 1:
-            state = sample_search_body_fn(state)
+            positions = jnp.broadcast_to(
+                jnp.arange(input_ids.shape[1] - 1), (batch_size, input_ids.shape[1] - 1)
+            )
+            _, next_kwargs = log_probs(
+                self, params, state.model_kwargs, input_ids[:, :-1], positions
+            )
+            _, next_draft_kwargs = log_probs(
+                draft_model,
+                draft_params,
+                state.draft_model_kwargs,
+                input_ids[:, :-1],
+                positions,
+            )
+            state = state.replace(
+                model_kwargs=next_kwargs, draft_model_kwargs=next_draft_kwargs
+            )
+
+        def speculative_cond_fn(state):
+            """state termination condition fn."""
+            return jnp.any(state.cur_len < max_length)
+
+        def speculative_body_fn(state):
+            """state update fn."""
+            prng_key, draft_key, accept_key, resample_key = jax.random.split(
+                state.prng_key, 4
+            )
+            # position of the last token, which is not in the cache yet
+            start = state.cur_len - 1
+            last_token = state.sequences[rows, start]
+
+            # draft proposes k tokens, the extra step adds the last proposal to its cache
+            def draft_step(carry, key):
+                token, position, kwargs = carry
+                log_q, kwargs = log_probs(
+                    draft_model, draft_params, kwargs, token, position
+                )
+                next_token = jax.random.categorical(key, log_q[:, -1], axis=-1)
+                return (next_token[:, None], position + 1, kwargs), (
+                    next_token,
+                    log_q[:, -1],
+                )
+
+            (_, _, draft_kwargs), (draft_tokens, draft_log_q) = lax.scan(
+                draft_step,
+                (last_token[:, None], start[:, None], state.draft_model_kwargs),
+                jax.random.split(draft_key, k + 1),
+            )
+            draft_tokens = jnp.swapaxes(draft_tokens[:k], 0, 1)
+            draft_log_q = jnp.swapaxes(draft_log_q[:k], 0, 1)
+
+            # score all proposals with a single call
+            tokens = jnp.concatenate([last_token[:, None], draft_tokens], axis=1)
+            log_p, next_kwargs = log_probs(
+                self,
+                params,
+                state.model_kwargs,
+                tokens,
+                start[:, None] + jnp.arange(k + 1),
+            )
+
+            # accept proposals while u < p / q
+            log_p_draft = jnp.take_along_axis(
+                log_p[:, :k], draft_tokens[..., None], axis=-1
+            )[..., 0]
+            log_q_draft = jnp.take_along_axis(
+                draft_log_q, draft_tokens[..., None], axis=-1
+            )[..., 0]
+            u = jax.random.uniform(accept_key, (batch_size, k))
+            accepted = jnp.log(u) < log_p_draft - log_q_draft
+            num_accepted = jnp.cumprod(accepted, axis=1).sum(axis=1)
+
+            # resample the first rejected token from max(0, p - q), or sample one more
+            # token from p when all proposals are accepted
+            p = jnp.exp(log_p[rows, num_accepted])
+            q = jnp.where(
+                (num_accepted < k)[:, None],
+                jnp.exp(draft_log_q[rows, jnp.minimum(num_accepted, k - 1)]),
+                0.0,
+            )
+            residual = jnp.maximum(p - q, 0.0)
+            residual = jnp.where(residual.sum(axis=-1, keepdims=True) > 0, residual, p)
+            next_token = jax.random.categorical(
+                resample_key, jnp.log(residual), axis=-1
+            )
+
+            new_tokens = jnp.where(
+                jnp.arange(k + 1) < num_accepted[:, None],
+                jnp.pad(draft_tokens, ((0, 0), (0, 1))),
+                next_token[:, None],
+            )
+            num_new_tokens = jnp.where(state.cur_len < max_length, num_accepted + 1, 0)
+
+            def write_row(row, tokens, start, n):
+                window = lax.dynamic_slice(row, (start,), (k + 1,))
+                tokens = jnp.where(jnp.arange(k + 1) < n, tokens, window)
+                return lax.dynamic_update_slice(row, tokens, (start,))
+
+            next_sequences = jax.vmap(write_row)(
+                state.sequences, new_tokens, state.cur_len, num_new_tokens
+            )
+            next_cur_len = jnp.minimum(state.cur_len + num_new_tokens, max_length)
+
+            # rejected proposals are dropped from the caches
+            return SpeculativeSampleState(
+                cur_len=next_cur_len,
+                sequences=next_sequences,
+                prng_key=prng_key,
+                model_kwargs=set_cache_index(next_kwargs, next_cur_len - 1),
+                draft_model_kwargs=set_cache_index(draft_kwargs, next_cur_len - 1),
+            )
 
         if not trace:
             state = self._run_loop_in_debug(
-                sample_search_cond_fn, sample_search_body_fn, state
+                speculative_cond_fn, speculative_body_fn, state
             )
         else:
-            state = lax.while_loop(sample_search_cond_fn, sample_search_body_fn, state)
+            state = lax.while_loop(speculative_cond_fn, speculative_body_fn, state)
 
-        return FlaxSampleOutput(sequences=state.sequences)
+        return FlaxSampleOutput(sequences=state.sequences[:, :max_length])
@@ -0,0 +1,132 @@
+""" Model parallel DalleBart generation with pjit """
+
+from typing import Any, Dict, Optional
+
+import jax
+import numpy as np
+from flax.core.frozen_dict import freeze
+from flax.traverse_util import flatten_dict, unflatten_dict
+from jax.experimental import PartitionSpec, maps
+from jax.experimental.pjit import pjit
+
+from .modeling import DalleBart
+from .partitions import set_partitions
+
+
+def _divisible_spec(param_spec, params, mp_devices):
+    """Replicates params whose sharded dimension is not a multiple of `mp_devices`."""
+    shapes = flatten_dict(params)
+    param_spec = flatten_dict(param_spec)
+    for k, spec in param_spec.items():
+        if spec is not None and any(
+            axis == "mp" and dim % mp_devices
+            for axis, dim in zip(spec, shapes[k].shape)
+        ):
+            # e.g. lm_head with image_vocab_size + 1 outputs
+            param_spec[k] = None
+    return freeze(unflatten_dict(param_spec))
+
+
+class ShardedGenerator:
+    """
+    Runs `DalleBart.generate` with params sharded over a ("dp", "mp") device mesh.
+
+    Params are split along "mp" with the partition rules used for training (see
+    `set_partitions`), so that each device only holds a fraction of the model, and
+    the batch is split along "dp". The decoder self-attention cache follows the
+    attention heads along "mp" and the batch along "dp".
+
+    `mp_devices` devices hold a full copy of the model and `dp_devices` defaults to
+    using all the remaining devices (of every process). As in `tools/train/train.py`,
+    each process passes its local part of the batch.
+
+    Sequences are the same as with `DalleBart.generate` on a single device when
+    `jax_threefry_partitionable` is enabled. Otherwise XLA partitions the random bits
+    of sampling differently depending on the mesh: sequences follow the same
+    distribution but change with `mp_devices` and `dp_devices`.
+
+    Example:
+        model, params = DalleBart.from_pretrained(DALLE_MODEL, _do_init=False)
+        generator = ShardedGenerator(model, params, mp_devices=4, condition_scale=10.0)
+        sequences = generator(
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            prng_key,
+            inputs["input_ids_uncond"],
+            inputs["attention_mask_uncond"],
+        )
+    """
+
+    def __init__(
+        self,
+        model: DalleBart,
+        params: Dict[str, Any],
+        mp_devices: int = 1,
+        dp_devices: Optional[int] = None,
+        **generate_kwargs,
+    ):
+        self.model = model
+        self.generate_kwargs = generate_kwargs
+        self.super_conditioning = generate_kwargs.get("condition_scale", 1.0) != 1.0
+
+        if dp_devices is None:
+            dp_devices = jax.device_count() // mp_devices
+        mesh_shape = (dp_devices, mp_devices)
+        devices = np.asarray(jax.devices()[: dp_devices * mp_devices])
+        self.mesh = maps.Mesh(devices.reshape(*mesh_shape), ("dp", "mp"))
+
+        # get PartitionSpec for model params
+        params = freeze(params)
+        self.param_spec = _divisible_spec(
+            set_partitions(params, model.config.use_scan), params, mp_devices
+        )
+        with self.mesh:
+            self.params = pjit(
+                lambda params: params,
+                in_axis_resources=(self.param_spec,),
+                out_axis_resources=self.param_spec,
+            )(params)
+
+        batch_spec = PartitionSpec("dp")
+        text_specs = (batch_spec,) * (4 if self.super_conditioning else 2)
+        self._generate = pjit(
+            self._generate_fn,
+            in_axis_resources=(self.param_spec, None) + text_specs,
+            out_axis_resources=batch_spec,
+        )
+
+    def _generate_fn(
+        self,
+        params,
+        prng_key,
+        input_ids,
+        attention_mask,
+        input_ids_uncond=None,
+        attention_mask_uncond=None,
+    ):
+        return self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            input_ids_uncond=input_ids_uncond,
+            attention_mask_uncond=attention_mask_uncond,
+            prng_key=prng_key,
+            params=params,
+            **self.generate_kwargs,
+        ).sequences
+
+    def __call__(
+        self,
+        input_ids,
+        attention_mask,
+        prng_key,
+        input_ids_uncond=None,
+        attention_mask_uncond=None,
+    ):
+        inputs = [input_ids, attention_mask]
+        if self.super_conditioning:
+            assert (
+                input_ids_uncond is not None
+            ), "`input_ids_uncond` has to be defined for super conditioning."
+            inputs += [input_ids_uncond, attention_mask_uncond]
+        with self.mesh:
+            return self._generate(self.params, prng_key, *inputs)
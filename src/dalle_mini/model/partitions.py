@@ -3,6 +3,8 @@ import re
 from flax.core.frozen_dict import freeze
 from flax.traverse_util import flatten_dict, unflatten_dict
 from jax.experimental import PartitionSpec as P
+from jax.experimental.pjit import with_sharding_constraint
+from jax.interpreters import pxla
 
 # utils adapted from https://github.com/google-research/google-research/blob/master/flax_models/t5x/partitions.py
 # Sentinels
@@ -41,7 +43,11 @@ def _get_partition_rules():
         (("rel_bias", "embedding"), P(None, "mp")),
         # attention
         (("(q_proj|k_proj|v_proj)", "kernel"), P(None, "mp")),
+        # fused kernel is laid out per head, see `fused_qkv.py`
+        (("qkv_proj", "kernel"), P(None, "mp")),
         (("out_proj", "kernel"), P("mp", None)),
+        # quantization scales
+        (("kernel_scale",), None),
         # FFN
         (("Dense_0", "kernel"), P(None, "mp")),
         (("GLU.*", "Dense_1", "kernel"), P(None, "mp")),
@@ -74,3 +80,16 @@ def set_partitions(in_dict, use_scan):
         }
     assert _unmatched not in result.values(), "Incomplete partition spec."
     return freeze(unflatten_dict(result))
+
+
+def with_kv_cache_sharding(x):
+    """
+    Shards a decoder cache tensor of shape (..., batch, length, heads, head_dim) with
+    batch along "dp" and heads along "mp" when called within a mesh defining these axes
+    (see `ShardedGenerator`), and leaves it unchanged otherwise.
+    """
+    mesh = pxla.thread_resources.env.physical_mesh
+    if mesh.empty or not {"dp", "mp"}.issubset(mesh.axis_names):
+        return x
+    spec = (None,) * (x.ndim - 4) + ("dp", None, "mp", None)
+    return with_sharding_constraint(x, P(*spec))
@@ -0,0 +1,163 @@
+""" Decoding of generated image tokens into encoded image files """
+
+import base64
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import List, Optional, Union
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from PIL import Image
+
+IMAGE_FORMATS = ["png", "jpeg", "webp"]
+
+
+def encode_image(
+    image: np.ndarray,
+    image_format: str = "png",
+    base64_encode: bool = False,
+    **save_kwargs,
+) -> Union[bytes, str]:
+    """Encodes an uint8 image of shape (height, width, 3), optionally as a base64 string."""
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format=image_format.upper(), **save_kwargs)
+    encoded = buffer.getvalue()
+    if base64_encode:
+        return base64.b64encode(encoded).decode("utf-8")
+    return encoded
+
+
+class ImagePostprocessor:
+    """
+    Turns `FlaxSampleOutput.sequences` into encoded images.
+
+    Image tokens are decoded by the VQGAN and converted to uint8 on device, in batches
+    of `decode_batch_size` (padded so that a single executable is compiled). Images are
+    then encoded to `image_format` by a pool of `num_workers` threads (or processes
+    with `use_processes`).
+
+    `submit` runs both stages in the background and returns a future, so that the next
+    batch can be generated while the previous one is decoded and encoded.
+
+    With a `reranker` (see `ClipReranker`), `submit(sequences, prompts, top_k=...)` only
+    encodes the best candidates of each prompt.
+
+    Example:
+        postprocessor = ImagePostprocessor(vqgan, vqgan_params, image_format="jpeg", quality=90)
+        pending = None
+        for batch in batches:
+            sequences = p_generate(batch, ...).sequences
+            if pending is not None:
+                send(pending.result())
+            pending = postprocessor.submit(sequences)
+        send(pending.result())
+    """
+
+    def __init__(
+        self,
+        vqgan,
+        vqgan_params,
+        image_format: str = "png",
+        decode_batch_size: Optional[int] = None,
+        num_workers: int = 4,
+        use_processes: bool = False,
+        base64_encode: bool = False,
+        reranker=None,
+        **save_kwargs,
+    ):
+        assert (
+            image_format in IMAGE_FORMATS
+        ), f"image_format must be one of {IMAGE_FORMATS}"
+        self.vqgan = vqgan
+        self.vqgan_params = vqgan_params
+        self.decode_batch_size = decode_batch_size
+        self.reranker = reranker
+        self._encode = partial(
+            encode_image,
+            image_format=image_format,
+            base64_encode=base64_encode,
+            **save_kwargs,
+        )
+        self._decode = jax.jit(self._decode_fn)
+        # a single background thread keeps decoding in submission order
+        self._decode_executor = ThreadPoolExecutor(max_workers=1)
+        if use_processes:
+            # forking a process that initialized jax can deadlock
+            self._encode_executor = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            self._encode_executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _decode_fn(self, vqgan_params, codes):
+        images = self.vqgan.decode_code(codes, params=vqgan_params)
+        return (images.clip(0.0, 1.0) * 255).astype(jnp.uint8)
+
+    def decode(self, sequences) -> np.ndarray:
+        """uint8 images of shape (batch_size, height, width, 3) from generated sequences."""
+        sequences = np.asarray(sequences)
+        # drop decoder start token
+        codes = sequences.reshape(-1, sequences.shape[-1])[:, 1:]
+        num_images = codes.shape[0]
+        decode_batch_size = self.decode_batch_size or num_images
+        images = []
+        for start in range(0, num_images, decode_batch_size):
+            batch = codes[start : start + decode_batch_size]
+            padding = decode_batch_size - batch.shape[0]
+            # dispatch every batch before waiting for the first one
+            images.append(
+                self._decode(
+                    self.vqgan_params,
+                    np.pad(batch, ((0, padding), (0, 0)), mode="edge"),
+                )[: batch.shape[0]]
+            )
+        return np.concatenate([np.asarray(x) for x in images])
+
+    def _process(self, sequences, prompts=None, top_k=None, min_score=None):
+        images = self.decode(sequences)
+        if prompts is None:
+            return list(self._encode_executor.map(self._encode, images))
+        # low scoring candidates are never encoded
+        indices, _ = self.reranker.rerank(prompts, images, top_k, min_score)
+        candidates = images.reshape(len(prompts), -1, *images.shape[1:])
+        return [
+            list(self._encode_executor.map(self._encode, prompt_candidates[idx]))
+            for prompt_candidates, idx in zip(candidates, indices)
+        ]
+
+    def submit(
+        self,
+        sequences,
+        prompts: Optional[List[str]] = None,
+        top_k: Optional[int] = None,
+        min_score: Optional[float] = None,
+    ) -> Future:
+        """
+        Future of the list of encoded images of `sequences`.
+
+        With `prompts`, the future holds a list per prompt of its `top_k` best images
+        scoring at least `min_score` (see `ClipReranker.rerank`), best first.
+        """
+        assert (
+            prompts is None or self.reranker is not None
+        ), "a reranker is required to select images"
+        return self._decode_executor.submit(
+            self._process, sequences, prompts, top_k, min_score
+        )
+
+    def __call__(self, sequences, *args, **kwargs) -> List[Union[bytes, str]]:
+        return self.submit(sequences, *args, **kwargs).result()
+
+    def close(self):
+        self._decode_executor.shutdown()
+        self._encode_executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -30,12 +30,18 @@ class DalleBartProcessorBase:
         self.input_ids_uncond = uncond["input_ids"]
         self.attention_mask_uncond = uncond["attention_mask"]
 
-    def __call__(self, text: List[str] = None):
+    def normalize(self, text: List[str]) -> List[str]:
+        """Text as seen by the tokenizer."""
+        if self.normalize_text:
+            return [self.text_processor(t) for t in text]
+        return list(text)
+
+    def __call__(self, text: List[str] = None, normalized: bool = False):
         # check that text is not a string
         assert not isinstance(text, str), "text must be a list of strings"
 
-        if self.normalize_text:
-            text = [self.text_processor(t) for t in text]
+        if not normalized:
+            text = self.normalize(text)
         res = self.tokenizer(
             text,
             return_tensors="jax",
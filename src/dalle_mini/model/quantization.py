@@ -0,0 +1,103 @@
+""" Weight-only quantization of DalleBart dense kernels """
+
+import re
+
+import jax.numpy as jnp
+from flax.core.frozen_dict import freeze, unfreeze
+from flax.traverse_util import flatten_dict, unflatten_dict
+
+QUANTIZATION_TYPES = ["int8", "int4"]
+
+# kernels of attention projections and feed-forward layers (not embeddings or lm_head)
+_quantized_kernel_patterns = [
+    re.compile(r"(q_proj|k_proj|v_proj|qkv_proj|out_proj)"),
+    re.compile(r"(GLU|FFN)_\d+"),
+]
+
+
+def is_quantized_kernel(path) -> bool:
+    """Whether the param at `path` (tuple of keys) is quantized."""
+    return path[-1] == "kernel" and any(
+        pattern.fullmatch(k) for k in path for pattern in _quantized_kernel_patterns
+    )
+
+
+def quantize_kernel(kernel, quantization: str = "int8", group_size: int = 128):
+    """
+    Symmetric calibration-free quantization of a kernel of shape (..., in, out).
+
+    Returns the quantized kernel (stored as int8) and its scale:
+    - int8: per output channel scale of shape (..., out)
+    - int4: scale of shape (..., in // group_size, out) for groups of `group_size`
+      input channels, with two values packed per int8 so that the kernel has
+      shape (..., in // 2, out)
+    """
+    assert (
+        quantization in QUANTIZATION_TYPES
+    ), f"quantization must be one of {QUANTIZATION_TYPES}"
+    kernel = jnp.asarray(kernel, dtype=jnp.float32)
+    if quantization == "int8":
+        scale = jnp.max(jnp.abs(kernel), axis=-2) / 127.0
+        scale = jnp.where(scale == 0, 1.0, scale)
+        q = jnp.round(kernel / scale[..., None, :])
+        return q.astype(jnp.int8), scale
+
+    *batch_dims, in_features, out_features = kernel.shape
+    group_size = min(group_size, in_features)
+    assert (
+        in_features % group_size == 0 and group_size % 2 == 0
+    ), f"input features ({in_features}) must be divisible by an even group_size ({group_size})"
+    grouped = kernel.reshape(*batch_dims, -1, group_size, out_features)
+    scale = jnp.max(jnp.abs(grouped), axis=-2) / 7.0
+    scale = jnp.where(scale == 0, 1.0, scale)
+    q = jnp.round(grouped / scale[..., None, :]).astype(jnp.int8)
+    q = q.reshape(*batch_dims, in_features // 2, 2, out_features)
+    packed = (q[..., 0, :] & 0x0F) | (q[..., 1, :] << 4)
+    return packed.astype(jnp.int8), scale
+
+
+def quantize_int8(x, axis: int = -1):
+    """Symmetric int8 quantization of `x` with a scale per slice along `axis`."""
+    scale = jnp.max(jnp.abs(x), axis=axis, keepdims=True) / 127.0
+    scale = jnp.where(scale == 0, 1.0, scale).astype(x.dtype)
+    return jnp.round(x / scale).astype(jnp.int8), scale
+
+
+def unpack_int4(packed):
+    """Unpacks a kernel of shape (..., in // 2, out) into int8 values of shape (..., in, out)."""
+    # arithmetic shifts restore the sign of each 4 bits value
+    low = (packed << 4) >> 4
+    high = packed >> 4
+    unpacked = jnp.stack([low, high], axis=-2)
+    return unpacked.reshape(*packed.shape[:-2], -1, packed.shape[-1])
+
+
+def dequantize_kernel(kernel, scale, quantization: str = "int8"):
+    """Float kernel of shape (..., in, out) from `quantize_kernel` outputs."""
+    if quantization == "int8":
+        return kernel.astype(jnp.float32) * scale[..., None, :]
+    kernel = unpack_int4(kernel).astype(jnp.float32)
+    *batch_dims, in_features, out_features = kernel.shape
+    num_groups = scale.shape[-2]
+    kernel = kernel.reshape(*batch_dims, num_groups, -1, out_features)
+    kernel = kernel * scale[..., None, :]
+    return kernel.reshape(*batch_dims, in_features, out_features)
+
+
+def quantize_params(params, quantization: str = "int8", group_size: int = 128):
+    """
+    Quantizes attention and feed-forward kernels of float params.
+
+    The result is loaded by a model whose config has the same `quantization` and
+    `quantization_group_size` (see `DalleBart.quantize`).
+    """
+    params = flatten_dict(unfreeze(params))
+    quantized = {}
+    for path, value in params.items():
+        if is_quantized_kernel(path):
+            quantized[path], quantized[path[:-1] + ("kernel_scale",)] = quantize_kernel(
+                value, quantization, group_size
+            )
+        else:
+            quantized[path] = value
+    return freeze(unflatten_dict(quantized))
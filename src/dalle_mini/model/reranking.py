@@ -0,0 +1,146 @@
+""" CLIP reranking of generated images """
+
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+# normalization of CLIP image inputs (see CLIPFeatureExtractor)
+CLIP_IMAGE_MEAN = [0.48145466, 0.4578275, 0.40821073]
+CLIP_IMAGE_STD = [0.26862954, 0.26130258, 0.27577711]
+
+
+class ClipReranker:
+    """
+    Ranks candidate images of each prompt by CLIP score.
+
+    Text features are computed once per prompt and cached. Images (uint8 arrays of shape
+    (height, width, 3), e.g. from `ImagePostprocessor.decode`) are resized, normalized
+    and scored on device in padded batches of `batch_size`.
+
+    Candidates are expected grouped per prompt, as returned by
+    `DalleBart.generate(..., num_return_sequences=n)`: rows `i * n` to `(i + 1) * n - 1`
+    belong to prompt `i`.
+
+    Example:
+        clip, clip_params = FlaxCLIPModel.from_pretrained(CLIP_REPO, _do_init=False)
+        clip_processor = CLIPProcessor.from_pretrained(CLIP_REPO)
+        reranker = ClipReranker(clip, clip_params, clip_processor)
+        indices, scores = reranker.rerank(prompts, images, top_k=2)
+    """
+
+    def __init__(
+        self,
+        clip,
+        clip_params,
+        clip_processor,
+        batch_size: int = 16,
+        max_cached_prompts: int = 1024,
+    ):
+        self.clip = clip
+        self.clip_params = clip_params
+        self.clip_processor = clip_processor
+        self.batch_size = batch_size
+        self.max_cached_prompts = max_cached_prompts
+        self.image_size = clip.config.vision_config.image_size
+        self._text_features = OrderedDict()
+        self._encode_text = jax.jit(self._encode_text_fn)
+        self._encode_images = jax.jit(self._encode_images_fn)
+
+    def _encode_text_fn(self, clip_params, input_ids, attention_mask):
+        features = self.clip.get_text_features(
+            input_ids, attention_mask, params=clip_params
+        )
+        return features / jnp.linalg.norm(features, axis=-1, keepdims=True)
+
+    def _encode_images_fn(self, clip_params, images):
+        images = jax.image.resize(
+            images.astype(jnp.float32) / 255.0,
+            (images.shape[0], self.image_size, self.image_size, images.shape[-1]),
+            method="bicubic",
+        )
+        images = (images - jnp.array(CLIP_IMAGE_MEAN)) / jnp.array(CLIP_IMAGE_STD)
+        # CLIP expects channels first
+        pixel_values = images.transpose(0, 3, 1, 2)
+        features = self.clip.get_image_features(pixel_values, params=clip_params)
+        return features / jnp.linalg.norm(features, axis=-1, keepdims=True)
+
+    def text_features(self, prompts: Sequence[str]) -> jnp.ndarray:
+        """Normalized text features of shape (len(prompts), projection_dim)."""
+        missing = list(
+            dict.fromkeys(p for p in prompts if p not in self._text_features)
+        )
+        if missing:
+            inputs = self.clip_processor(
+                text=missing,
+                return_tensors="np",
+                padding="max_length",
+                max_length=77,
+                truncation=True,
+            ).data
+            features = self._encode_text(
+                self.clip_params, inputs["input_ids"], inputs["attention_mask"]
+            )
+            for prompt, feature in zip(missing, features):
+                self._text_features[prompt] = feature
+        for prompt in prompts:
+            self._text_features.move_to_end(prompt)
+        features = jnp.stack([self._text_features[p] for p in prompts])
+        while len(self._text_features) > self.max_cached_prompts:
+            self._text_features.popitem(last=False)
+        return features
+
+    def image_features(self, images) -> jnp.ndarray:
+        """Normalized image features of uint8 images of shape (batch, height, width, 3)."""
+        images = np.asarray(images)
+        features = []
+        for start in range(0, images.shape[0], self.batch_size):
+            batch = images[start : start + self.batch_size]
+            padding = self.batch_size - batch.shape[0]
+            features.append(
+                self._encode_images(
+                    self.clip_params,
+                    np.pad(batch, ((0, padding), (0, 0), (0, 0), (0, 0)), mode="edge"),
+                )[: batch.shape[0]]
+            )
+        return jnp.concatenate(features)
+
+    def score(self, prompts: List[str], images) -> np.ndarray:
+        """CLIP logits of shape (len(prompts), num_candidates) of images grouped per prompt."""
+        num_prompts = len(prompts)
+        assert (
+            len(images) % num_prompts == 0
+        ), "every prompt needs the same number of candidates"
+        text_features = self.text_features(prompts)
+        image_features = self.image_features(images).reshape(
+            num_prompts, -1, text_features.shape[-1]
+        )
+        logit_scale = jnp.exp(self.clip_params["logit_scale"])
+        scores = jnp.einsum("pd,pnd->pn", text_features, image_features) * logit_scale
+        return np.asarray(scores)
+
+    def rerank(
+        self,
+        prompts: List[str],
+        images,
+        top_k: Optional[int] = None,
+        min_score: Optional[float] = None,
+    ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        Indices (within the candidates of each prompt) and scores of the best `top_k`
+        candidates of each prompt, best first.
+
+        Candidates scoring below `min_score` are pruned, so that fewer than `top_k`
+        indices may be returned for a prompt.
+        """
+        scores = self.score(prompts, images)
+        order = np.argsort(-scores, axis=-1, kind="stable")[:, :top_k]
+        indices, top_scores = [], []
+        for prompt_order, prompt_scores in zip(order, scores):
+            if min_score is not None:
+                prompt_order = prompt_order[prompt_scores[prompt_order] >= min_score]
+            indices.append(prompt_order)
+            top_scores.append(prompt_scores[prompt_order])
+        return indices, top_scores
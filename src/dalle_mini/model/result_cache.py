@@ -0,0 +1,241 @@
+""" Cache of generated image tokens keyed by prompt and generation settings """
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+class GenerationResultCache:
+    """
+    LRU cache of image token sequences (the 256 VQGAN codes, stored as int16).
+
+    Entries are keyed by the normalized prompt, its token ids, the generation
+    settings, the PRNG seed and `model_version`, so that a cached sequence is only
+    served for the exact same request. Serving a hit costs a VQGAN decode instead of
+    a full sampling loop.
+
+    The in-memory tier holds at most `max_entries` sequences and `max_bytes` bytes.
+    With `cache_dir`, sequences are also written to disk and reloaded on memory misses.
+    The disk tier holds at most `max_disk_entries` files and `max_disk_bytes` bytes,
+    least recently used files are deleted first.
+
+    Example:
+        cache = GenerationResultCache(model_version="dalle-mini/dalle-mini/mega-1-fp16:latest")
+        codes = generate_with_cache(model, processor, prompts, cache, seed=0, params=params)
+        images = vqgan.decode_code(codes, params=vqgan_params)
+    """
+
+    def __init__(
+        self,
+        model_version: str,
+        max_entries: int = 10000,
+        max_bytes: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        max_disk_entries: int = 100000,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        # sizes of the files of the disk tier, least recently used first
+        self._disk_entries = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+        }
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # files left by previous processes, oldest first
+            files = [
+                os.path.join(cache_dir, f)
+                for f in os.listdir(cache_dir)
+                if f.endswith(".npy") and ".tmp" not in f
+            ]
+            for path in sorted(files, key=os.path.getmtime):
+                key = os.path.basename(path)[: -len(".npy")]
+                self._disk_entries[key] = os.path.getsize(path)
+                self._disk_bytes += self._disk_entries[key]
+            with self._lock:
+                self._evict_disk()
+
+    def key(
+        self,
+        normalized_text: str,
+        input_ids,
+        seed: int,
+        generate_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """Identifies a generation request."""
+        description = {
+            "text": normalized_text,
+            "input_ids": np.asarray(input_ids).reshape(-1).tolist(),
+            "seed": seed,
+            "generate_kwargs": generate_kwargs or {},
+            "model_version": self.model_version,
+        }
+        description = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _insert(self, key, codes):
+        # caller holds the lock
+        if key in self._entries:
+            self._num_bytes -= self._entries.pop(key).nbytes
+        self._entries[key] = codes
+        self._num_bytes += codes.nbytes
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._num_bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= evicted.nbytes
+            self.metrics["evictions"] += 1
+
+    def _evict_disk(self):
+        # caller holds the lock
+        while len(self._disk_entries) > self.max_disk_entries or (
+            self.max_disk_bytes is not None and self._disk_bytes > self.max_disk_bytes
+        ):
+            key, num_bytes = self._disk_entries.popitem(last=False)
+            self._disk_bytes -= num_bytes
+            self.metrics["disk_evictions"] += 1
+            try:
+                os.remove(self._disk_path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Cached image codes of `key`, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.metrics["hits"] += 1
+                return self._entries[key]
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            try:
+                codes = np.load(self._disk_path(key))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not load cached generation {key}: {e}")
+            else:
+                with self._lock:
+                    self._insert(key, codes)
+                    if key in self._disk_entries:
+                        self._disk_entries.move_to_end(key)
+                    self.metrics["disk_hits"] += 1
+                return codes
+        with self._lock:
+            self.metrics["misses"] += 1
+        return None
+
+    def put(self, key: str, codes):
+        """Store the image codes (without the decoder start token) of `key`."""
+        codes = np.asarray(codes)
+        assert codes.min() >= 0 and codes.max() <= np.iinfo(np.int16).max
+        codes = codes.astype(np.int16)
+        codes.setflags(write=False)
+        with self._lock:
+            self._insert(key, codes)
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.tmp.npy"
+            np.save(tmp_path, codes)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes -= self._disk_entries.pop(key, 0)
+                self._disk_entries[key] = os.path.getsize(path)
+                self._disk_bytes += self._disk_entries[key]
+                self._evict_disk()
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.metrics["hits"] + self.metrics["disk_hits"]
+        total = hits + self.metrics["misses"]
+        return hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@partial(jax.jit, static_argnums=(0, 1))
+def _generate(model, generate_kwargs, params, inputs, prng_keys):
+    """`model.generate` with one key per row, compiled once per hashable settings."""
+    return model.generate(
+        **inputs, prng_key=prng_keys, params=params, **dict(generate_kwargs)
+    ).sequences
+
+
+def generate_with_cache(
+    model,
+    processor,
+    prompts: List[str],
+    cache: GenerationResultCache,
+    seed: int = 0,
+    params=None,
+    **generate_kwargs,
+) -> np.ndarray:
+    """
+    Image codes of shape (len(prompts), image_length) for `prompts`.
+
+    Prompts missing from `cache` are generated together in one batch and added to it.
+    Each prompt is sampled with its own PRNG key derived from `seed` and its cache key,
+    so that cached codes only depend on the request and not on the other prompts.
+    `generate_kwargs` must be hashable, generation is compiled once per setting and
+    power of 2 of missing prompts.
+    """
+    normalized = processor.normalize(prompts)
+    tokenized = processor(normalized, normalized=True)
+    input_ids = np.asarray(tokenized["input_ids"])
+    keys = [
+        cache.key(text, ids, seed, generate_kwargs)
+        for text, ids in zip(normalized, input_ids)
+    ]
+    cached = {key: cache.get(key) for key in dict.fromkeys(keys)}
+    # duplicated prompts are generated once
+    missing = [keys.index(key) for key, c in cached.items() if c is None]
+    if missing:
+        # pad to a power of 2 to limit the number of compiled shapes
+        num_rows = 1 << (len(missing) - 1).bit_length()
+        rows = missing + missing[-1:] * (num_rows - len(missing))
+        prng_keys = jnp.stack(
+            [
+                jax.random.fold_in(
+                    jax.random.PRNGKey(seed), int(keys[i][:8], 16) & 0x7FFFFFFF
+                )
+                for i in rows
+            ]
+        )
+        sequences = _generate(
+            model,
+            tuple(sorted(generate_kwargs.items())),
+            params if params is not None else model.params,
+            {k: jnp.asarray(v)[np.asarray(rows)] for k, v in tokenized.items()},
+            prng_keys,
+        )
+        # drop decoder start token
+        sequences = np.asarray(sequences)[: len(missing), 1:]
+        for i, sequence in zip(missing, sequences):
+            cache.put(keys[i], sequence)
+            cached[keys[i]] = sequence
+    return np.stack([np.asarray(cached[key], dtype=np.int32) for key in keys])
@@ -0,0 +1,49 @@
+""" Progressive decoding of images streamed by DalleBart.generate """
+
+import math
+
+import jax.numpy as jnp
+
+
+def partial_image_codes(
+    sequences, cur_len, placeholder_code: int = 0, completed_rows_only: bool = True
+):
+    """
+    Image codes of sequences yielded by `DalleBart.generate(..., stream=True)`.
+
+    Codes that are not generated yet (or belong to an incomplete row of the image when
+    `completed_rows_only`) are replaced with `placeholder_code`.
+    """
+    # drop decoder start token
+    codes = sequences[:, 1:]
+    num_codes = cur_len - 1
+    if completed_rows_only:
+        row_length = int(math.sqrt(codes.shape[1]))
+        assert row_length**2 == codes.shape[1], "images must be square"
+        num_codes = num_codes // row_length * row_length
+    generated = jnp.arange(codes.shape[1]) < num_codes
+    return jnp.where(generated, codes, placeholder_code)
+
+
+def decode_partial_images(
+    vqgan,
+    vqgan_params,
+    stream_output,
+    placeholder_code: int = 0,
+    completed_rows_only: bool = True,
+):
+    """
+    Renders the rows generated so far with the VQGAN decoder, as images in [0, 1].
+
+    Example:
+        for output in model.generate(**inputs, stream=True, decode_chunk_size=16):
+            previews = decode_partial_images(vqgan, vqgan_params, output)
+    """
+    codes = partial_image_codes(
+        stream_output.sequences,
+        stream_output.cur_len,
+        placeholder_code=placeholder_code,
+        completed_rows_only=completed_rows_only,
+    )
+    images = vqgan.decode_code(codes, params=vqgan_params)
+    return images.clip(0.0, 1.0)
@@ -0,0 +1,40 @@
+import pytest
+
+# small enough for tests to compile and run in seconds on CPU
+TINY_CONFIG = dict(
+    encoder_vocab_size=100,
+    image_vocab_size=64,
+    image_length=16,
+    max_text_length=8,
+    encoder_layers=2,
+    decoder_layers=2,
+    encoder_ffn_dim=32,
+    decoder_ffn_dim=32,
+    encoder_attention_heads=2,
+    decoder_attention_heads=2,
+    d_model=16,
+    dropout=0.0,
+    gradient_checkpointing=False,
+)
+
+
+@pytest.fixture
+def tiny_config():
+    """Builds a tiny `DalleBartConfig`, keyword arguments override the defaults."""
+    from dalle_mini.model import DalleBartConfig
+
+    def make(**kwargs):
+        return DalleBartConfig(**{**TINY_CONFIG, **kwargs})
+
+    return make
+
+
+@pytest.fixture
+def tiny_model(tiny_config):
+    """Builds a `DalleBart` with random params from `tiny_config(**kwargs)`."""
+    from dalle_mini.model import DalleBart
+
+    def make(seed=0, **kwargs):
+        return DalleBart(tiny_config(**kwargs), seed=seed)
+
+    return make
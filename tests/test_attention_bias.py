@@ -0,0 +1,77 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+from flax.linen import combine_masks, make_attention_mask, make_causal_mask
+from jax import lax
+
+from dalle_mini.model.modeling import make_attention_bias
+
+ATTENTION_MASK = jnp.array([[1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 0, 0]])
+
+
+def select_bias(mask):
+    """Bias of the previous implementation, selected per layer from the full mask."""
+    return lax.select(
+        mask > 0,
+        jnp.full(mask.shape, 0.0),
+        jnp.full(mask.shape, -jnp.inf),
+    )
+
+
+def test_padding_bias():
+    expected = select_bias(make_attention_mask(jnp.ones((2, 6)), ATTENTION_MASK))
+    bias = make_attention_bias(ATTENTION_MASK)
+    assert bias.shape == (2, 1, 1, 6)
+    np.testing.assert_array_equal(jnp.broadcast_to(bias, expected.shape), expected)
+    assert make_attention_bias(None) is None
+
+
+def test_causal_bias():
+    expected = select_bias(
+        combine_masks(
+            make_causal_mask(ATTENTION_MASK),
+            make_attention_mask(jnp.ones((2, 6)), ATTENTION_MASK),
+        )
+    )
+    bias = make_attention_bias(ATTENTION_MASK, causal=True, query_length=6)
+    np.testing.assert_array_equal(bias, expected)
+
+
+@pytest.mark.parametrize("cache_index", [jnp.array(2), jnp.array([2, 4])])
+def test_cached_decoding_bias(cache_index):
+    # a single query at `cache_index` attends to the positions cached so far
+    kv_length = 8
+    attention_mask = jnp.ones((2, kv_length))
+    bias = make_attention_bias(
+        attention_mask,
+        causal=True,
+        query_length=1,
+        cache_index=cache_index,
+        kv_length=kv_length,
+    )
+    cache_index = jnp.broadcast_to(cache_index, (2,))
+    cached = jnp.arange(kv_length) <= cache_index[:, None]
+    expected = select_bias(cached[:, None, None, :])
+    np.testing.assert_array_equal(jnp.broadcast_to(bias, expected.shape), expected)
+
+
+def test_masked_positions_do_not_change_logits(tiny_model):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 6), 0, 100)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 16), 0, 64)
+    logits = model(
+        input_ids, ATTENTION_MASK, decoder_input_ids=decoder_input_ids
+    ).logits
+    # padded prompt tokens and future image tokens are never attended to
+    other_logits = model(
+        input_ids.at[1, 4:].set(7),
+        ATTENTION_MASK,
+        decoder_input_ids=decoder_input_ids.at[:, 10:].set(3),
+    ).logits
+    np.testing.assert_allclose(other_logits[:, :10], logits[:, :10], atol=1e-6)
+    assert not np.allclose(other_logits[:, 10:], logits[:, 10:])
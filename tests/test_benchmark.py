@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("tokenizers")
+pytest.importorskip("dalle_mini")
+
+BENCHMARK_SCRIPT = os.path.join(
+    os.path.dirname(__file__), "..", "tools", "benchmark", "benchmark_generation.py"
+)
+
+
+def test_benchmark_generation(tmp_path):
+    output_file = str(tmp_path / "results.json")
+    # tiny model, see `TINY_CONFIG`
+    args = (
+        "--d_model 16 --image_vocab_size 64 --image_length 16 --max_text_length 8 "
+        "--batch_sizes 1 2 --condition_scales 1.0 3.0 --num_iterations 2 "
+        "--cache_options default uncond_cache --no_measure_ttft"
+    ).split()
+    subprocess.run(
+        [sys.executable, BENCHMARK_SCRIPT, *args, "--output_file", output_file],
+        check=True,
+        capture_output=True,
+    )
+    with open(output_file) as f:
+        results = json.load(f)["results"]
+    # "uncond_cache" is the same as "default" without super conditioning
+    assert [
+        (r["cache_option"], r["batch_size"], r["condition_scale"]) for r in results
+    ] == [
+        ("default", 1, 1.0),
+        ("default", 1, 3.0),
+        ("default", 2, 1.0),
+        ("default", 2, 3.0),
+        ("uncond_cache", 1, 3.0),
+        ("uncond_cache", 2, 3.0),
+    ]
+    for result in results:
+        assert result["time_to_first_token"] is None
+        assert result["tokens_per_second"] > 0
+        assert 0 < result["latency_p50"] <= result["latency_p99"]
+        assert result["peak_host_rss_bytes"] > 0
@@ -0,0 +1,147 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+
+from dalle_mini.model import DalleBart
+from dalle_mini.model.modeling import (
+    blockwise_dot_product_attention,
+    dot_product_attention_weights,
+)
+
+
+def reference_attention(query, key, value, mask=None, embed_pos=None, tau=None):
+    bias = None
+    if mask is not None:
+        bias = jnp.where(mask, 0.0, -jnp.inf)
+    weights = dot_product_attention_weights(
+        query,
+        key,
+        bias=bias,
+        mask=mask,
+        embed_pos=embed_pos,
+        deterministic=True,
+        tau=tau,
+    )
+    return jnp.einsum("...hqk,...khd->...qhd", weights, value)
+
+
+@pytest.mark.parametrize("block_size", [1, 5, 16, 64])
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("tau", [None, 0.05])
+def test_blockwise_attention_parity(block_size, causal, tau):
+    batch, q_length, kv_length, heads, depth = 2, 16, 16, 3, 8
+    keys = jax.random.split(jax.random.PRNGKey(0), 5)
+    query = jax.random.normal(keys[0], (batch, q_length, heads, depth))
+    key = jax.random.normal(keys[1], (batch, kv_length, heads, depth))
+    value = jax.random.normal(keys[2], (batch, kv_length, heads, depth))
+    if tau is not None:
+        # cosine attention
+        query = query / jnp.linalg.norm(query, axis=-1, keepdims=True)
+        key = key / jnp.linalg.norm(key, axis=-1, keepdims=True)
+    embed_pos = jax.random.normal(keys[3], (1, heads, q_length, kv_length))
+    # padded keys
+    mask = jnp.ones((batch, 1, q_length, kv_length), dtype=jnp.bool_)
+    mask = mask.at[1, ..., -3:].set(False)
+    if causal:
+        mask = mask & jnp.tril(jnp.ones((q_length, kv_length), dtype=jnp.bool_))
+
+    expected = reference_attention(query, key, value, mask, embed_pos, tau)
+    output = blockwise_dot_product_attention(
+        query, key, value, mask, embed_pos, block_size=block_size, tau=tau
+    )
+    np.testing.assert_allclose(output, expected, atol=1e-5, rtol=1e-5)
+
+    # gradients
+    def loss(fn, *args, **kwargs):
+        return lambda q, k, v: jnp.sum(jnp.sin(fn(q, k, v, *args, **kwargs)))
+
+    expected_grads = jax.grad(
+        loss(reference_attention, mask, embed_pos, tau), argnums=(0, 1, 2)
+    )(query, key, value)
+    grads = jax.grad(
+        loss(
+            blockwise_dot_product_attention,
+            mask,
+            embed_pos,
+            block_size=block_size,
+            tau=tau,
+        ),
+        argnums=(0, 1, 2),
+    )(query, key, value)
+    for grad, expected_grad in zip(grads, expected_grads):
+        np.testing.assert_allclose(grad, expected_grad, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize(
+    "variant",
+    [
+        {},
+        {"use_head_scale": True, "use_scan": False},
+        {"use_cosine_attention": True},
+        {
+            "ln_positions": "swinv2",
+            "use_swin_position_embeddings": True,
+            "use_cosine_attention": True,
+        },
+    ],
+)
+def test_blockwise_attention_model_parity(variant, tiny_model, tiny_config):
+    model = tiny_model(**variant)
+    blockwise_model = DalleBart(
+        tiny_config(attention_block_size=4, **variant), _do_init=False
+    )
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+    attention_mask = jnp.ones_like(input_ids).at[1, -2:].set(0)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 16), 0, 64)
+    inputs = dict(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        decoder_input_ids=decoder_input_ids,
+    )
+
+    expected = model(**inputs, params=model.params).logits
+    logits = blockwise_model(**inputs, params=model.params).logits
+    np.testing.assert_allclose(logits, expected, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("broadcast_dropout", [True, False])
+def test_blockwise_attention_dropout(broadcast_dropout):
+    batch, length, heads, depth, block_size = 2, 10, 3, 8, 4
+    keys = jax.random.split(jax.random.PRNGKey(0), 4)
+    query = jax.random.normal(keys[0], (batch, length, heads, depth))
+    key = jax.random.normal(keys[1], (batch, length, heads, depth))
+    value = jax.random.normal(keys[2], (batch, length, heads, depth))
+    dropout_rng, dropout_rate = keys[3], 0.3
+
+    # dropout masks of each block of keys
+    shape = (1, 1) if broadcast_dropout else (batch, heads)
+    keep = jnp.concatenate(
+        [
+            jax.random.bernoulli(
+                jax.random.fold_in(dropout_rng, i),
+                1.0 - dropout_rate,
+                shape + (length, block_size),
+            )
+            for i in range(-(-length // block_size))
+        ],
+        axis=-1,
+    )[..., :length]
+    weights = dot_product_attention_weights(query, key, deterministic=True)
+    weights = weights * keep / (1.0 - dropout_rate)
+    expected = jnp.einsum("...hqk,...khd->...qhd", weights, value)
+
+    output = blockwise_dot_product_attention(
+        query,
+        key,
+        value,
+        block_size=block_size,
+        dropout_rng=dropout_rng,
+        dropout_rate=dropout_rate,
+        broadcast_dropout=broadcast_dropout,
+    )
+    np.testing.assert_allclose(output, expected, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+
+from dalle_mini.model import CompiledGenerator, DalleBart
+
+GENERATE_SCRIPT = """
+import json
+import sys
+
+import jax
+import jax.numpy as jnp
+
+from dalle_mini.model import CompiledGenerator, DalleBart, DalleBartConfig
+
+config_file, cache_dir = sys.argv[1:]
+model = DalleBart(DalleBartConfig.from_json_file(config_file), seed=0)
+generator = CompiledGenerator(
+    model, model.params, cache_dir=cache_dir, batch_sizes=(2,), top_k=4
+)
+input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+sequences = generator(input_ids, jnp.ones_like(input_ids), jax.random.PRNGKey(0))
+print(json.dumps({"metrics": generator.metrics, "sequences": sequences.tolist()}))
+"""
+
+
+def generate_in_new_process(config_file, cache_dir):
+    env = dict(os.environ)
+    # executables can only be serialized by the XLA runtime on CPU
+    env["XLA_FLAGS"] = f"{env.get('XLA_FLAGS', '')} --xla_cpu_use_xla_runtime=true"
+    output = subprocess.run(
+        [sys.executable, "-c", GENERATE_SCRIPT, config_file, cache_dir],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_compiled_generator_loads_from_cache_dir(tmp_path, tiny_config):
+    config_file = str(tmp_path / "config.json")
+    tiny_config().to_json_file(config_file)
+    cache_dir = str(tmp_path / "cache")
+
+    expected = generate_in_new_process(config_file, cache_dir)
+    assert expected["metrics"] == {"loaded": 0, "compiled": 1}
+    assert len(os.listdir(cache_dir)) == 1
+
+    # a new process loads the executable from disk instead of compiling it
+    output = generate_in_new_process(config_file, cache_dir)
+    assert output["metrics"] == {"loaded": 1, "compiled": 0}
+    assert output["sequences"] == expected["sequences"]
+
+
+def test_cache_key_depends_on_dtype(tiny_model):
+    model = tiny_model()
+    generator = CompiledGenerator(model, model.params)
+    params_fp16 = jax.tree_util.tree_map(lambda x: x.astype(jnp.float16), model.params)
+    assert CompiledGenerator(model, params_fp16).cache_key(1) != generator.cache_key(1)
+    model_fp16 = DalleBart(model.config, dtype=jnp.float16, _do_init=False)
+    assert CompiledGenerator(model_fp16, model.params).cache_key(1) != (
+        generator.cache_key(1)
+    )
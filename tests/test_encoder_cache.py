@@ -0,0 +1,117 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+from transformers.modeling_flax_outputs import FlaxBaseModelOutput
+
+from dalle_mini.model import EncoderCache
+
+
+class FakeEncoder:
+    """Stands for `_prepare_encoder_decoder_kwargs_for_generation`, counting rows."""
+
+    def __init__(self):
+        self.num_rows = 0
+
+    def __call__(self, input_ids, params, model_kwargs):
+        self.num_rows += input_ids.shape[0]
+        hidden_states = input_ids[..., None] * params["w"]
+        return {
+            **model_kwargs,
+            "encoder_outputs": FlaxBaseModelOutput(last_hidden_state=hidden_states),
+        }
+
+
+def encode(cache, encoder, input_ids, params):
+    input_ids = jnp.asarray(input_ids)
+    return cache.prepare_encoder_kwargs(
+        encoder, input_ids, params, {"attention_mask": jnp.ones_like(input_ids)}
+    )["encoder_outputs"].last_hidden_state
+
+
+# each row of 4 tokens has hidden states of 4 * 2 float32
+ROW_BYTES = 32
+PARAMS = {"w": jnp.ones(2)}
+
+
+def test_device_hits_and_deduplicated_rows():
+    cache, encoder = EncoderCache(), FakeEncoder()
+    input_ids = np.array([[1, 2, 3, 4], [5, 6, 7, 8], [1, 2, 3, 4]])
+    expected = FakeEncoder()(jnp.asarray(input_ids), PARAMS, {})["encoder_outputs"]
+    # identical rows are encoded once (padded to a power of 2)
+    hidden_states = encode(cache, encoder, input_ids, PARAMS)
+    np.testing.assert_array_equal(hidden_states, expected.last_hidden_state)
+    assert encoder.num_rows == 2
+    assert cache.metrics["misses"] == 2
+
+    hidden_states = encode(cache, encoder, input_ids[::-1], PARAMS)
+    np.testing.assert_array_equal(hidden_states, expected.last_hidden_state[::-1])
+    assert encoder.num_rows == 2
+    assert cache.metrics["hits"] == 2
+
+
+def test_host_demotion_and_promotion():
+    cache, encoder = EncoderCache(max_device_bytes=ROW_BYTES), FakeEncoder()
+    encode(cache, encoder, [[1, 2, 3, 4]], PARAMS)
+    # the first row is moved to host to make room for the second one
+    encode(cache, encoder, [[5, 6, 7, 8]], PARAMS)
+    assert len(cache._device) == 1 and len(cache._host) == 1
+
+    hidden_states = encode(cache, encoder, [[1, 2, 3, 4]], PARAMS)
+    np.testing.assert_array_equal(hidden_states[0, :, 0], [1, 2, 3, 4])
+    assert cache.metrics["host_hits"] == 1
+    assert encoder.num_rows == 2
+    assert len(cache._device) == 1 and len(cache._host) == 1
+
+
+def test_host_eviction():
+    cache = EncoderCache(max_device_bytes=ROW_BYTES, max_host_bytes=ROW_BYTES)
+    encoder = FakeEncoder()
+    for i in range(3):
+        encode(cache, encoder, [[i, i, i, i]], PARAMS)
+    assert cache.metrics["evictions"] == 1
+    encode(cache, encoder, [[0, 0, 0, 0]], PARAMS)
+    assert encoder.num_rows == 4
+
+
+def test_entries_larger_than_device_memory():
+    # entries go straight to host memory and are still returned on hits
+    cache, encoder = EncoderCache(max_device_bytes=0), FakeEncoder()
+    for _ in range(2):
+        hidden_states = encode(cache, encoder, [[1, 2, 3, 4]], PARAMS)
+        np.testing.assert_array_equal(hidden_states[0, :, 0], [1, 2, 3, 4])
+    assert cache.metrics["host_hits"] == 1
+    assert encoder.num_rows == 1
+
+
+def test_params_fingerprint_invalidation():
+    cache, encoder = EncoderCache(), FakeEncoder()
+    encode(cache, encoder, [[1, 2, 3, 4]], PARAMS)
+    encode(cache, encoder, [[1, 2, 3, 4]], {"w": jnp.ones(2)})
+    # same values: same fingerprint
+    assert encoder.num_rows == 1
+    hidden_states = encode(cache, encoder, [[1, 2, 3, 4]], {"w": jnp.full(2, 2.0)})
+    assert encoder.num_rows == 2
+    np.testing.assert_array_equal(hidden_states[0, :, 0], [2, 4, 6, 8])
+
+
+def test_generate_with_encoder_cache(tiny_model):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+    kwargs = dict(
+        input_ids=input_ids,
+        input_ids_uncond=jnp.zeros_like(input_ids),
+        prng_key=jax.random.PRNGKey(0),
+        condition_scale=3.0,
+    )
+    expected = model.generate(**kwargs).sequences
+    cache = EncoderCache(max_device_bytes=0)
+    for _ in range(2):
+        sequences = model.generate(**kwargs, encoder_cache=cache).sequences
+        np.testing.assert_array_equal(sequences, expected)
+    # 2 prompts and the shared unconditional prompt
+    assert cache.metrics["misses"] == 3 and cache.metrics["host_hits"] == 3
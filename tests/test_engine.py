@@ -0,0 +1,72 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+
+from dalle_mini.model import ContinuousBatchingEngine
+
+
+def run_engine(model, input_ids, cancelled=(), **kwargs):
+    input_ids_uncond = jnp.zeros_like(input_ids[:1])
+    engine = ContinuousBatchingEngine(
+        model,
+        model.params,
+        num_slots=2,
+        steps_per_sync=4,
+        condition_scale=3.0,
+        top_k=1,
+        input_ids_uncond=input_ids_uncond,
+        attention_mask_uncond=jnp.ones_like(input_ids_uncond),
+        **kwargs,
+    )
+    request_ids = [engine.submit(ids) for ids in input_ids]
+    for i in cancelled:
+        assert engine.cancel(request_ids[i])
+    results = engine.run()
+    return [results.get(request_id) for request_id in request_ids]
+
+
+def expected_sequences(model, input_ids):
+    # with top_k=1 sampling does not depend on the PRNG key of each request
+    return model.generate(
+        input_ids,
+        input_ids_uncond=jnp.zeros_like(input_ids),
+        prng_key=jax.random.PRNGKey(0),
+        condition_scale=3.0,
+        top_k=1,
+    ).sequences
+
+
+def test_engine_matches_generate(tiny_model):
+    model = tiny_model()
+    # more requests than slots: slots are reused once requests complete
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (3, 8), 0, 100)
+    expected = expected_sequences(model, input_ids)
+    for sequence, expected_sequence in zip(run_engine(model, input_ids), expected):
+        np.testing.assert_array_equal(sequence, expected_sequence)
+
+
+def test_engine_cancel(tiny_model):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (3, 8), 0, 100)
+    expected = expected_sequences(model, input_ids)
+    sequences = run_engine(model, input_ids, cancelled=[1])
+    assert sequences[1] is None
+    np.testing.assert_array_equal(sequences[0], expected[0])
+    np.testing.assert_array_equal(sequences[2], expected[2])
+
+
+@pytest.mark.parametrize("num_pages", [None, 6])
+def test_paged_engine_matches_generate(num_pages, tiny_model):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (3, 8), 0, 100)
+    expected = expected_sequences(model, input_ids)
+    # 6 pages of 4 positions do not fit 2 sequences of 16 positions: requests are
+    # preempted and restarted
+    sequences = run_engine(model, input_ids, page_size=4, num_pages=num_pages)
+    for sequence, expected_sequence in zip(sequences, expected):
+        np.testing.assert_array_equal(sequence, expected_sequence)
@@ -0,0 +1,45 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+from flax.core.frozen_dict import unfreeze
+from flax.traverse_util import flatten_dict
+
+from dalle_mini.model.fused_qkv import pack_qkv, unpack_qkv
+
+
+def test_pack_qkv_roundtrip():
+    keys = jax.random.split(jax.random.PRNGKey(0), 3)
+    qkv = [jax.random.normal(key, (4, 16)) for key in keys]
+    packed = pack_qkv(*qkv, num_heads=2)
+    assert packed.shape == (4, 48)
+    for x, y in zip(unpack_qkv(packed, num_heads=2), qkv):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_fused_qkv_matches_separate_projections(tiny_model):
+    model = tiny_model()
+    params = model.params
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+    attention_mask = jnp.ones_like(input_ids)
+    kwargs = dict(prng_key=jax.random.PRNGKey(0), top_k=4, condition_scale=3.0)
+    kwargs.update(input_ids_uncond=jnp.zeros_like(input_ids))
+    expected = model.generate(input_ids, attention_mask, params=params, **kwargs)
+
+    fused_params = model.fuse_qkv(params)
+    paths = flatten_dict(fused_params)
+    assert any("qkv_proj" in path for path in paths)
+    # cross-attention keeps separate projections
+    assert any("q_proj" in path for path in paths)
+    sequences = model.generate(input_ids, attention_mask, params=fused_params, **kwargs)
+    np.testing.assert_array_equal(sequences.sequences, expected.sequences)
+
+    unfused_params = flatten_dict(unfreeze(model.unfuse_qkv(fused_params)))
+    params = flatten_dict(unfreeze(params))
+    assert unfused_params.keys() == params.keys()
+    for path, value in params.items():
+        np.testing.assert_array_equal(unfused_params[path], value)
@@ -0,0 +1,205 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+from flax.core.frozen_dict import unfreeze
+from flax.traverse_util import flatten_dict
+
+
+def prompts(batch_size=2, uncond=True):
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (batch_size, 8), 0, 100)
+    inputs = {"input_ids": input_ids, "attention_mask": jnp.ones_like(input_ids)}
+    if uncond:
+        inputs["input_ids_uncond"] = jnp.zeros_like(input_ids)
+        inputs["attention_mask_uncond"] = jnp.ones_like(input_ids)
+    return inputs
+
+
+def generate(model, **kwargs):
+    kwargs = {"prng_key": jax.random.PRNGKey(3), "top_k": 4, **prompts(), **kwargs}
+    return np.asarray(model.generate(**kwargs).sequences)
+
+
+def test_fuse_uncond(tiny_model):
+    model = tiny_model()
+    expected = generate(model, condition_scale=3.0)
+    sequences = generate(model, condition_scale=3.0, fuse_uncond=True)
+    np.testing.assert_array_equal(sequences, expected)
+    # without super conditioning there is nothing to fuse
+    np.testing.assert_array_equal(
+        generate(model, fuse_uncond=True), generate(model, fuse_uncond=False)
+    )
+
+
+@pytest.mark.parametrize("fuse_uncond", [False, True])
+def test_uncond_cache(fuse_uncond, tiny_model):
+    model = tiny_model()
+    inputs = prompts()
+    expected = generate(model, condition_scale=3.0)
+    uncond_cache = model.init_uncond_cache(
+        inputs.pop("input_ids_uncond"), inputs.pop("attention_mask_uncond")
+    )
+    # a single unconditional prompt is shared by every row
+    assert uncond_cache["encoder_outputs"].last_hidden_state.shape[0] == 1
+    sequences = model.generate(
+        **inputs,
+        uncond_cache=uncond_cache,
+        fuse_uncond=fuse_uncond,
+        condition_scale=3.0,
+        prng_key=jax.random.PRNGKey(3),
+        top_k=4,
+    ).sequences
+    np.testing.assert_array_equal(sequences, expected)
+
+
+@pytest.mark.parametrize("use_cross_attention_cache", [False, True])
+def test_cross_attention_cache(use_cross_attention_cache, tiny_model):
+    model = tiny_model()
+    inputs = prompts(uncond=False)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 16), 0, 64)
+    expected = model(**inputs, decoder_input_ids=decoder_input_ids).logits
+
+    encoder_outputs = model.encode(**inputs)
+    cross_attention_cache = None
+    if use_cross_attention_cache:
+        cross_attention_cache = model.init_cross_attention_cache(
+            encoder_outputs, inputs["attention_mask"]
+        )
+    model_inputs = model.prepare_inputs_for_generation(
+        decoder_input_ids[:, :1],
+        17,
+        attention_mask=inputs["attention_mask"],
+        encoder_outputs=encoder_outputs,
+        cross_attention_cache=cross_attention_cache,
+    )
+    past_key_values = model_inputs["past_key_values"]
+    cached_keys = [k[-1] for k in flatten_dict(unfreeze(past_key_values))]
+    assert ("cached_cross_key" in cached_keys) == use_cross_attention_cache
+    logits = []
+    for i in range(16):
+        outputs = model.decode(
+            decoder_input_ids[:, i : i + 1],
+            encoder_outputs,
+            encoder_attention_mask=inputs["attention_mask"],
+            past_key_values=past_key_values,
+            decoder_position_ids=jnp.full((2, 1), i),
+        )
+        past_key_values = outputs.past_key_values
+        logits.append(outputs.logits)
+    np.testing.assert_allclose(jnp.concatenate(logits, axis=1), expected, atol=1e-5)
+
+
+def test_per_row_sampling(tiny_model):
+    model = tiny_model()
+    settings = [
+        dict(condition_scale=3.0, top_k=4, top_p=0.9, temperature=0.7),
+        dict(condition_scale=1.0, top_k=8, top_p=1.0, temperature=1.3),
+    ]
+    sequences = generate(
+        model,
+        per_row_sampling=True,
+        **{k: jnp.array([s[k] for s in settings]) for k in settings[0]},
+    )
+    # each row samples the same tokens as the static warpers with its settings
+    for i, kwargs in enumerate(settings):
+        np.testing.assert_array_equal(sequences[i], generate(model, **kwargs)[i])
+
+
+def test_stream(tiny_model):
+    from dalle_mini.model.streaming import partial_image_codes
+
+    model = tiny_model()
+    expected = generate(model, condition_scale=3.0)
+    outputs = list(
+        model.generate(
+            **prompts(),
+            condition_scale=3.0,
+            prng_key=jax.random.PRNGKey(3),
+            top_k=4,
+            stream=True,
+            decode_chunk_size=5,
+        )
+    )
+    assert [int(output.cur_len) for output in outputs] == [6, 11, 16, 17]
+    for output in outputs:
+        # tokens generated so far are final, the others are padding
+        cur_len = int(output.cur_len)
+        sequences = np.asarray(output.sequences)
+        np.testing.assert_array_equal(sequences[:, :cur_len], expected[:, :cur_len])
+        assert (sequences[:, cur_len:] == model.config.pad_token_id).all()
+    # only complete rows of 4 codes are kept
+    codes = partial_image_codes(outputs[1].sequences, outputs[1].cur_len, -1)
+    np.testing.assert_array_equal(codes[:, :8], expected[:, 1:9])
+    assert (codes[:, 8:] == -1).all()
+
+
+def test_cancel_mask(tiny_model):
+    model = tiny_model()
+    expected = generate(model, condition_scale=3.0)
+    cancel_mask = np.zeros(2, dtype=bool)
+
+    def cancel_second_row(output):
+        cancel_mask[1] = True
+
+    sequences = generate(
+        model,
+        condition_scale=3.0,
+        decode_chunk_size=5,
+        cancel_mask=cancel_mask,
+        chunk_callback=cancel_second_row,
+    )
+    np.testing.assert_array_equal(sequences[0], expected[0])
+    # the cancelled row keeps the tokens of the first chunk and is padded afterwards
+    np.testing.assert_array_equal(sequences[1, :6], expected[1, :6])
+    assert (sequences[1, 6:] == model.config.pad_token_id).all()
+
+    # decoding stops once every row is cancelled
+    outputs = []
+    sequences = generate(
+        model,
+        decode_chunk_size=5,
+        cancel_mask=np.ones(2, dtype=bool),
+        chunk_callback=outputs.append,
+    )
+    assert len(outputs) == 1
+    assert (sequences[:, 1:] == model.config.pad_token_id).all()
+
+
+@pytest.mark.parametrize("decode_chunk_size", [1, 5, 16])
+def test_chunk_callback(decode_chunk_size, tiny_model):
+    model = tiny_model()
+    expected = generate(model, condition_scale=3.0)
+    outputs = []
+    sequences = generate(
+        model,
+        condition_scale=3.0,
+        decode_chunk_size=decode_chunk_size,
+        chunk_callback=outputs.append,
+    )
+    np.testing.assert_array_equal(sequences, expected)
+    # one call per chunk, the last chunk may be shorter
+    assert [int(output.cur_len) for output in outputs] == [
+        min(1 + decode_chunk_size * (i + 1), 17) for i in range(len(outputs))
+    ]
+    assert int(outputs[-1].cur_len) == 17
+    np.testing.assert_array_equal(outputs[-1].sequences, expected)
+    assert all(output.tokens_per_second > 0 for output in outputs)
+    elapsed_time = [output.elapsed_time for output in outputs]
+    assert elapsed_time == sorted(elapsed_time)
+
+
+@pytest.mark.parametrize("fuse_uncond", [False, True])
+def test_num_return_sequences(fuse_uncond, tiny_model):
+    model = tiny_model()
+    # the same as repeating every prompt, with a single encoder pass per prompt
+    repeated = {k: jnp.repeat(v, 3, axis=0) for k, v in prompts().items()}
+    expected = generate(model, condition_scale=3.0, **repeated)
+    sequences = generate(
+        model, condition_scale=3.0, fuse_uncond=fuse_uncond, num_return_sequences=3
+    )
+    assert sequences.shape == (6, 17)
+    np.testing.assert_array_equal(sequences, expected)
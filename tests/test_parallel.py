@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+# runs in a new process so that the host platform can be split into 4 CPU devices
+SHARDED_GENERATE_SCRIPT = """
+import json
+import sys
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax.traverse_util import flatten_dict
+
+from dalle_mini.model import DalleBart, DalleBartConfig, ShardedGenerator
+
+# random bits do not depend on the mesh, see `ShardedGenerator`
+jax.config.update("jax_threefry_partitionable", True)
+
+config_file, mp_devices, condition_scale = sys.argv[1:]
+model = DalleBart(DalleBartConfig.from_json_file(config_file), seed=0)
+kwargs = dict(condition_scale=float(condition_scale), top_k=4)
+generator = ShardedGenerator(model, model.params, mp_devices=int(mp_devices), **kwargs)
+input_ids = jax.random.randint(jax.random.PRNGKey(1), (4, 8), 0, 100)
+inputs = [input_ids, jnp.ones_like(input_ids), jnp.zeros_like(input_ids), jnp.ones_like(input_ids)]
+prng_key = jax.random.PRNGKey(3)
+sequences = generator(inputs[0], inputs[1], prng_key, *inputs[2:])
+expected = model.generate(
+    **dict(zip(["input_ids", "attention_mask", "input_ids_uncond", "attention_mask_uncond"], inputs)),
+    prng_key=prng_key,
+    **kwargs,
+).sequences
+q_proj = [v for k, v in flatten_dict(generator.params).items() if "q_proj" in k][0]
+print(
+    json.dumps(
+        {
+            "device_count": jax.device_count(),
+            "mesh_shape": list(generator.mesh.devices.shape),
+            "equal": bool(np.array_equal(sequences, expected)),
+            "q_proj_shard_size": q_proj.addressable_shards[0].data.size / q_proj.size,
+        }
+    )
+)
+"""
+
+
+@pytest.mark.parametrize("mp_devices", [1, 2, 4])
+@pytest.mark.parametrize("condition_scale", [1.0, 3.0])
+def test_sharded_generator(mp_devices, condition_scale, tmp_path, tiny_config):
+    config_file = str(tmp_path / "config.json")
+    tiny_config().to_json_file(config_file)
+    env = dict(os.environ)
+    env[
+        "XLA_FLAGS"
+    ] = f"{env.get('XLA_FLAGS', '')} --xla_force_host_platform_device_count=4"
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            SHARDED_GENERATE_SCRIPT,
+            config_file,
+            str(mp_devices),
+            str(condition_scale),
+        ],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    output = json.loads(output.splitlines()[-1])
+    assert output["device_count"] == 4
+    assert output["mesh_shape"] == [4 // mp_devices, mp_devices]
+    # sharded params and batch give the same sequences as a single device
+    assert output["equal"]
+    assert output["q_proj_shard_size"] == 1 / mp_devices
@@ -0,0 +1,70 @@
+import base64
+from io import BytesIO
+
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("PIL")
+pytest.importorskip("dalle_mini")
+
+import numpy as np
+from PIL import Image
+
+from dalle_mini.model.postprocessing import ImagePostprocessor
+
+
+class FakeVQGAN:
+    """Decodes 16 codes into a 4x4 image with one color per code."""
+
+    def decode_code(self, codes, params):
+        colors = params["embedding"][codes]
+        return colors.reshape(codes.shape[0], 4, 4, 3)
+
+
+VQGAN_PARAMS = {
+    # values out of [0, 1] are clipped
+    "embedding": jax.random.uniform(
+        jax.random.PRNGKey(0), (64, 3), minval=-0.2, maxval=1.2
+    )
+}
+
+
+def sequences(num_images):
+    codes = jax.random.randint(jax.random.PRNGKey(1), (num_images, 17), 0, 64)
+    return np.asarray(codes)
+
+
+def expected_images(sequences):
+    colors = np.asarray(VQGAN_PARAMS["embedding"])[sequences[:, 1:]]
+    images = (colors.clip(0.0, 1.0) * 255).astype(np.uint8)
+    return images.reshape(-1, 4, 4, 3)
+
+
+@pytest.mark.parametrize("decode_batch_size", [None, 1, 3, 8])
+def test_batched_decode(decode_batch_size):
+    postprocessor = ImagePostprocessor(
+        FakeVQGAN(), VQGAN_PARAMS, decode_batch_size=decode_batch_size
+    )
+    with postprocessor:
+        # the last batch is padded, leading device dimensions are flattened
+        images = postprocessor.decode(sequences(5))
+        np.testing.assert_array_equal(images, expected_images(sequences(5)))
+        images = postprocessor.decode(sequences(6).reshape(2, 3, 17))
+        np.testing.assert_array_equal(images, expected_images(sequences(6)))
+
+
+@pytest.mark.parametrize("base64_encode", [False, True])
+def test_encoded_images(base64_encode):
+    with ImagePostprocessor(
+        FakeVQGAN(), VQGAN_PARAMS, decode_batch_size=2, base64_encode=base64_encode
+    ) as postprocessor:
+        # the next batch can be submitted before the first one is done
+        pending = [postprocessor.submit(sequences(n)) for n in [3, 5]]
+        for n, future in zip([3, 5], pending):
+            encoded = future.result()
+            assert len(encoded) == n
+            if base64_encode:
+                encoded = [base64.b64decode(image) for image in encoded]
+            # png is lossless
+            images = np.stack([np.asarray(Image.open(BytesIO(x))) for x in encoded])
+            np.testing.assert_array_equal(images, expected_images(sequences(n)))
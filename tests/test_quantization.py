@@ -0,0 +1,82 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+from flax.traverse_util import flatten_dict
+
+from dalle_mini.model import DalleBart
+from dalle_mini.model.quantization import dequantize_kernel, quantize_kernel
+
+
+@pytest.mark.parametrize("quantization", ["int8", "int4"])
+def test_dequantized_kernel_error(quantization):
+    kernel = jax.random.normal(jax.random.PRNGKey(0), (2, 64, 8))
+    q, scale = quantize_kernel(kernel, quantization, group_size=16)
+    assert q.dtype == jnp.int8
+    if quantization == "int4":
+        # two values per int8, one scale per group of 16 input channels
+        assert q.shape == (2, 32, 8) and scale.shape == (2, 4, 8)
+    dequantized = dequantize_kernel(q, scale, quantization)
+    assert dequantized.shape == kernel.shape
+    # rounding error is at most half a quantization step
+    if quantization == "int8":
+        step = scale[..., None, :]
+    else:
+        step = jnp.repeat(scale, 16, axis=-2)
+    assert (jnp.abs(dequantized - kernel) <= step / 2 + 1e-6).all()
+
+
+@pytest.mark.parametrize("quantization,atol", [("int8", 0.01), ("int4", 0.1)])
+def test_quantized_model_logits(quantization, atol, tiny_config):
+    model = DalleBart(tiny_config(), seed=0)
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 16), 0, 64)
+    expected = model(input_ids, decoder_input_ids=decoder_input_ids).logits
+
+    quantized_model = DalleBart(tiny_config(), _do_init=False)
+    params = quantized_model.quantize(model.params, quantization, group_size=16)
+    assert quantized_model.config.quantization == quantization
+    kernels = [
+        v
+        for k, v in flatten_dict(params).items()
+        if k[-2] == "q_proj" and k[-1] == "kernel"
+    ]
+    assert kernels and all(v.dtype == jnp.int8 for v in kernels)
+    logits = quantized_model(
+        input_ids, decoder_input_ids=decoder_input_ids, params=params
+    ).logits
+    np.testing.assert_allclose(logits, expected, atol=atol)
+
+
+def decode_with_cache(model, input_ids, decoder_input_ids, params):
+    encoder_outputs = model.encode(input_ids, params=params)
+    batch_size, length = decoder_input_ids.shape
+    past_key_values = model.init_cache(batch_size, length, encoder_outputs)
+    logits = []
+    for i in range(length):
+        outputs = model.decode(
+            decoder_input_ids[:, i : i + 1],
+            encoder_outputs,
+            past_key_values=past_key_values,
+            decoder_position_ids=jnp.full((batch_size, 1), i),
+            params=params,
+        )
+        past_key_values = outputs.past_key_values
+        logits.append(outputs.logits)
+    return jnp.concatenate(logits, axis=1)
+
+
+@pytest.mark.parametrize("kv_cache_quantization,atol", [(None, 1e-5), ("int8", 5e-3)])
+def test_kv_cache_quantization_logits(kv_cache_quantization, atol, tiny_model):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 16), 0, 64)
+    expected = model(input_ids, decoder_input_ids=decoder_input_ids).logits
+
+    cached_model = tiny_model(kv_cache_quantization=kv_cache_quantization)
+    logits = decode_with_cache(cached_model, input_ids, decoder_input_ids, model.params)
+    np.testing.assert_allclose(logits, expected, atol=atol)
@@ -0,0 +1,44 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+from flax.traverse_util import flatten_dict
+
+from dalle_mini.model import DalleBart
+
+
+@pytest.mark.parametrize("use_scan", [False, True])
+@pytest.mark.parametrize("remat_policy", [None, "save_attention", "save_dots"])
+def test_remat_policy_gradients(remat_policy, use_scan, tiny_config):
+    model = DalleBart(tiny_config(use_scan=use_scan), seed=0)
+    remat_model = DalleBart(
+        tiny_config(
+            use_scan=use_scan, gradient_checkpointing=True, remat_policy=remat_policy
+        ),
+        _do_init=False,
+    )
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 100)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 16), 0, 64)
+    labels = jax.random.randint(jax.random.PRNGKey(3), (2, 16), 0, 64)
+
+    def loss_fn(model):
+        def loss(params):
+            logits = model(
+                input_ids, decoder_input_ids=decoder_input_ids, params=params
+            ).logits
+            log_probs = jax.nn.log_softmax(logits)
+            return -jnp.take_along_axis(log_probs, labels[..., None], -1).mean()
+
+        return jax.jit(jax.value_and_grad(loss))
+
+    loss, grads = loss_fn(model)(model.params)
+    remat_loss, remat_grads = loss_fn(remat_model)(model.params)
+    np.testing.assert_allclose(remat_loss, loss, rtol=1e-6)
+    grads, remat_grads = flatten_dict(grads), flatten_dict(remat_grads)
+    assert grads.keys() == remat_grads.keys()
+    for k in grads:
+        np.testing.assert_allclose(remat_grads[k], grads[k], atol=1e-6, err_msg=k)
@@ -0,0 +1,104 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("transformers")
+pytest.importorskip("dalle_mini")
+
+import numpy as np
+from transformers import CLIPConfig, FlaxCLIPModel
+
+from dalle_mini.model.reranking import CLIP_IMAGE_MEAN, CLIP_IMAGE_STD, ClipReranker
+
+
+class FakeProcessor:
+    """One token per word, padded to `max_length`, counting encoded prompts."""
+
+    def __init__(self):
+        self.num_prompts = 0
+
+    def __call__(self, text, max_length, **kwargs):
+        self.num_prompts += len(text)
+        rows = [
+            [sum(map(ord, w)) % 48 + 1 for w in t.split()][:max_length] for t in text
+        ]
+        input_ids = np.zeros((len(text), max_length), dtype=np.int32)
+        attention_mask = np.zeros_like(input_ids)
+        for i, row in enumerate(rows):
+            input_ids[i, : len(row)] = row
+            attention_mask[i, : len(row)] = 1
+
+        class Encoding:
+            data = {"input_ids": input_ids, "attention_mask": attention_mask}
+
+        return Encoding()
+
+
+@pytest.fixture
+def clip():
+    config = CLIPConfig(
+        text_config=dict(
+            vocab_size=50,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+        ),
+        vision_config=dict(
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            image_size=8,
+            patch_size=4,
+        ),
+        projection_dim=8,
+    )
+    return FlaxCLIPModel(config, seed=0)
+
+
+PROMPTS = ["a red cat", "a blue dog"]
+# 4 candidates per prompt, already at the CLIP image size
+IMAGES = np.asarray(
+    jax.random.randint(jax.random.PRNGKey(1), (8, 8, 8, 3), 0, 256), dtype=np.uint8
+)
+
+
+def test_scores_match_clip(clip):
+    processor = FakeProcessor()
+    reranker = ClipReranker(clip, clip.params, processor, batch_size=3)
+    scores = reranker.score(PROMPTS, IMAGES)
+
+    text = processor(text=PROMPTS, max_length=77).data
+    pixel_values = (IMAGES / 255.0 - np.array(CLIP_IMAGE_MEAN)) / np.array(
+        CLIP_IMAGE_STD
+    )
+    logits = clip(
+        input_ids=text["input_ids"],
+        attention_mask=text["attention_mask"],
+        pixel_values=pixel_values.transpose(0, 3, 1, 2).astype(np.float32),
+    ).logits_per_text
+    expected = [logits[i, 4 * i : 4 * (i + 1)] for i in range(len(PROMPTS))]
+    np.testing.assert_allclose(scores, np.stack(expected), rtol=1e-4, atol=1e-4)
+
+    # text features are cached per prompt
+    processor.num_prompts = 0
+    reranker.score(PROMPTS[::-1], IMAGES)
+    reranker.score(PROMPTS + ["a green bird"], IMAGES[:6])
+    assert processor.num_prompts == 1
+
+
+def test_rerank(clip):
+    reranker = ClipReranker(clip, clip.params, FakeProcessor())
+    scores = reranker.score(PROMPTS, IMAGES)
+    indices, top_scores = reranker.rerank(PROMPTS, IMAGES, top_k=2)
+    for prompt_scores, idx, top in zip(scores, indices, top_scores):
+        np.testing.assert_array_equal(idx, np.argsort(-prompt_scores)[:2])
+        np.testing.assert_allclose(top, prompt_scores[idx])
+
+    min_score = np.median(scores)
+    indices, top_scores = reranker.rerank(PROMPTS, IMAGES, min_score=min_score)
+    assert sum(len(idx) for idx in indices) == 4
+    for prompt_scores, idx, top in zip(scores, indices, top_scores):
+        assert set(idx) == set(np.flatnonzero(prompt_scores >= min_score))
+        assert (np.diff(top) <= 0).all()
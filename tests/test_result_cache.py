@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+
+from dalle_mini.model import GenerationResultCache, generate_with_cache
+from dalle_mini.model.processor import DalleBartProcessorBase
+
+
+class FakeTokenizer:
+    """One token per word, padded to `max_length`."""
+
+    def __call__(self, text, return_tensors=None, padding=None, truncation=None, **kw):
+        if isinstance(text, str):
+            text = [text]
+        rows = [
+            ([sum(map(ord, w)) % 90 + 5 for w in t.split()] + [1] * kw["max_length"])[
+                : kw["max_length"]
+            ]
+            for t in text
+        ]
+        input_ids = jnp.array(rows)
+
+        class Encoding:
+            data = {"input_ids": input_ids, "attention_mask": jnp.ones_like(input_ids)}
+
+        return Encoding()
+
+
+GENERATE_KWARGS = dict(condition_scale=3.0, top_k=4)
+
+
+@pytest.fixture
+def processor():
+    return DalleBartProcessorBase(FakeTokenizer(), False, 8)
+
+
+def test_generate_with_cache_per_prompt_keys(tiny_model, processor):
+    model = tiny_model()
+    cache = GenerationResultCache("v1")
+    codes = generate_with_cache(
+        model, processor, ["a cat", "a dog", "a cat"], cache, **GENERATE_KWARGS
+    )
+    assert codes.shape == (3, 16) and codes.dtype == np.int32
+    # duplicated prompts are generated once
+    assert cache.metrics["misses"] == 2 and len(cache) == 2
+    np.testing.assert_array_equal(codes[0], codes[2])
+
+    # codes of a prompt do not depend on the other prompts of the batch
+    other_cache = GenerationResultCache("v1")
+    codes_alone = generate_with_cache(
+        model, processor, ["a bird", "a cat"], other_cache, **GENERATE_KWARGS
+    )
+    np.testing.assert_array_equal(codes_alone[1], codes[0])
+
+    # hits are served from the cache
+    codes_again = generate_with_cache(
+        model, processor, ["a dog", "a cat"], cache, **GENERATE_KWARGS
+    )
+    np.testing.assert_array_equal(codes_again, codes[1::-1])
+    assert cache.metrics["hits"] == 2 and cache.metrics["misses"] == 2
+
+
+def test_memory_tier_eviction():
+    cache = GenerationResultCache("v1", max_entries=2)
+    for i in range(3):
+        cache.put(str(i), np.full(16, i))
+    assert cache.get("0") is None
+    np.testing.assert_array_equal(cache.get("2"), np.full(16, 2))
+    assert cache.metrics["evictions"] == 1 and cache.hit_rate == 0.5
+
+
+def test_disk_tier(tmp_path):
+    cache = GenerationResultCache("v1", max_entries=1, cache_dir=str(tmp_path))
+    for i in range(3):
+        cache.put(str(i), np.full(16, i))
+    # evicted from memory, reloaded from disk
+    np.testing.assert_array_equal(cache.get("0"), np.full(16, 0))
+    assert cache.metrics["disk_hits"] == 1
+
+    # a new process finds the files, the least recently used ones are deleted
+    cache = GenerationResultCache("v1", cache_dir=str(tmp_path), max_disk_entries=2)
+    assert cache.metrics["disk_evictions"] == 1
+    assert len(os.listdir(tmp_path)) == 2
+    np.testing.assert_array_equal(cache.get("2"), np.full(16, 2))
+
+    # unreadable files are misses
+    with open(tmp_path / f"{cache.key('x', [1], 0)}.npy", "w") as f:
+        f.write("not an array")
+    assert cache.get(cache.key("x", [1], 0)) is None
@@ -0,0 +1,47 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+
+from dalle_mini.model.modeling import sinkhorn_normalization
+
+
+def unrolled_sinkhorn_normalization(attn_weights, mask=None, iters=1):
+    """Reference implementation, unrolled in the traced graph."""
+    for i in range(iters):
+        axis = -1 if i % 2 == 0 else -2
+        attn_weights -= jax.nn.logsumexp(attn_weights, axis=axis, keepdims=True)
+        if mask is not None:
+            attn_weights = jnp.where(mask, attn_weights, -jnp.inf)
+    return attn_weights
+
+
+@pytest.mark.parametrize("iters", [1, 2, 3, 4, 5])
+def test_sinkhorn_normalization(iters):
+    attn_weights = jax.random.normal(jax.random.PRNGKey(0), (2, 3, 6, 6))
+    expected = unrolled_sinkhorn_normalization(attn_weights, iters=iters)
+    np.testing.assert_allclose(
+        sinkhorn_normalization(attn_weights, iters=iters), expected, atol=1e-5
+    )
+
+    # padded positions stay masked
+    mask = jnp.arange(6) < jnp.array([6, 4])[:, None, None, None]
+    mask = mask & mask.swapaxes(-1, -2)
+    expected = unrolled_sinkhorn_normalization(attn_weights, mask, iters)
+    np.testing.assert_allclose(
+        sinkhorn_normalization(attn_weights, mask, iters), expected, atol=1e-5
+    )
+
+    # gradients through the rematerialized loop
+    def loss(fn, x):
+        return (jax.nn.softmax(fn(x, iters=iters)) * jnp.arange(6)).sum()
+
+    np.testing.assert_allclose(
+        jax.grad(loss, argnums=1)(sinkhorn_normalization, attn_weights),
+        jax.grad(loss, argnums=1)(unrolled_sinkhorn_normalization, attn_weights),
+        atol=1e-5,
+    )
@@ -0,0 +1,76 @@
+import pytest
+
+jax = pytest.importorskip("jax")
+pytest.importorskip("flax")
+pytest.importorskip("dalle_mini")
+
+import jax.numpy as jnp
+import numpy as np
+
+
+def prompts(batch_size):
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (batch_size, 8), 0, 100)
+    return {
+        "input_ids": input_ids,
+        "attention_mask": jnp.ones_like(input_ids),
+        "input_ids_uncond": jnp.zeros_like(input_ids),
+        "attention_mask_uncond": jnp.ones_like(input_ids),
+    }
+
+
+@pytest.mark.parametrize("condition_scale", [1.0, 3.0])
+def test_speculative_sampling_matches_sampling(condition_scale, tiny_model):
+    # with top_k=1 sampling is deterministic: proposals of the draft model are
+    # accepted only where they match the tokens sampled by `_sample`
+    model, draft_model = tiny_model(seed=0), tiny_model(seed=1)
+    inputs = prompts(3)
+    kwargs = dict(prng_key=jax.random.PRNGKey(0), top_k=1)
+    expected = model.generate(
+        **inputs, condition_scale=condition_scale, **kwargs
+    ).sequences
+    sequences = model.generate(
+        **inputs,
+        condition_scale=condition_scale,
+        draft_model=draft_model,
+        draft_params=draft_model.params,
+        num_speculative_tokens=3,
+        **kwargs,
+    ).sequences
+    np.testing.assert_array_equal(sequences, expected)
+
+
+def test_speculative_sampling_applies_logits_processor(tiny_model):
+    model, draft_model = tiny_model(seed=0), tiny_model(seed=1)
+    inputs = prompts(2)
+    kwargs = dict(prng_key=jax.random.PRNGKey(0), top_k=1, forced_bos_token_id=7)
+    expected = model.generate(**inputs, **kwargs).sequences
+    sequences = model.generate(
+        **inputs, draft_model=draft_model, draft_params=draft_model.params, **kwargs
+    ).sequences
+    assert (sequences[:, 1] == 7).all()
+    np.testing.assert_array_equal(sequences, expected)
+
+
+def test_speculative_sampling_with_uncond_cache(tiny_model):
+    model, draft_model = tiny_model(seed=0), tiny_model(seed=1)
+    inputs = prompts(2)
+    uncond_cache = model.init_uncond_cache(inputs["input_ids_uncond"])
+    kwargs = dict(
+        prng_key=jax.random.PRNGKey(0),
+        top_k=1,
+        condition_scale=3.0,
+        draft_model=draft_model,
+        draft_params=draft_model.params,
+    )
+    expected = model.generate(**inputs, **kwargs).sequences
+    sequences = model.generate(**inputs, uncond_cache=uncond_cache, **kwargs).sequences
+    np.testing.assert_array_equal(sequences, expected)
+
+    # the draft model cannot use the encoder outputs of `uncond_cache`
+    with pytest.raises(ValueError, match="input_ids_uncond"):
+        model.generate(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            uncond_cache=uncond_cache,
+            **kwargs,
+        )
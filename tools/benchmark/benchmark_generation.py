@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright 2021-2022 The HuggingFace & DALL·E Mini team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Latency and throughput benchmark of DalleBart generation.
+
+By default, a tiny randomly initialized model and tokenizer are used so that the
+benchmark runs on CPU without downloading anything:
+
+    python tools/benchmark/benchmark_generation.py --output_file results.json
+"""
+
+import itertools
+import json
+import logging
+import resource
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+import jax
+import numpy as np
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors
+from transformers import HfArgumentParser
+
+from dalle_mini.model import (
+    DalleBart,
+    DalleBartConfig,
+    DalleBartProcessor,
+    DalleBartTokenizer,
+)
+
+logger = logging.getLogger(__name__)
+
+CACHE_OPTIONS = ["default", "fuse_uncond", "uncond_cache", "kv_int8"]
+
+PROMPTS = [
+    "sunset over a lake in the mountains",
+    "the Eiffel tower landing on the moon",
+    "a cute avocado armchair",
+    "an oil painting of a fox in the snow",
+]
+
+
+@dataclass
+class BenchmarkArguments:
+    """
+    Arguments pertaining to the model and the settings swept by the benchmark.
+    """
+
+    model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Pretrained model to benchmark. A tiny random model is used if not set."
+        },
+    )
+    tokenizer_name: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Pretrained tokenizer name or path. A byte-level tokenizer is built if not set."
+        },
+    )
+    d_model: int = field(default=64, metadata={"help": "Size of the tiny model."})
+    layers: int = field(
+        default=2, metadata={"help": "Encoder and decoder layers of the tiny model."}
+    )
+    attention_heads: int = field(
+        default=4, metadata={"help": "Attention heads of the tiny model."}
+    )
+    image_vocab_size: int = field(
+        default=256, metadata={"help": "Image vocabulary of the tiny model."}
+    )
+    image_length: int = field(
+        default=64, metadata={"help": "Image tokens generated by the tiny model."}
+    )
+    max_text_length: int = field(
+        default=16, metadata={"help": "Text tokens of the tiny model."}
+    )
+    use_scan: Optional[bool] = field(
+        default=None, metadata={"help": "Scan over layers in the tiny model."}
+    )
+    batch_sizes: List[int] = field(
+        default_factory=lambda: [1, 4], metadata={"help": "Batch sizes to sweep."}
+    )
+    condition_scales: List[float] = field(
+        default_factory=lambda: [1.0, 3.0],
+        metadata={"help": "Super conditioning scales to sweep."},
+    )
+    top_ks: List[int] = field(
+        default_factory=lambda: [50], metadata={"help": "top_k values to sweep."}
+    )
+    top_ps: List[float] = field(
+        default_factory=lambda: [1.0], metadata={"help": "top_p values to sweep."}
+    )
+    cache_options: List[str] = field(
+        default_factory=lambda: list(CACHE_OPTIONS),
+        metadata={"help": f"Cache options to sweep, among {CACHE_OPTIONS}."},
+    )
+    num_iterations: int = field(
+        default=10, metadata={"help": "Timed generations per configuration."}
+    )
+    measure_ttft: bool = field(
+        default=True,
+        metadata={"help": "Measure time to first token with streaming generation."},
+    )
+    seed: int = field(default=0, metadata={"help": "Random seed."})
+    output_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "JSON file for the results, printed if not set."},
+    )
+
+    def __post_init__(self):
+        for option in self.cache_options:
+            assert (
+                option in CACHE_OPTIONS
+            ), f"cache option must be one of {CACHE_OPTIONS}"
+
+
+def build_tokenizer():
+    """Byte-level BPE tokenizer without merges, so that nothing is downloaded."""
+    special_tokens = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"]
+    vocab = {
+        token: i
+        for i, token in enumerate(
+            special_tokens + sorted(pre_tokenizers.ByteLevel.alphabet())
+        )
+    }
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.post_processor = processors.RobertaProcessing(("</s>", 2), ("<s>", 0))
+    tokenizer.decoder = decoders.ByteLevel()
+    return DalleBartTokenizer(tokenizer_object=tokenizer)
+
+
+def load_model(args, cache_option):
+    config_kwargs = (
+        {"kv_cache_quantization": "int8"} if cache_option == "kv_int8" else {}
+    )
+    if args.tokenizer_name is not None:
+        tokenizer = DalleBartTokenizer.from_pretrained(args.tokenizer_name)
+    elif args.model_name_or_path is not None:
+        tokenizer = DalleBartTokenizer.from_pretrained(args.model_name_or_path)
+    else:
+        tokenizer = build_tokenizer()
+    if args.model_name_or_path is not None:
+        model, params = DalleBart.from_pretrained(
+            args.model_name_or_path, _do_init=False, **config_kwargs
+        )
+    else:
+        config = DalleBartConfig(
+            encoder_vocab_size=len(tokenizer),
+            image_vocab_size=args.image_vocab_size,
+            image_length=args.image_length,
+            max_text_length=args.max_text_length,
+            encoder_layers=args.layers,
+            decoder_layers=args.layers,
+            encoder_attention_heads=args.attention_heads,
+            decoder_attention_heads=args.attention_heads,
+            encoder_ffn_dim=4 * args.d_model,
+            decoder_ffn_dim=4 * args.d_model,
+            d_model=args.d_model,
+            use_scan=args.use_scan,
+            gradient_checkpointing=False,
+            **config_kwargs,
+        )
+        model = DalleBart(config, seed=args.seed)
+        params = model.params
+    processor = DalleBartProcessor(
+        tokenizer, model.config.normalize_text, model.config.max_text_length
+    )
+    return model, params, processor
+
+
+def peak_memory():
+    """Peak memory of the first device (when reported) and of the host process."""
+    stats = jax.local_devices()[0].memory_stats() or {}
+    return {
+        "peak_device_bytes": stats.get("peak_bytes_in_use"),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_host_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * 1024,
+    }
+
+
+def benchmark(
+    model,
+    params,
+    processor,
+    batch_size,
+    condition_scale,
+    top_k,
+    top_p,
+    cache_option,
+    args,
+):
+    prompts = list(itertools.islice(itertools.cycle(PROMPTS), batch_size))
+    tokenize_times = []
+    for _ in range(args.num_iterations):
+        start = time.perf_counter()
+        inputs = processor(prompts)
+        tokenize_times.append(time.perf_counter() - start)
+
+    generate_kwargs = {
+        "condition_scale": condition_scale,
+        "top_k": top_k,
+        "top_p": top_p,
+        "fuse_uncond": cache_option == "fuse_uncond",
+    }
+    uncond_cache = None
+    if cache_option == "uncond_cache":
+        # the unconditional prompt is encoded once for all requests
+        uncond_cache = jax.jit(model.init_uncond_cache)(
+            inputs["input_ids_uncond"][:1],
+            inputs["attention_mask_uncond"][:1],
+            params=params,
+        )
+        inputs = {k: v for k, v in inputs.items() if not k.endswith("_uncond")}
+
+    def generate(params, inputs, prng_key, uncond_cache):
+        return model.generate(
+            **inputs,
+            prng_key=prng_key,
+            params=params,
+            uncond_cache=uncond_cache,
+            **generate_kwargs,
+        ).sequences
+
+    start = time.perf_counter()
+    compiled = (
+        jax.jit(generate)
+        .lower(params, inputs, jax.random.PRNGKey(args.seed), uncond_cache)
+        .compile()
+    )
+    compile_time = time.perf_counter() - start
+
+    latencies = []
+    key = jax.random.PRNGKey(args.seed)
+    for _ in range(args.num_iterations):
+        key, subkey = jax.random.split(key)
+        start = time.perf_counter()
+        compiled(params, inputs, subkey, uncond_cache).block_until_ready()
+        latencies.append(time.perf_counter() - start)
+
+    ttft = None
+    if args.measure_ttft:
+        # first call compiles the chunked decoding loop
+        ttfts = []
+        for _ in range(2):
+            start = time.perf_counter()
+            stream = model.generate(
+                **inputs,
+                prng_key=key,
+                params=params,
+                uncond_cache=uncond_cache,
+                stream=True,
+                decode_chunk_size=1,
+                **generate_kwargs,
+            )
+            next(stream).sequences.block_until_ready()
+            ttfts.append(time.perf_counter() - start)
+            stream.close()
+        ttft = ttfts[-1]
+
+    num_tokens = batch_size * model.config.image_length
+    return {
+        "batch_size": batch_size,
+        "condition_scale": condition_scale,
+        "top_k": top_k,
+        "top_p": top_p,
+        "cache_option": cache_option,
+        "compile_time": compile_time,
+        "time_to_first_token": ttft,
+        "tokens_per_second": num_tokens / float(np.median(latencies)),
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "tokenize_latency_p50": float(np.percentile(tokenize_times, 50)),
+        **peak_memory(),
+    }
+
+
+def main():
+    # See all possible arguments by passing the --help flag to this script.
+    parser = HfArgumentParser(BenchmarkArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    results = []
+    for cache_option in args.cache_options:
+        model, params, processor = load_model(args, cache_option)
+        for batch_size, condition_scale, top_k, top_p in itertools.product(
+            args.batch_sizes, args.condition_scales, args.top_ks, args.top_ps
+        ):
+            if condition_scale == 1.0 and cache_option in [
+                "fuse_uncond",
+                "uncond_cache",
+            ]:
+                # same as "default" without super conditioning
+                continue
+            logger.info(
+                f"batch_size={batch_size} condition_scale={condition_scale} "
+                f"top_k={top_k} top_p={top_p} cache_option={cache_option}"
+            )
+            results.append(
+                benchmark(
+                    model,
+                    params,
+                    processor,
+                    batch_size,
+                    condition_scale,
+                    top_k,
+                    top_p,
+                    cache_option,
+                    args,
+                )
+            )
+
+    output = {
+        "args": asdict(args),
+        "jax": jax.__version__,
+        "backend": jax.default_backend(),
+        "devices": [d.device_kind for d in jax.local_devices()],
+        "results": results,
+    }
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
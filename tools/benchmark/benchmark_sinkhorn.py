@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright 2021-2022 The HuggingFace & DALL·E Mini team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Step time and memory of the Sinkhorn normalization of encoder attention weights
+(`sinkhorn_iters > 1`), `lax.fori_loop` implementation against the unrolled loop:
+
+    python tools/benchmark/benchmark_sinkhorn.py --output_file results.json
+"""
+
+import json
+import logging
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from transformers import HfArgumentParser
+
+from dalle_mini.model.modeling import sinkhorn_normalization
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BenchmarkArguments:
+    """
+    Arguments pertaining to the shape of the attention weights and the iterations swept.
+    """
+
+    batch_size: int = field(default=8, metadata={"help": "Batch size."})
+    attention_heads: int = field(default=16, metadata={"help": "Attention heads."})
+    max_text_length: int = field(
+        default=64, metadata={"help": "Query and key length of encoder attention."}
+    )
+    sinkhorn_iters: List[int] = field(
+        default_factory=lambda: [2, 4, 8],
+        metadata={"help": "Sinkhorn iterations to sweep."},
+    )
+    num_iterations: int = field(
+        default=20, metadata={"help": "Timed steps per configuration."}
+    )
+    seed: int = field(default=0, metadata={"help": "Random seed."})
+    output_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "JSON file for the results, printed if not set."},
+    )
+
+
+def unrolled_sinkhorn_normalization(attn_weights, mask=None, iters=1):
+    """Previous implementation, unrolled in the traced graph."""
+    for i in range(iters):
+        if i % 2 == 0:
+            attn_weights -= jax.nn.logsumexp(attn_weights, axis=-1, keepdims=True)
+        else:
+            attn_weights -= jax.nn.logsumexp(attn_weights, axis=-2, keepdims=True)
+        if mask is not None:
+            attn_weights = jnp.where(mask, attn_weights, -jnp.inf)
+    return attn_weights
+
+
+IMPLEMENTATIONS = {
+    "unrolled": unrolled_sinkhorn_normalization,
+    "fori_loop": sinkhorn_normalization,
+}
+
+
+def make_step(normalization, iters):
+    """Forward and backward pass through the normalization, as in training."""
+
+    def loss_fn(attn_weights, value, mask):
+        weights = jnp.exp(normalization(attn_weights, mask, iters))
+        return jnp.sum(jnp.einsum("...hqk,...khd->...qhd", weights, value) ** 2)
+
+    return jax.value_and_grad(loss_fn)
+
+
+def residual_bytes(normalization, iters, inputs):
+    """Bytes of the activations saved for the backward pass (on any backend)."""
+    attn_weights, _, mask = inputs
+    _, vjp_fn = jax.vjp(lambda x: normalization(x, mask, iters), attn_weights)
+    leaves = jax.tree_util.tree_leaves(vjp_fn)
+    return sum(x.nbytes for x in leaves if hasattr(x, "nbytes"))
+
+
+def compiled_memory(compiled):
+    """Temporary and output buffer sizes reported by XLA, when available."""
+    try:
+        analysis = compiled.memory_analysis()
+    except (AttributeError, NotImplementedError):
+        analysis = None
+    if analysis is None:
+        return {"temp_bytes": None, "output_bytes": None}
+    return {
+        "temp_bytes": analysis.temp_size_in_bytes,
+        "output_bytes": analysis.output_size_in_bytes,
+    }
+
+
+def benchmark(name, iters, inputs, reference, args):
+    step = make_step(IMPLEMENTATIONS[name], iters)
+    num_equations = len(jax.make_jaxpr(step)(*inputs).jaxpr.eqns)
+    saved_bytes = residual_bytes(IMPLEMENTATIONS[name], iters, inputs)
+
+    start = time.perf_counter()
+    compiled = jax.jit(step).lower(*inputs).compile()
+    compile_time = time.perf_counter() - start
+
+    loss, grad = compiled(*inputs)
+    step_times = []
+    for _ in range(args.num_iterations):
+        start = time.perf_counter()
+        jax.block_until_ready(compiled(*inputs))
+        step_times.append(time.perf_counter() - start)
+
+    reference_loss, reference_grad = reference
+    return {
+        "implementation": name,
+        "sinkhorn_iters": iters,
+        "jaxpr_equations": num_equations,
+        "compile_time": compile_time,
+        "step_time_p50": float(np.percentile(step_times, 50)),
+        "step_time_p99": float(np.percentile(step_times, 99)),
+        "max_loss_diff": float(jnp.abs(loss - reference_loss)),
+        "max_grad_diff": float(jnp.nanmax(jnp.abs(grad - reference_grad))),
+        "residual_bytes": saved_bytes,
+        **compiled_memory(compiled),
+    }
+
+
+def main():
+    # See all possible arguments by passing the --help flag to this script.
+    parser = HfArgumentParser(BenchmarkArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    length, heads = args.max_text_length, args.attention_heads
+    keys = jax.random.split(jax.random.PRNGKey(args.seed), 2)
+    attn_weights = jax.random.normal(keys[0], (args.batch_size, heads, length, length))
+    value = jax.random.normal(keys[1], (args.batch_size, length, heads, 64))
+    # padded prompts, as in the encoder
+    lengths = np.linspace(length // 4, length, args.batch_size).astype(np.int32)
+    mask = (np.arange(length)[None, :] < lengths[:, None])[:, None, None, :]
+    attn_weights = jnp.where(mask, attn_weights, -jnp.inf)
+    inputs = (attn_weights, value, jnp.asarray(mask))
+
+    results = []
+    for iters in args.sinkhorn_iters:
+        reference = jax.jit(make_step(unrolled_sinkhorn_normalization, iters))(*inputs)
+        for name in IMPLEMENTATIONS:
+            logger.info(f"implementation={name} sinkhorn_iters={iters}")
+            results.append(benchmark(name, iters, inputs, reference, args))
+
+    output = {
+        "args": asdict(args),
+        "jax": jax.__version__,
+        "backend": jax.default_backend(),
+        "devices": [d.device_kind for d in jax.local_devices()],
+        "results": results,
+    }
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
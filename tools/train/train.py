@@ -340,6 +340,14 @@ class TrainingArguments:
     gradient_checkpointing: bool = field(
         default=False, metadata={"help": "Use gradient checkpointing."}
     )
+    remat_policy: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Activations saved by gradient checkpointing: None (recompute everything), "
+            '"save_attention" (recompute feed-forward blocks) or "save_dots" (save outputs of '
+            "dense layers)."
+        },
+    )
 
     learning_rate: float = field(
         default=5e-5, metadata={"help": "The initial learning rate."}
@@ -531,6 +539,11 @@ class TrainingArguments:
             "sgd",
             "sqrt_n",
         ], f"Selected graft type not supported: {self.graft_type}"
+        assert self.remat_policy in [
+            None,
+            "save_attention",
+            "save_dots",
+        ], f"Selected remat policy not supported: {self.remat_policy}"
         assert self.lr_decay in [
             None,
             "linear",
@@ -698,6 +711,7 @@ def main():
         if getattr(model_args, k) is not None
     }
     config_args["gradient_checkpointing"] = training_args.gradient_checkpointing
+    config_args["remat_policy"] = training_args.remat_policy
     if model_args.config_name:
         config = DalleBartConfig.from_pretrained(model_args.config_name)
     else: